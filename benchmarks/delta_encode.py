@@ -0,0 +1,79 @@
+"""Benchmark for delta encoding of a mostly unchanged file.
+
+Builds a random basis file, derives a "nightly" version from it with a few
+in-place edits, an insertion and a deletion, and reports how many bytes the
+delta would put on the wire compared to a full send, plus the time taken to
+compute the receiver's signature and the sender's delta. It also times the
+delta of an unrelated file of the same size, where nothing matches.
+
+Usage: python benchmarks/delta_encode.py [megabytes]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+
+import delta  # noqa: E402
+
+
+def make_files(directory, megabytes):
+    basis = os.path.join(directory, "basis.bin")
+    target = os.path.join(directory, "target.bin")
+    data = bytearray(os.urandom(megabytes * 1024 * 1024))
+    with open(basis, "wb") as f:
+        f.write(data)
+    rng = random.Random(0)
+    for _ in range(8):
+        offset = rng.randrange(len(data) - 4096)
+        data[offset : offset + 512] = os.urandom(512)
+    middle = len(data) // 2
+    data[middle:middle] = os.urandom(10000)
+    del data[middle // 2 : middle // 2 + 3000]
+    with open(target, "wb") as f:
+        f.write(data)
+    return basis, target
+
+
+def run(megabytes):
+    with tempfile.TemporaryDirectory() as directory:
+        basis, target = make_files(directory, megabytes)
+        start = time.perf_counter()
+        signature = delta.file_signature(basis)
+        signed = time.perf_counter()
+        block_size, _, table = delta.parse_signature(signature)
+        literal = copies = 0
+        for op in delta.delta_ops(target, block_size, table):
+            if op[0] == "data":
+                literal += len(op[1])
+            elif op[0] == "copy":
+                copies += 1
+        done = time.perf_counter()
+        size = os.path.getsize(target)
+        wire = literal + len(signature) + copies * (1 + delta.COPY_OP.size)
+        print(f"file        {size / 1048576:10.1f} MiB  (block {block_size} B)")
+        print(f"signature   {len(signature) / 1024:10.1f} KiB  {signed - start:6.2f} s")
+        print(f"delta       {literal / 1024:10.1f} KiB literal, {copies} copy runs")
+        print(
+            f"encode      {done - signed:10.2f} s  ({size / 1048576 / (done - signed):.0f} MiB/s)"
+        )
+        print(f"reduction   {size / wire:10.1f}x fewer bytes than a full send")
+
+        with open(target, "wb") as f:
+            f.write(os.urandom(size))
+        start = time.perf_counter()
+        for op in delta.delta_ops(target, block_size, table):
+            pass
+        elapsed = time.perf_counter() - start
+        print(
+            f"unrelated   {elapsed:10.2f} s  ({size / 1048576 / elapsed:.0f} MiB/s, no matches)"
+        )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
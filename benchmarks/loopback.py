@@ -0,0 +1,335 @@
+"""End-to-end loopback benchmark: a real receiver and sender over 127.0.0.1.
+
+The receiver runs `receiver_thread` in a child process (with every sender
+auto-accepted) and the sender calls `send_file` / `send_files` from this
+process, each side with its own working directory and keys. For every case
+the suite records throughput, CPU time per GB and peak RSS of both sides;
+handshake latency is measured separately for the full key exchange and for
+a resumed session. Results are printed, and written as JSON with --output
+so runs can be compared.
+
+Cases: many tiny files sent as one batch, and medium and large files of
+random (incompressible) and text-like (compressible) data. The sender's
+peak RSS includes the page-cache pages of its memory-mapped input, which
+the kernel can drop at any time.
+
+Usage: python benchmarks/loopback.py [--large-mb 2048] [--output results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+
+import peers  # noqa: E402
+import transfer  # noqa: E402
+
+HOST = "127.0.0.1"
+MB = 1024 * 1024
+TEXT_BLOCK = "".join(
+    f"2024-05-{i % 28 + 1:02d} 12:{i % 60:02d}:{i * 7 % 60:02d} INFO "
+    f"worker-{i % 16} processed request {i} in {i % 997} ms\n"
+    for i in range(20000)
+).encode()[:MB]
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss():
+    """Reset the peak RSS counter where the kernel allows it (Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+def process_stats():
+    return {"cpu_s": cpu_time(), "peak_rss_mb": peak_rss_mb()}
+
+
+def run_receiver(workdir, port, commands):
+    """Child process: serve transfers until told to stop."""
+    import logging
+
+    logging.disable(logging.CRITICAL)
+    os.chdir(workdir)
+    transfer.PORT = port
+    transfer.RECEIVED_DIR = os.path.join(workdir, "Received")
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=transfer.receiver_thread,
+        args=(None, None, stop_event),
+        kwargs={"auto_accept": True},
+        daemon=True,
+    )
+    thread.start()
+    while True:
+        command = commands.recv()
+        if command == "reset":
+            reset_peak_rss()
+            commands.send(process_stats())
+        elif command == "stats":
+            commands.send(process_stats())
+        elif command == "stop":
+            stop_event.set()
+            thread.join(5)
+            commands.send(None)
+            return
+
+
+def write_file(path, size, kind):
+    with open(path, "wb") as f:
+        while size > 0:
+            block = os.urandom(min(MB, size)) if kind == "random" else TEXT_BLOCK
+            f.write(block[:size])
+            size -= min(len(block), size)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Receiver did not start listening")
+
+
+def wait_for_files(received_dir, names, timeout=60):
+    """The last ack can precede the receiver's commit; wait until it lands."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(os.path.exists(os.path.join(received_dir, name)) for name in names):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def measure_handshakes(samples):
+    """Return (full, resumed) handshake latencies in milliseconds."""
+
+    def handshake():
+        started = time.perf_counter()
+        s, version = transfer.open_session(HOST)
+        with s:
+            if transfer.exchange_keys(s, HOST, version) is None:
+                raise RuntimeError("Receiver rejected the handshake")
+        return (time.perf_counter() - started) * 1000
+
+    full, resumed = [], []
+    for _ in range(samples):
+        peers.drop_ticket(HOST)
+        full.append(handshake())
+        resumed.append(handshake())
+    return full, resumed
+
+
+def summarize(values):
+    return {
+        "median_ms": round(statistics.median(values), 2),
+        "min_ms": round(min(values), 2),
+        "max_ms": round(max(values), 2),
+    }
+
+
+def clear_received(received_dir):
+    """Delete earlier results (keeping .partial and .chunks) to save space."""
+    if not os.path.isdir(received_dir):
+        return
+    for name in os.listdir(received_dir):
+        path = os.path.join(received_dir, name)
+        if name.startswith("."):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def run_case(name, paths, total, received_dir, commands, streams, compression):
+    statuses = []
+    clear_received(received_dir)
+    commands.send("reset")
+    receiver_before = commands.recv()
+    reset_peak_rss()
+    sender_cpu = cpu_time()
+    started = time.perf_counter()
+    if len(paths) == 1 and os.path.isfile(paths[0]):
+        transfer.send_file(
+            HOST,
+            paths[0],
+            status_callback=statuses.append,
+            streams=streams,
+            compression=compression,
+        )
+    else:
+        transfer.send_files(
+            HOST, paths, status_callback=statuses.append, compression=compression
+        )
+    elapsed = time.perf_counter() - started
+    sender_cpu = cpu_time() - sender_cpu
+    sender_peak = peak_rss_mb()
+    landed = wait_for_files(received_dir, [os.path.basename(p) for p in paths])
+    commands.send("stats")
+    receiver_after = commands.recv()
+
+    ok = landed and any("✅" in status for status in statuses)
+    gigabytes = total / 1024**3
+    receiver_cpu = receiver_after["cpu_s"] - receiver_before["cpu_s"]
+    result = {
+        "case": name,
+        "ok": ok,
+        "bytes": total,
+        "seconds": round(elapsed, 4),
+        "mb_per_s": round(total / MB / elapsed, 2) if elapsed else None,
+        "sender": {
+            "cpu_s": round(sender_cpu, 3),
+            "cpu_s_per_gb": round(sender_cpu / gigabytes, 3) if total else None,
+            "peak_rss_mb": round(sender_peak, 1),
+        },
+        "receiver": {
+            "cpu_s": round(receiver_cpu, 3),
+            "cpu_s_per_gb": round(receiver_cpu / gigabytes, 3) if total else None,
+            "peak_rss_mb": round(receiver_after["peak_rss_mb"], 1),
+        },
+    }
+    if not ok:
+        result["status"] = statuses[-1] if statuses else "no status"
+    return result
+
+
+def build_cases(args, datadir):
+    """Yield (name, paths, total bytes) with the data written just in time."""
+    if args.tiny_count:
+        tiny_dir = os.path.join(datadir, "tiny")
+        os.makedirs(tiny_dir)
+        for index in range(args.tiny_count):
+            write_file(os.path.join(tiny_dir, f"{index:05d}.bin"), 1024, "random")
+        yield f"tiny-{args.tiny_count}x1KiB", [tiny_dir], args.tiny_count * 1024
+    for label, megabytes in (("medium", args.medium_mb), ("large", args.large_mb)):
+        if not megabytes:
+            continue
+        for kind in ("random", "text"):
+            path = os.path.join(datadir, f"{label}-{kind}.bin")
+            write_file(path, megabytes * MB, kind)
+            yield f"{label}-{kind}-{megabytes}MiB", [path], megabytes * MB
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=5301)
+    parser.add_argument("--tiny-count", type=int, default=1000)
+    parser.add_argument("--medium-mb", type=int, default=64)
+    parser.add_argument("--large-mb", type=int, default=2048)
+    parser.add_argument("--streams", type=int, default=1)
+    parser.add_argument("--compress", choices=transfer.MODES, default="auto")
+    parser.add_argument("--handshakes", type=int, default=5)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="lancryptor-bench-")
+    sender_dir = os.path.join(root, "sender")
+    receiver_dir = os.path.join(root, "receiver")
+    datadir = os.path.join(root, "data")
+    for path in (sender_dir, receiver_dir, datadir):
+        os.makedirs(path)
+
+    context = multiprocessing.get_context("spawn")
+    commands, child_commands = context.Pipe()
+    receiver = context.Process(
+        target=run_receiver, args=(receiver_dir, args.port, child_commands)
+    )
+    receiver.start()
+    cwd = os.getcwd()
+    try:
+        os.chdir(sender_dir)
+        transfer.PORT = args.port
+        transfer.notify = lambda title, message: None
+        transfer.generate_keys()
+        wait_for_port(args.port)
+
+        full, resumed = measure_handshakes(args.handshakes)
+        results = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "protocol": transfer.PROTOCOL_VERSION,
+                "streams": args.streams,
+                "compression": args.compress,
+            },
+            "handshake": {"full": summarize(full), "resumed": summarize(resumed)},
+            "cases": [],
+        }
+        print(
+            f"handshake: full {results['handshake']['full']['median_ms']} ms, "
+            f"resumed {results['handshake']['resumed']['median_ms']} ms"
+        )
+        received_dir = os.path.join(receiver_dir, "Received")
+        for name, paths, total in build_cases(args, datadir):
+            result = run_case(
+                name,
+                paths,
+                total,
+                received_dir,
+                commands,
+                args.streams,
+                args.compress,
+            )
+            results["cases"].append(result)
+            print(
+                f"{name:24} {'ok' if result['ok'] else 'FAILED':6} "
+                f"{result['mb_per_s'] or 0:9.1f} MB/s  "
+                f"sender {result['sender']['cpu_s_per_gb'] or 0:6.2f} CPU s/GB "
+                f"{result['sender']['peak_rss_mb']:7.1f} MB  "
+                f"receiver {result['receiver']['cpu_s_per_gb'] or 0:6.2f} CPU s/GB "
+                f"{result['receiver']['peak_rss_mb']:7.1f} MB"
+            )
+    finally:
+        os.chdir(cwd)
+        if receiver.is_alive():
+            commands.send("stop")
+            commands.recv()
+        receiver.join(10)
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Startup benchmark: how long CLI modes take before they do any work.
+
+Every case starts a fresh interpreter running src/main.py. For `send`, the
+benchmark listens on transfer.PORT itself and measures the time until the
+first bytes of the sender's hello arrive, then drops the connection (and
+the fallback connections that follow). The other cases are timed until the
+process exits. The first run of each case generates the sender's keys or
+warms the file cache and is not counted.
+
+Usage: python benchmarks/startup.py [--runs 20] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MAIN = os.path.join(ROOT, "src", "main.py")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import transfer  # noqa: E402
+
+HOST = "127.0.0.1"
+
+
+def time_exit(args, cwd):
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return (time.perf_counter() - started) * 1000
+
+
+def time_to_wire(listener, path, cwd):
+    """Milliseconds from spawning `main.py send` to its first bytes."""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, MAIN, "send", "--ip", HOST, "--file", path],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        conn, _ = listener.accept()
+        with conn:
+            conn.recv(64)
+            elapsed = (time.perf_counter() - started) * 1000
+    finally:
+        # The sender would wait IDLE_TIMEOUT on its fallback connection
+        process.kill()
+        process.wait()
+        drain(listener)
+    return elapsed
+
+
+def drain(listener):
+    """Drop connections the sender made after the first (protocol fallback)."""
+    listener.setblocking(False)
+    try:
+        while True:
+            listener.accept()[0].close()
+    except BlockingIOError:
+        pass
+    finally:
+        listener.settimeout(30)
+
+
+def summarize(values):
+    return {
+        "median_ms": round(statistics.median(values), 1),
+        "min_ms": round(min(values), 1),
+        "max_ms": round(max(values), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="lancryptor-startup-")
+    path = os.path.join(workdir, "payload.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(1024))
+
+    listener = socket.create_server((HOST, transfer.PORT))
+    listener.settimeout(30)
+    cases = {
+        "python -c pass": lambda: time_exit(["-c", "pass"], workdir),
+        "main.py --help": lambda: time_exit([MAIN, "--help"], workdir),
+        "main.py peers list": lambda: time_exit([MAIN, "peers", "list"], workdir),
+        "main.py send (to wire)": lambda: time_to_wire(listener, path, workdir),
+    }
+    try:
+        results = {}
+        for name, run in cases.items():
+            run()
+            results[name] = summarize([run() for _ in range(args.runs)])
+            print(f"{name:24} {results[name]['median_ms']:7.1f} ms median")
+    finally:
+        listener.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
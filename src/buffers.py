@@ -0,0 +1,137 @@
+import mmap
+import threading
+
+# Map input files instead of reading them; set to False to force block reads
+MMAP_INPUT = True
+# Block size of the read fallback, a multiple of every chunk size used
+READ_BLOCK = 4 * 1024 * 1024
+
+
+class BufferPool:
+    """Thread-safe pool of fixed-size bytearrays that are reused across reads.
+
+    Buffers are created lazily. When more are in use than the pool keeps, a
+    fresh buffer is handed out and simply dropped on release.
+    """
+
+    def __init__(self, size, count):
+        self.size = size
+        self.count = count
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf):
+        with self._lock:
+            if len(buf) == self.size and len(self._free) < self.count:
+                self._free.append(buf)
+
+
+def recv_into_exact(sock, buf):
+    """Fill buf completely from sock without allocating intermediate bytes."""
+    view = memoryview(buf)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("Socket connection lost during recv_into_exact")
+        view = view[received:]
+
+
+class FrameReader:
+    """Read length-prefixed frames from a socket into pooled buffers.
+
+    `read` returns a memoryview over a pooled buffer that is only valid until
+    the next call; `scratch` is a second pooled buffer of the same size that
+    callers can decrypt into with `update_into`.
+    """
+
+    def __init__(self, sock, pool, header):
+        if pool.size < 16:
+            raise ValueError("Pool buffers are too small for framing")
+        self.sock = sock
+        self.pool = pool
+        self.header = header
+        self.max_frame = pool.size - 16
+        self._header_buf = bytearray(header.size)
+        self._frame = pool.acquire()
+        self.scratch = pool.acquire()
+        self._frame_view = memoryview(self._frame)
+        self.scratch_view = memoryview(self.scratch)
+
+    def read(self):
+        """Return the next frame payload, or an empty view at the end marker."""
+        return self.read_into(self._frame_view)
+
+    def read_into(self, buf):
+        """Read the next frame into buf (at least pool-sized) and return its view.
+
+        Useful when frames must outlive the next read, e.g. while they are
+        decrypted on another thread.
+        """
+        recv_into_exact(self.sock, self._header_buf)
+        length = self.header.unpack(self._header_buf)[0]
+        if length > self.max_frame:
+            raise ConnectionError(f"Frame too large: {length} bytes")
+        frame = memoryview(buf)[:length]
+        recv_into_exact(self.sock, frame)
+        return frame
+
+    def close(self):
+        self.pool.release(self._frame)
+        self.pool.release(self.scratch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def file_views(path, start, end, size):
+    """Yield consecutive memoryviews of at most `size` bytes over path[start:end].
+
+    The range is memory-mapped (from an allocation-aligned offset) with
+    sequential read-ahead, so chunks come straight from the page cache
+    without a read call or copy each. Where the file cannot be mapped
+    (network and virtual filesystems, empty ranges, a file that shrank) it
+    is read in READ_BLOCK pieces instead. Views keep the mapping alive, so
+    they may be handed to other threads. `size` may also be a callable
+    returning the size of each next view.
+    """
+    next_size = size if callable(size) else lambda: size
+    with open(path, "rb") as f:
+        mapped = None
+        if MMAP_INPUT and end > start:
+            base = start - start % mmap.ALLOCATIONGRANULARITY
+            try:
+                mapped = mmap.mmap(
+                    f.fileno(), end - base, access=mmap.ACCESS_READ, offset=base
+                )
+            except (OSError, ValueError, OverflowError):
+                mapped = None
+        if mapped is None:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0 and (block := f.read(min(READ_BLOCK, remaining))):
+                remaining -= len(block)
+                view = memoryview(block)
+                offset = 0
+                while offset < len(block):
+                    step = next_size()
+                    yield view[offset : offset + step]
+                    offset += step
+            return
+
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mapped)
+    offset = start - base
+    while offset < end - base:
+        step = next_size()
+        yield view[offset : offset + step]
+        offset += step
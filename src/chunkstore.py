@@ -0,0 +1,200 @@
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+# Content-defined chunking: every byte is mapped to one pseudo-random bit
+# and a chunk ends where the bits of the last BOUNDARY_BITS bytes spell out
+# a fixed pattern. Both steps run in C (bytes.translate / bytes.find), and
+# boundaries only depend on nearby content, so an insertion moves at most
+# a couple of chunk boundaries.
+MIN_CHUNK = 4096
+MAX_CHUNK = 65536
+BOUNDARY_BITS = 14
+READ_SIZE = 8 * 1024 * 1024
+_rng = random.Random(0x4C414E)
+BIT_TABLE = bytes(_rng.getrandbits(1) for _ in range(256))
+BOUNDARY = bytes(_rng.getrandbits(1) for _ in range(BOUNDARY_BITS))
+
+DIGEST_SIZE = 32
+CACHE_LIMIT = 2 * 1024 * 1024 * 1024
+# Eviction trims the store to this fraction of its limit
+EVICT_TO = 0.9
+INDEX_FILE = "index.sqlite3"
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).digest()
+
+
+def split_chunks(data, final):
+    """Return the chunk lengths found in `data`.
+
+    Unless `final` is set, the trailing bytes that did not reach a boundary
+    (or MAX_CHUNK) are left out so the caller can prepend them to more data.
+    """
+    bits = data.translate(BIT_TABLE)
+    lengths = []
+    pos = 0
+    size = len(data)
+    while pos < size:
+        found = bits.find(BOUNDARY, pos + MIN_CHUNK - BOUNDARY_BITS, pos + MAX_CHUNK)
+        if found != -1:
+            end = found + BOUNDARY_BITS
+        elif pos + MAX_CHUNK <= size or final:
+            end = min(pos + MAX_CHUNK, size)
+        else:
+            break
+        lengths.append(end - pos)
+        pos = end
+    return lengths
+
+
+def file_chunks(path):
+    """Yield (offset, length, digest) for the content-defined chunks of a file."""
+    offset = 0
+    pending = b""
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(READ_SIZE)
+            data = pending + block if pending else block
+            final = not block
+            pos = 0
+            for length in split_chunks(data, final):
+                yield offset, length, chunk_digest(data[pos : pos + length])
+                offset += length
+                pos += length
+            pending = data[pos:]
+            if final:
+                return
+
+
+class ChunkStore:
+    """Content-addressed chunks on disk with an SQLite index.
+
+    Chunks are stored one file each under root/<xx>/<digest>. The index
+    records sizes and last use so the least recently used chunks can be
+    evicted once the store grows past `limit` bytes. Chunks taking part in
+    a running transfer are pinned and never evicted.
+    """
+
+    def __init__(self, root, limit=CACHE_LIMIT):
+        self.root = root
+        self.limit = limit
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pins = {}
+        self._db = sqlite3.connect(
+            os.path.join(root, INDEX_FILE), check_same_thread=False
+        )
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "digest BLOB PRIMARY KEY, size INTEGER NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS chunks_last_used ON chunks(last_used)"
+            )
+
+    def _path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def missing(self, digests):
+        """Return the subset of `digests` that is not in the store."""
+        with self._lock:
+            present = set()
+            for digest in set(digests):
+                row = self._db.execute(
+                    "SELECT 1 FROM chunks WHERE digest = ?", (digest,)
+                ).fetchone()
+                if row:
+                    present.add(digest)
+        return {digest for digest in digests if digest not in present}
+
+    def get(self, digest):
+        """Return the chunk's bytes, or None if it is gone or damaged."""
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+        if data is None or chunk_digest(data) != digest:
+            logging.warning(f"Dropping missing or corrupt chunk {digest.hex()}")
+            self.remove(digest)
+            return None
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE chunks SET last_used = ? WHERE digest = ?",
+                (time.time(), digest),
+            )
+        return data
+
+    def put(self, digest, data):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chunks (digest, size, last_used) "
+                "VALUES (?, ?, ?)",
+                (digest, len(data), time.time()),
+            )
+
+    def remove(self, digest):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM chunks WHERE digest = ?", (digest,))
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def pin(self, digests):
+        with self._lock:
+            for digest in digests:
+                self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digests):
+        with self._lock:
+            for digest in digests:
+                count = self._pins.get(digest, 0) - 1
+                if count > 0:
+                    self._pins[digest] = count
+                else:
+                    self._pins.pop(digest, None)
+
+    def size(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM chunks"
+            ).fetchone()[0]
+
+    def evict(self):
+        """Drop least recently used chunks until the store fits its limit."""
+        total = self.size()
+        if total <= self.limit:
+            return 0
+        target = self.limit * EVICT_TO
+        victims = []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT digest, size FROM chunks ORDER BY last_used"
+            )
+            for digest, size in rows:
+                if total <= target:
+                    break
+                if digest in self._pins:
+                    continue
+                victims.append(digest)
+                total -= size
+        for digest in victims:
+            self.remove(digest)
+        logging.info(f"Evicted {len(victims)} chunks from the chunk store")
+        return len(victims)
@@ -0,0 +1,127 @@
+import threading
+import zlib
+
+# Per-chunk methods recorded in front of every chunk's payload
+STORED = 0
+DEFLATED = 1
+
+# Modes selectable with --compress
+MODES = ("auto", "none", "fast", "max")
+MODE_IDS = {mode: index for index, mode in enumerate(MODES)}
+
+LEVEL_FAST = 1
+LEVEL_STRONG = 6
+LEVEL_MAX = 9
+
+# Ratios (compressed / raw) that decide between storing, fast and strong
+STORE_ABOVE = 0.9
+STRONG_BELOW = 0.5
+# How often a stored stream is re-probed to notice compressible regions
+PROBE_EVERY = 32
+SAMPLE_SIZE = 65536
+SAMPLE_POINTS = 4
+
+
+def estimate_ratio(filepath, start=0, end=None):
+    """Estimate how well filepath[start:end] compresses from a few samples.
+
+    Samples are taken from evenly spaced points so a compressible header in
+    front of incompressible media does not skew the result.
+    """
+    with open(filepath, "rb") as f:
+        if end is None:
+            end = f.seek(0, 2)
+        length = end - start
+        if length <= 0:
+            return 1.0
+        step = max(length // SAMPLE_POINTS, SAMPLE_SIZE)
+        raw = compressed = 0
+        for offset in range(start, end, step):
+            f.seek(offset)
+            sample = f.read(min(SAMPLE_SIZE, end - offset))
+            raw += len(sample)
+            compressed += len(zlib.compress(sample, LEVEL_FAST))
+    return compressed / raw if raw else 1.0
+
+
+def level_for_ratio(ratio):
+    if ratio > STORE_ABOVE:
+        return None
+    if ratio < STRONG_BELOW:
+        return LEVEL_STRONG
+    return LEVEL_FAST
+
+
+class AdaptiveCompressor:
+    """Choose a compression level for each chunk of a stream.
+
+    With mode "auto" the level follows a moving average of how well recent
+    chunks compressed: incompressible data is stored, very compressible data
+    gets the strong level. Stored streams are probed every PROBE_EVERY chunks
+    so a change in content is picked up. Other modes use a fixed level.
+    """
+
+    def __init__(self, mode="auto", initial_ratio=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown compression mode: {mode}")
+        self.mode = mode
+        self.ratio = initial_ratio
+        self.since_probe = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """Return the zlib level for the next chunk, or None to store it."""
+        if self.mode == "none":
+            return None
+        if self.mode == "fast":
+            return LEVEL_FAST
+        if self.mode == "max":
+            return LEVEL_MAX
+        with self._lock:
+            if self.ratio is None:
+                return LEVEL_FAST
+            level = level_for_ratio(self.ratio)
+            if level is None:
+                self.since_probe += 1
+                if self.since_probe >= PROBE_EVERY:
+                    self.since_probe = 0
+                    return LEVEL_FAST
+            return level
+
+    def record(self, raw_size, packed_size, level):
+        """Feed back the outcome of a chunk compressed at `level`."""
+        if self.mode != "auto" or level is None or not raw_size:
+            return
+        with self._lock:
+            ratio = min(packed_size / raw_size, 1.0)
+            self.ratio = (
+                ratio if self.ratio is None else 0.75 * self.ratio + 0.25 * ratio
+            )
+
+
+def compress_chunk(chunk, level):
+    """Return (method, payload, packed_size) for one independent chunk.
+
+    Chunks that do not shrink are stored so incompressible data costs a
+    single compression attempt at most.
+    """
+    if level is not None and chunk:
+        packed = zlib.compress(chunk, level)
+        if len(packed) < len(chunk):
+            return DEFLATED, packed, len(packed)
+        return STORED, chunk, len(packed)
+    return STORED, chunk, len(chunk)
+
+
+def decompress_chunk(method, payload, max_size):
+    if method == STORED:
+        if len(payload) > max_size:
+            raise ValueError("Stored chunk is larger than allowed")
+        return payload
+    if method != DEFLATED:
+        raise ValueError(f"Unknown chunk compression method: {method}")
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, max_size)
+    if not decompressor.eof or decompressor.unconsumed_tail:
+        raise ValueError("Deflated chunk is corrupt or larger than allowed")
+    return data
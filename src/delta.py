@@ -0,0 +1,154 @@
+import hashlib
+import mmap
+import struct
+import zlib
+
+# Block size grows with the basis file (about sqrt(size), like rsync) so
+# the signature stays small for multi-gigabyte images
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 65536
+ADLER_MOD = 65521
+SIGNATURE_HEADER = struct.Struct("IQ")
+BLOCK_SIGNATURE = struct.Struct("I16s")
+
+# Control record operations in a delta stream
+OP_COPY = b"C"
+OP_DIGEST = b"D"
+COPY_OP = struct.Struct("QI")
+# Largest literal run handed out at once
+LITERAL_SIZE = 65536
+# Rolling the checksum costs Python time for every byte. Each time another
+# ROLL_LIMIT bytes have been rolled over, the scan stops rolling if less
+# than MIN_MATCH_RATIO of the file so far matched the basis; the rest is
+# then only checked at block boundaries (in C), which still finds blocks
+# that did not move, and everything else is sent as literal data.
+ROLL_LIMIT = 256 * 1024
+MIN_MATCH_RATIO = 0.5
+
+
+def block_size_for(size):
+    block = int(size**0.5) & ~1023
+    return max(MIN_BLOCK_SIZE, min(block, MAX_BLOCK_SIZE))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def file_signature(path):
+    """Return the block signature of the file at `path`, or an empty one.
+
+    Every full block contributes its adler32 checksum (cheap to roll on the
+    sender) and a 16-byte BLAKE2b hash that confirms a weak match.
+    """
+    try:
+        with open(path, "rb") as f:
+            block_size = block_size_for(f.seek(0, 2))
+            f.seek(0)
+            blocks = []
+            while len(block := f.read(block_size)) == block_size:
+                weak = zlib.adler32(block)
+                blocks.append(BLOCK_SIGNATURE.pack(weak, strong_hash(block)))
+    except FileNotFoundError:
+        return SIGNATURE_HEADER.pack(MIN_BLOCK_SIZE, 0)
+    return SIGNATURE_HEADER.pack(block_size, len(blocks)) + b"".join(blocks)
+
+
+def parse_signature(signature):
+    """Return (block_size, block_count, {weak: {strong: index}})."""
+    if len(signature) < SIGNATURE_HEADER.size:
+        raise ValueError("Delta signature is truncated")
+    block_size, count = SIGNATURE_HEADER.unpack_from(signature)
+    if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise ValueError(f"Unsupported delta block size: {block_size}")
+    if len(signature) != SIGNATURE_HEADER.size + count * BLOCK_SIGNATURE.size:
+        raise ValueError("Delta signature length does not match its block count")
+    table = {}
+    for index, (weak, strong) in enumerate(
+        BLOCK_SIGNATURE.iter_unpack(signature[SIGNATURE_HEADER.size :])
+    ):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return block_size, count, table
+
+
+def delta_ops(path, block_size, table):
+    """Yield the operations that rebuild `path` from the receiver's basis.
+
+    Operations are ("data", bytes) for literal runs, ("copy", index, count)
+    for runs of basis blocks and finally ("digest", sha256 of the file).
+    Block-aligned matches are checked with zlib's adler32; only after a miss
+    does the checksum roll byte by byte until the data lines up again, and
+    only while enough of the file matches (see ROLL_LIMIT).
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = f.seek(0, 2)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            copy_start = copy_count = 0
+            literal = pos = 0
+            rolling = aligned = False
+            rolled = matched = 0
+            weak = a = b = 0
+            while table and pos + block_size <= size:
+                if not rolling:
+                    weak = zlib.adler32(data[pos : pos + block_size])
+                    a, b = weak & 0xFFFF, weak >> 16
+                candidates = table.get(weak)
+                if candidates:
+                    block = data[pos : pos + block_size]
+                    index = candidates.get(strong_hash(block))
+                    if index is not None:
+                        if literal < pos:
+                            if copy_count:
+                                yield "copy", copy_start, copy_count
+                                copy_count = 0
+                            digest.update(data[literal:pos])
+                            yield "data", data[literal:pos]
+                        if copy_count and index == copy_start + copy_count:
+                            copy_count += 1
+                        else:
+                            if copy_count:
+                                yield "copy", copy_start, copy_count
+                            copy_start, copy_count = index, 1
+                        digest.update(block)
+                        pos += block_size
+                        matched += block_size
+                        literal = pos
+                        rolling = False
+                        continue
+                if aligned:
+                    pos += block_size
+                else:
+                    if pos + block_size >= size:
+                        break
+                    old, new = data[pos], data[pos + block_size]
+                    a = (a - old + new) % ADLER_MOD
+                    b = (b - block_size * old + a - 1) % ADLER_MOD
+                    weak = b << 16 | a
+                    pos += 1
+                    rolling = True
+                    rolled += 1
+                    if rolled >= ROLL_LIMIT:
+                        rolled = 0
+                        if matched < MIN_MATCH_RATIO * pos:
+                            aligned = True
+                            rolling = False
+                if pos - literal >= LITERAL_SIZE:
+                    if copy_count:
+                        yield "copy", copy_start, copy_count
+                        copy_count = 0
+                    run = data[literal : literal + LITERAL_SIZE]
+                    digest.update(run)
+                    yield "data", run
+                    literal += LITERAL_SIZE
+            if copy_count:
+                yield "copy", copy_start, copy_count
+            for start in range(literal, size, LITERAL_SIZE):
+                chunk = data[start : min(start + LITERAL_SIZE, size)]
+                digest.update(chunk)
+                yield "data", chunk
+        finally:
+            if size:
+                data.close()
+    yield "digest", digest.digest()
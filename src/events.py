@@ -0,0 +1,51 @@
+import collections
+import threading
+
+# How often the UI thread drains the bus
+FRAME_RATE = 20
+FRAME_INTERVAL_MS = 1000 // FRAME_RATE
+# Status messages applied per frame; the rest wait for the next one
+MESSAGES_PER_FRAME = 200
+
+
+class EventBus:
+    """Hand progress, load and status updates from worker threads to the UI.
+
+    Workers never touch widgets. Values such as progress and load are
+    coalesced, so only the latest one per key is kept no matter how often
+    a transfer reports it; status messages are queued in order. The UI
+    thread calls `drain` once per frame (see FRAME_RATE) and applies what
+    it gets.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._messages = collections.deque()
+
+    def publish(self, key, value):
+        """Set the latest value for `key`, replacing one not yet drained."""
+        with self._lock:
+            self._latest[key] = value
+
+    def post(self, channel, message):
+        """Queue a status message for `channel`."""
+        with self._lock:
+            self._messages.append((channel, message))
+
+    def progress_callback(self, channel):
+        return lambda percent: self.publish((channel, "progress"), percent)
+
+    def status_callback(self, channel):
+        return lambda message: self.post(channel, message)
+
+    def value_callback(self, key):
+        return lambda value: self.publish(key, value)
+
+    def drain(self, limit=MESSAGES_PER_FRAME):
+        """Return ({key: latest value}, [(channel, message), ...]) and reset."""
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            count = min(limit, len(self._messages))
+            messages = [self._messages.popleft() for _ in range(count)]
+        return latest, messages
@@ -2,7 +2,14 @@ from tkinter import filedialog, messagebox
 import customtkinter as ctk
 import threading
 import transfer
+import events
+import history
+import metrics
 import queue
+import scheduler
+
+# Finished sends listed below the queue in the Send tab
+QUEUE_FINISHED_SHOWN = 10
 
 
 class PlaceholderEntry(ctk.CTkEntry):
@@ -51,15 +58,26 @@ class LANCryptorApp(ctk.CTk):
         except Exception as e:
             print(f"Failed to load window icon: {e}")
 
-        self.geometry("600x400")
+        self.geometry("600x640")
         self.receiver_running = False
-        self.history = []
         self.confirmation_queue = transfer.confirmation_queue
-        self.confirmation_event = transfer.confirmation_event
-        self.confirmation_result = transfer.confirmation_result
+        # Worker threads report through the bus; only _pump_events touches widgets
+        self.events = events.EventBus()
+        self.history = history.FileTransferHistory()
+        metrics.subscribe(self.history.record)
+        metrics.subscribe(lambda record: self.events.publish("history", True))
+        # Sends are queued and run by the scheduler, a few at a time
+        self.scheduler = scheduler.SendScheduler(
+            on_change=lambda: self.events.publish("queue", True),
+            status_callback=lambda job_id, msg: self.events.post(
+                "send", f"#{job_id}: {msg}"
+            ),
+        )
+        self.queue_layout = None
 
         self._build_ui()
         self._poll_confirmation()
+        self._pump_events()
 
     def _build_ui(self):
         self.tab_control = ctk.CTkTabview(self)
@@ -91,10 +109,20 @@ class LANCryptorApp(ctk.CTk):
         self.entry_ip = PlaceholderEntry(frame, placeholder="Receiver IP", width=400)
         self.entry_ip.pack(pady=10, padx=10)
 
+        send_row = ctk.CTkFrame(frame, fg_color="transparent")
+        send_row.pack(pady=10)
+        self.priority_var = ctk.StringVar(value="normal")
+        self.priority_menu = ctk.CTkOptionMenu(
+            send_row,
+            values=list(scheduler.PRIORITIES),
+            variable=self.priority_var,
+            width=100,
+        )
+        self.priority_menu.pack(side="left", padx=5)
         self.send_button = ctk.CTkButton(
-            frame, text="Send File", command=self.send_file_thread
+            send_row, text="Send File", command=self.send_file_thread
         )
-        self.send_button.pack(pady=10)
+        self.send_button.pack(side="left", padx=5)
 
         self.send_progress = ctk.CTkProgressBar(frame, width=400)
         self.send_progress.pack(pady=10)
@@ -103,6 +131,11 @@ class LANCryptorApp(ctk.CTk):
         self.send_status = ctk.CTkLabel(frame, text="")
         self.send_status.pack()
 
+        self.queue_frame = ctk.CTkScrollableFrame(frame, label_text="Queue")
+        self.queue_frame.pack(expand=True, fill="both", padx=10, pady=10)
+        self._refresh_queue()
+        self.scheduler.start()
+
     def _build_receive_tab(self):
         frame = ctk.CTkFrame(self.receive_tab)
         frame.pack(expand=True, fill="both", padx=10, pady=10)
@@ -114,6 +147,9 @@ class LANCryptorApp(ctk.CTk):
         self.recv_progress.pack(pady=10)
         self.recv_progress.set(0)
 
+        self.recv_load = ctk.CTkLabel(frame, text="")
+        self.recv_load.pack()
+
         self.start_receiver_button = ctk.CTkButton(
             frame, text="Start Receiver", command=self.start_receiver_thread
         )
@@ -131,9 +167,20 @@ class LANCryptorApp(ctk.CTk):
         frame = ctk.CTkFrame(self.history_tab)
         frame.pack(expand=True, fill="both", padx=10, pady=10)
 
-        self.history_text = ctk.CTkTextbox(frame, wrap="word")
+        self.history_search = PlaceholderEntry(
+            frame, placeholder="Search address or file name", width=400
+        )
+        self.history_search.pack(pady=(10, 0), padx=10)
+        self.history_search.bind("<Return>", lambda event: self._reload_history())
+
+        self.history_text = ctk.CTkTextbox(frame, wrap="none")
         self.history_text.pack(expand=True, fill="both", padx=10, pady=10)
-        self._update_history_display()
+
+        self.history_more_button = ctk.CTkButton(
+            frame, text="Load older", command=self._load_older_history
+        )
+        self.history_more_button.pack(pady=(0, 10))
+        self._reload_history()
 
     def browse_file(self):
         file_path = filedialog.askopenfilename()
@@ -141,17 +188,58 @@ class LANCryptorApp(ctk.CTk):
             self.file_path_var.set(file_path)
 
     def send_file_thread(self):
+        """Queue the selected file; the scheduler sends it when a slot is free."""
         filepath = self.file_path_var.get()
         ip = self.entry_ip.get().strip()
         if not filepath or not ip or ip == "Receiver IP":
             self._update_send_status("Please provide file and IP.")
             return
-        self._update_send_status("Sending...")
-        threading.Thread(
-            target=transfer.send_file,
-            args=(ip, filepath, self._update_send_progress, self._update_send_status),
-            daemon=True,
-        ).start()
+        ips = [address.strip() for address in ip.split(",") if address.strip()]
+        try:
+            job_id = self.scheduler.add(
+                list(dict.fromkeys(ips)), [filepath], self.priority_var.get()
+            )
+        except ValueError as e:
+            self._update_send_status(str(e))
+            return
+        self._update_send_status(f"#{job_id}: Queued")
+
+    def _refresh_queue(self):
+        """Show the scheduler's jobs; rows are only rebuilt when they change."""
+        jobs = self.scheduler.jobs(finished=QUEUE_FINISHED_SHOWN)
+        layout = [(job["id"], job["state"]) for job in jobs]
+        if layout != self.queue_layout:
+            self.queue_layout = layout
+            for child in self.queue_frame.winfo_children():
+                child.destroy()
+            self.queue_labels = {}
+            for job in jobs:
+                self._add_queue_row(job)
+        for job in jobs:
+            self.queue_labels[job["id"]].configure(text=scheduler.describe(job))
+
+        running = [job["progress"] for job in jobs if job["progress"] is not None]
+        if running:
+            self._update_send_progress(sum(running) / len(running))
+
+    def _add_queue_row(self, job):
+        row = ctk.CTkFrame(self.queue_frame, fg_color="transparent")
+        row.pack(fill="x", pady=1)
+        label = ctk.CTkLabel(row, text="", anchor="w")
+        label.pack(side="left", fill="x", expand=True)
+        self.queue_labels[job["id"]] = label
+        buttons = []
+        if job["state"] == scheduler.QUEUED:
+            buttons += [
+                ("↑", lambda: self.scheduler.move(job["id"], -1)),
+                ("↓", lambda: self.scheduler.move(job["id"], 1)),
+            ]
+        if job["state"] in (scheduler.QUEUED, scheduler.RUNNING):
+            buttons.append(("✕", lambda: self.scheduler.cancel(job["id"])))
+        for text, command in reversed(buttons):
+            ctk.CTkButton(row, text=text, width=28, command=command).pack(
+                side="right", padx=1
+            )
 
     def stop_receive(self):
         if self.receive_thread and self.receive_thread.is_alive():
@@ -160,12 +248,10 @@ class LANCryptorApp(ctk.CTk):
             self.receiver_running = False
 
     def _update_send_progress(self, percent):
-        self.send_progress.set(percent)
+        self.send_progress.set(percent / 100)
 
     def _update_send_status(self, msg):
         self.send_status.configure(text=msg)
-        self.history.append(f"SEND: {msg}")
-        self._update_history_display()
 
     def start_receiver_thread(self):
         if self.receiver_running:
@@ -177,43 +263,145 @@ class LANCryptorApp(ctk.CTk):
         self.receive_thread = threading.Thread(
             target=transfer.receiver_thread,
             args=(
-                self._update_recv_status,
-                self._update_recv_progress,
+                self.events.status_callback("recv"),
+                self.events.progress_callback("recv"),
                 self.stop_event,
             ),
-            kwargs={"cli": False},
+            kwargs={"cli": False, "load_callback": self.events.value_callback("load")},
             daemon=True,
         )
         self.receive_thread.start()
 
     def _update_recv_status(self, msg):
         self.receive_status.configure(text=msg)
-        self.history.append(f"RECV: {msg}")
-        self._update_history_display()
 
     def _update_recv_progress(self, percent):
-        self.recv_progress.set(percent)
+        self.recv_progress.set(percent / 100)
+
+    def _update_recv_load(self, load):
+        import receiver
+
+        self.recv_load.configure(text=f"Load: {receiver.describe_load(load)}")
+
+    def _history_filter(self):
+        search = self.history_search.get().strip()
+        return None if search == self.history_search.placeholder else search or None
 
-    def _update_history_display(self):
+    def _show_history(self, records, index):
+        text = "".join(history.describe(record) + "\n" for record in records)
+        self.history_text.insert(index, text)
+
+    def _reload_history(self):
+        """Show the newest page of records matching the search box."""
+        records = self.history.page(search=self._history_filter())
         self.history_text.delete("1.0", "end")
-        self.history_text.insert("end", "\n".join(self.history))
-        self.history_text.see("end")
+        self._show_history(records, "end")
+        self.history_newest = records[0]["id"] if records else 0
+        self.history_oldest = records[-1]["id"] if records else None
+        self.history_more_button.configure(
+            state="normal" if len(records) == history.PAGE_SIZE else "disabled"
+        )
+
+    def _load_older_history(self):
+        if self.history_oldest is None:
+            return
+        records = self.history.page(
+            before=self.history_oldest, search=self._history_filter()
+        )
+        self._show_history(records, "end")
+        if records:
+            self.history_oldest = records[-1]["id"]
+        if len(records) < history.PAGE_SIZE:
+            self.history_more_button.configure(state="disabled")
+
+    def _show_new_history(self):
+        records = self.history.page(
+            after=self.history_newest, search=self._history_filter()
+        )
+        if len(records) == history.PAGE_SIZE:
+            # Too many arrived at once to leave no gap; start over
+            self._reload_history()
+            return
+        if records:
+            self._show_history(records, "1.0")
+            self.history_newest = records[0]["id"]
+            if self.history_oldest is None:
+                self.history_oldest = records[-1]["id"]
+
+    def _pump_events(self):
+        """Apply what worker threads reported since the last frame."""
+        latest, messages = self.events.drain()
+        for key, value in latest.items():
+            if key == "queue":
+                self._refresh_queue()
+            elif key == ("recv", "progress"):
+                self._update_recv_progress(value)
+            elif key == "load":
+                self._update_recv_load(value)
+            elif key == "history":
+                self._show_new_history()
+
+        # Labels only need the newest message of each channel
+        newest = dict(messages)
+        if "send" in newest:
+            self._update_send_status(newest["send"])
+        if "recv" in newest:
+            self._update_recv_status(newest["recv"])
+        self.after(events.FRAME_INTERVAL_MS, self._pump_events)
 
     def _poll_confirmation(self):
         try:
-            pubkey_hash = transfer.confirmation_queue.get_nowait()
+            request = transfer.confirmation_queue.get_nowait()
         except queue.Empty:
-            pubkey_hash = None
-
-        if pubkey_hash:
-            answer = messagebox.askyesno(
-                "Confirm sender public key",
-                f"Incoming connection with public key hash:\n\n{pubkey_hash}\n\nAccept?",
-            )
-            transfer.confirmation_result = answer
-            transfer.confirmation_event.set()
+            request = None
+
+        if request:
+            if request.trustable:
+                answer = self._ask_trust(request)
+            else:
+                answer = messagebox.askyesno(
+                    "Confirm public key",
+                    f"Incoming connection from {request.address} with public key hash:\n\n{request.pubkey_hash}\n\nAccept?",
+                )
+            # Each request carries its own future, so the answer reaches the
+            # connection that asked even when several are waiting
+            request.resolve(answer)
         self.after(100, self._poll_confirmation)
 
+    def _ask_trust(self, request):
+        """Ask about a sender's key: reject, accept once or always trust it."""
+        answer = [transfer.REJECT]
+        dialog = ctk.CTkToplevel(self)
+        dialog.title("Confirm sender public key")
+        dialog.resizable(False, False)
+        ctk.CTkLabel(
+            dialog,
+            text=f"Incoming connection from {request.address} with public key hash:"
+            f"\n\n{request.pubkey_hash}\n\nCompare it with the hash the sender shows.",
+            wraplength=460,
+            justify="left",
+        ).pack(padx=20, pady=(20, 10))
+        buttons = ctk.CTkFrame(dialog, fg_color="transparent")
+        buttons.pack(padx=20, pady=(0, 20))
+
+        def choose(value):
+            answer[0] = value
+            dialog.destroy()
+
+        for text, value in (
+            ("Accept once", transfer.ACCEPT_ONCE),
+            ("Always trust this sender", transfer.ACCEPT_ALWAYS),
+            ("Reject", transfer.REJECT),
+        ):
+            ctk.CTkButton(
+                buttons, text=text, command=lambda value=value: choose(value)
+            ).pack(side="left", padx=5)
+        dialog.protocol("WM_DELETE_WINDOW", dialog.destroy)
+        dialog.transient(self)
+        dialog.grab_set()
+        self.wait_window(dialog)
+        return answer[0]
+
 
 if __name__ == "__main__":
     app = LANCryptorApp()
@@ -1,16 +1,203 @@
 import logging
-from datetime import datetime
+import sqlite3
+import threading
+import time
+
+# SQLite database of finished transfers
+HISTORY_DB = "transfer_history.db"
+# Records older than this many days are deleted; None keeps them forever
+RETENTION_DAYS = 365
+# At most this many records are kept, oldest deleted first
+MAX_RECORDS = 1_000_000
+# Retention is applied on open and then after every PRUNE_INTERVAL records
+PRUNE_INTERVAL = 1000
+# Records returned per page by default
+PAGE_SIZE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    direction TEXT NOT NULL,
+    peer TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    throughput REAL NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfers_time ON transfers (time);
+CREATE INDEX IF NOT EXISTS transfers_peer ON transfers (peer);
+"""
+
+
+_store = None
+_store_lock = threading.Lock()
 
 
 class FileTransferHistory:
-    def __init__(self):
-        self.transfers = []
-        logging.basicConfig(filename="transfer_history.log", level=logging.INFO)
+    """Persistent, indexed history of finished transfers.
+
+    Pass `record` to `metrics.subscribe` to store every transfer. Pages are
+    read newest first by id, so showing the latest records (or those of
+    one peer) costs the same with a hundred rows or a million. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or HISTORY_DB
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._since_prune = 0
+        self.prune()
+
+    def record(self, record):
+        """Store a finished transfer as published by `metrics`."""
+        started = time.mktime(time.strptime(record["time"], "%Y-%m-%dT%H:%M:%S"))
+        self.add_transfer(
+            record["name"],
+            "ok" if record["ok"] else "failed",
+            direction=record["direction"],
+            peer=record["peer"],
+            fingerprint=record.get("fingerprint", ""),
+            size=record["bytes"],
+            duration=record["seconds"],
+            throughput=record["bytes_per_second"],
+            started=started,
+        )
+
+    def add_transfer(
+        self,
+        file_name,
+        status,
+        direction="",
+        peer="",
+        fingerprint="",
+        size=0,
+        duration=0.0,
+        throughput=0.0,
+        started=None,
+    ):
+        row = (
+            started or time.time(),
+            direction,
+            peer,
+            fingerprint or "",
+            file_name,
+            size,
+            duration,
+            throughput,
+            status,
+        )
+        with self._lock:
+            try:
+                with self._db:
+                    self._db.execute(
+                        "INSERT INTO transfers (time, direction, peer, fingerprint,"
+                        " file, size, duration, throughput, result)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        row,
+                    )
+            except sqlite3.Error:
+                logging.exception(f"Could not write {self.path}")
+                return
+            self._since_prune += 1
+            prune = self._since_prune >= PRUNE_INTERVAL
+        if prune:
+            self.prune()
+
+    def page(self, before=None, after=None, peer=None, search=None, limit=PAGE_SIZE):
+        """Return up to `limit` records as dicts, newest first.
+
+        `before` / `after` are record ids to page from. `peer` matches an
+        address exactly (and uses its index); `search` matches an address
+        or any part of a file name.
+        """
+        clauses, params = [], []
+        if before is not None:
+            clauses.append("id < ?")
+            params.append(before)
+        if after is not None:
+            clauses.append("id > ?")
+            params.append(after)
+        if peer:
+            clauses.append("peer = ?")
+            params.append(peer)
+        if search:
+            clauses.append("(peer = ? OR file LIKE ? ESCAPE '\\')")
+            escaped = search.replace("\\", "\\\\")
+            escaped = escaped.replace("%", "\\%").replace("_", "\\_")
+            params += [search, f"%{escaped}%"]
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        query = f"SELECT * FROM transfers {where} ORDER BY id DESC LIMIT ?"
+        with self._lock:
+            rows = self._db.execute(query, (*params, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM transfers").fetchone()[0]
+
+    def prune(self):
+        """Apply RETENTION_DAYS and MAX_RECORDS; return the records deleted."""
+        deleted = 0
+        with self._lock:
+            self._since_prune = 0
+            try:
+                with self._db:
+                    if RETENTION_DAYS is not None:
+                        cutoff = time.time() - RETENTION_DAYS * 86400
+                        deleted += self._db.execute(
+                            "DELETE FROM transfers WHERE time < ?", (cutoff,)
+                        ).rowcount
+                    if MAX_RECORDS is not None:
+                        deleted += self._db.execute(
+                            "DELETE FROM transfers WHERE id <= (SELECT id FROM"
+                            " transfers ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                            (MAX_RECORDS,),
+                        ).rowcount
+            except sqlite3.Error:
+                logging.exception(f"Could not prune {self.path}")
+        if deleted:
+            logging.info(f"Removed {deleted} old records from {self.path}")
+        return deleted
+
+    def get_history(self, limit=PAGE_SIZE):
+        """Return the latest `limit` records as text, newest first."""
+        return "\n".join(describe(record) for record in self.page(limit=limit))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def record(record):
+    """Store `record` in HISTORY_DB, opening the database on first use.
+
+    Meant for `metrics.subscribe` in short-lived processes: nothing is
+    opened (or pruned) until the first transfer has finished.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FileTransferHistory()
+    _store.record(record)
 
-    def add_transfer(self, file_name, status):
-        transfer_record = f"{datetime.now()}: {file_name} - {status}"
-        self.transfers.append(transfer_record)
-        logging.info(transfer_record)
 
-    def get_history(self):
-        return "\n".join(self.transfers)
+def describe(record):
+    """One line per record, as shown in the History tab and by the CLI."""
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"]))
+    direction = {"send": "SEND", "receive": "RECV"}.get(record["direction"], "-")
+    size = record["size"] / (1024 * 1024)
+    rate = record["throughput"] / (1024 * 1024)
+    fingerprint = record["fingerprint"][:16] or "-"
+    return (
+        f"{when}  {direction}  {record['result']:6}  {record['peer'] or '-'}  "
+        f"{fingerprint}  {record['file']}  {size:.1f} MB  "
+        f"{record['duration']:.1f}s  {rate:.1f} MB/s"
+    )
@@ -1,10 +1,26 @@
 import argparse
+import logging
 import threading
 import time
+import struct
 import sys
-from gui import LANCryptorApp
-import transfer
 import platform
+import os
+
+# Everything else is imported by the mode that needs it, so CLI runs don't
+# pay for the GUI toolkit, the tray or modules they never use
+from compression import MODES
+
+# Log of every mode, GUI included (which has no console under pythonw)
+LOG_FILE = "transfer_history.log"
+
+
+def setup_logging():
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(threadName)s: %(message)s",
+    )
 
 
 def log_platform_info():
@@ -17,7 +33,8 @@ def log_platform_info():
 
     system = platform.system()
     release = platform.release()
-    arch = platform.architecture()[0]
+    # Same as platform.architecture() for this interpreter, without running `file`
+    arch = f"{struct.calcsize('P') * 8}bit"
     machine = platform.machine()
     friendly_arch = arch_map.get(machine, machine)
     python_version = sys.version.split()[0]
@@ -36,33 +53,224 @@ def log_platform_info():
         distro_str = system
 
 
+def start_tray():
+    import transfer
+
+    tray_thread = threading.Thread(target=transfer.start_tray_icon, daemon=True)
+    tray_thread.start()
+
+
 def run_gui():
+    from gui import LANCryptorApp
+    import transfer
+
+    transfer.NOTIFICATIONS = True
+    start_tray()
     app = LANCryptorApp()
     app.mainloop()
 
 
-def run_cli_send(ip, file):
+def run_cli_send(
+    ips, files, dirs=(), streams=1, compression="auto", delta=False, dedup=False
+):
+    import history
+    import metrics
+    import transfer
+
     def progress(p):
         print(f"[SEND] Progress: {p:.2f}%")
 
     def status(msg):
         print(f"[SEND] {msg}")
 
-    transfer.send_file(ip, file, progress_callback=progress, status_callback=status)
+    metrics.subscribe(history.record)
+    metrics.subscribe(
+        lambda record: print(f"[SEND] Timings: {metrics.describe(record)}")
+    )
+
+    paths = list(files) + list(dirs)
+    if len(ips) > 1:
+        run_cli_fanout(ips, paths[0], compression)
+        return
+
+    # Several files or any directory go out as one batch session
+    ip = ips[0]
+    if len(paths) > 1 or dirs:
+        transfer.send_files(
+            ip,
+            paths,
+            progress_callback=progress,
+            status_callback=status,
+            compression=compression,
+        )
+        return
+
+    transfer.send_file(
+        ip,
+        paths[0],
+        progress_callback=progress,
+        status_callback=status,
+        streams=streams,
+        compression=compression,
+        delta=delta,
+        dedup=dedup,
+    )
+
+
+def run_cli_fanout(ips, path, compression):
+    import transfer
+
+    # One line per receiver for every 10%, not per chunk
+    shown = {}
+
+    def progress(ip, p):
+        step = int(p // 10) * 10
+        if shown.get(ip) != step:
+            shown[ip] = step
+            print(f"[SEND] {ip}: Progress: {step}%")
+
+    def status(ip, msg):
+        print(f"[SEND] {ip}: {msg}")
+
+    results = transfer.send_file_fanout(
+        ips,
+        path,
+        progress_callback=progress,
+        status_callback=status,
+        compression=compression,
+    )
+    failed = [ip for ip, ok in results.items() if not ok]
+    print(f"[SEND] Sent to {len(ips) - len(failed)} of {len(ips)} receivers")
+    if failed:
+        print(f"[SEND] Failed: {', '.join(failed)}")
+
+
+def run_cli_enqueue(ips, paths, priority, streams, compression, delta, dedup):
+    import scheduler
+
+    queue = scheduler.SendScheduler()
+    try:
+        job_id = queue.add(ips, paths, priority, streams, compression, delta, dedup)
+    except ValueError as e:
+        print(f"[QUEUE] {e}")
+        return
+    finally:
+        queue.close()
+    print(f"[QUEUE] Queued job #{job_id}; run it with `main.py queue run`")
+
+
+def run_cli_queue(args):
+    import scheduler
+
+    if args.queue_action == "run":
+        run_cli_queue_worker(args.max_concurrent, args.limit)
+        return
+
+    queue = scheduler.SendScheduler()
+    try:
+        if args.queue_action == "list":
+            jobs = queue.jobs()
+            if not jobs:
+                print("[QUEUE] No sends queued.")
+            for job in jobs:
+                print(scheduler.describe(job))
+        elif args.queue_action == "cancel":
+            if not queue.cancel(args.job):
+                print(f"[QUEUE] Job #{args.job} is neither queued nor running")
+        elif args.queue_action == "move":
+            steps = {"up": -1, "down": 1, "top": -(1 << 30), "bottom": 1 << 30}
+            if not queue.move(args.job, steps[args.where]):
+                print(f"[QUEUE] Job #{args.job} was not moved")
+        elif args.queue_action == "priority":
+            queue.set_priority(args.job, args.level)
+        elif args.queue_action == "clear":
+            print(f"[QUEUE] Removed {queue.clear_finished()} finished jobs")
+    finally:
+        queue.close()
+
+
+def run_cli_queue_worker(max_concurrent=None, limit=None):
+    import history
+    import metrics
+    import scheduler
 
+    # One line per job for every 10%, not per chunk
+    shown = {}
+
+    def progress(job_id, p):
+        step = int(p // 10) * 10
+        if shown.get(job_id) != step:
+            shown[job_id] = step
+            print(f"[QUEUE] #{job_id}: Progress: {step}%")
+
+    def status(job_id, msg):
+        print(f"[QUEUE] #{job_id}: {msg}")
+
+    metrics.subscribe(history.record)
+    if limit:
+        scheduler.set_rate_limit(limit * 1024 * 1024)
+    queue = scheduler.SendScheduler(
+        max_concurrent=max_concurrent or scheduler.MAX_CONCURRENT,
+        status_callback=status,
+        progress_callback=progress,
+    )
+    queue.start()
+    try:
+        print("[QUEUE] Sending until the queue is empty, Ctrl+C to stop...")
+        while not queue.idle():
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("[QUEUE] Stopping; unfinished jobs stay queued")
+    finally:
+        queue.close()
+
+
+def run_cli_receive(
+    max_transfers=None,
+    max_per_ip=None,
+    max_inflight=None,
+    metrics_port=None,
+    durability=None,
+):
+    import history
+    import metrics
+    import receiver
+    import storage
+    import transfer
+
+    if durability:
+        storage.DURABILITY = durability
 
-def run_cli_receive():
     def progress(p):
         print(f"[RECV] Progress: {p:.2f}%")
 
     def status(msg):
         print(f"[RECV] {msg}")
 
+    def load(info):
+        print(f"[RECV] Load: {receiver.describe_load(info)}")
+
+    metrics.subscribe(history.record)
+    metrics.subscribe(
+        lambda record: print(f"[RECV] Timings: {metrics.describe(record)}")
+    )
+    if metrics_port:
+        metrics.serve_prometheus(metrics_port)
+        print(f"[RECV] Metrics at http://127.0.0.1:{metrics_port}/metrics")
+
+    limits = receiver.AdmissionLimits()
+    if max_transfers:
+        limits = limits._replace(transfers=max_transfers)
+    if max_per_ip:
+        limits = limits._replace(per_ip=max_per_ip)
+    if max_inflight:
+        limits = limits._replace(inflight_bytes=max_inflight * 1024 * 1024)
+
     stop_event = threading.Event()
     t = threading.Thread(
         target=transfer.receiver_thread,
         args=(status, progress, stop_event),
-        kwargs={"cli": True},
+        kwargs={"cli": True, "limits": limits, "load_callback": load},
         daemon=True,
     )
     t.start()
@@ -76,30 +284,276 @@ def run_cli_receive():
         print("[RECV] Stopping receiver...")
 
 
+def run_cli_peers(action, fingerprint=None):
+    import peers
+
+    if action == "list":
+        trusted = peers.list_peers()
+        if not trusted:
+            print("[PEERS] No trusted peers.")
+        for fp, info in trusted.items():
+            last_seen = time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(info.get("last_seen", 0))
+            )
+            print(f"{fp}  {info.get('address', '?'):15}  last seen {last_seen}")
+    elif action == "revoke":
+        try:
+            revoked = peers.revoke_peer(fingerprint)
+        except ValueError as e:
+            print(f"[PEERS] {e}")
+            return
+        if revoked:
+            print(f"[PEERS] Revoked {revoked}")
+        else:
+            print(f"[PEERS] No peer matches {fingerprint}")
+    elif action == "fingerprint":
+        import transfer
+
+        print(f"Identity key:  {transfer.own_fingerprint(transfer.PROTOCOL_VERSION)}")
+        if os.path.exists(transfer.KEY_FILE_PUBLIC):
+            print(f"RSA key (peers before protocol 4):  {transfer.own_fingerprint(3)}")
+
+
+def run_cli_history(peer=None, search=None, limit=None):
+    import history
+
+    store = history.FileTransferHistory()
+    records = store.page(peer=peer, search=search, limit=limit or history.PAGE_SIZE)
+    if not records:
+        print("[HISTORY] No transfers recorded.")
+    for record in reversed(records):
+        print(history.describe(record))
+    store.close()
+
+
 if __name__ == "__main__":
+    setup_logging()
     log_platform_info()
     print(
         f"[Platform] OS: {system} {release} ({distro_str}) | Arch: {arch}| Python: {python_version}"
     )
-    tray_thread = threading.Thread(target=transfer.start_tray_icon, daemon=True)
-    tray_thread.start()
 
     parser = argparse.ArgumentParser(description="LANCryptor - LAN File Transfer Tool")
     subparsers = parser.add_subparsers(dest="mode", help="Modes")
 
+    # The GUI always has both; CLI transfers only when asked
+    desktop = argparse.ArgumentParser(add_help=False)
+    desktop.add_argument("--tray", action="store_true", help="Show the tray icon")
+    desktop.add_argument(
+        "--notify", action="store_true", help="Show desktop notifications"
+    )
     subparsers.add_parser("gui", help="Launch graphical interface")
 
-    send_parser = subparsers.add_parser("send", help="Send a file over the network")
-    send_parser.add_argument("--ip", required=True, help="IP address of receiver")
-    send_parser.add_argument("--file", required=True, help="File path to send")
+    send_parser = subparsers.add_parser(
+        "send", parents=[desktop], help="Send a file over the network"
+    )
+    send_parser.add_argument(
+        "--ip",
+        required=True,
+        help="IP address of receiver, or several separated by commas",
+    )
+    send_parser.add_argument(
+        "--file",
+        action="append",
+        default=[],
+        help="File path to send (repeat to send several in one session)",
+    )
+    send_parser.add_argument(
+        "--dir",
+        action="append",
+        default=[],
+        help="Directory to send with everything below it",
+    )
+    send_parser.add_argument(
+        "--streams",
+        type=int,
+        default=1,
+        help="Parallel connections for large files (1-16)",
+    )
+    send_parser.add_argument(
+        "--compress",
+        choices=MODES,
+        default="auto",
+        help="Compression: auto picks per chunk, none stores, fast/max force a level",
+    )
+    send_parser.add_argument(
+        "--limit",
+        type=float,
+        metavar="MB/s",
+        help="Limit the send to this many MB per second",
+    )
+    send_parser.add_argument(
+        "--queue",
+        action="store_true",
+        help="Add the send to the queue (see `queue run`) instead of sending now",
+    )
+    send_parser.add_argument(
+        "--priority",
+        choices=("high", "normal", "low"),
+        default="normal",
+        help="Position among queued sends (with --queue)",
+    )
+    reuse = send_parser.add_mutually_exclusive_group()
+    reuse.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only send blocks that differ from the receiver's existing copy",
+    )
+    reuse.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Skip chunks the receiver already stored from earlier transfers",
+    )
+
+    receive_parser = subparsers.add_parser(
+        "receive", parents=[desktop], help="Receive files over the network"
+    )
+    receive_parser.add_argument(
+        "--max-transfers", type=int, help="Transfers running at once (default 8)"
+    )
+    receive_parser.add_argument(
+        "--max-per-ip",
+        type=int,
+        help="Transfers running at once from one address (default 4)",
+    )
+    receive_parser.add_argument(
+        "--max-inflight",
+        type=int,
+        metavar="MB",
+        help="Total size of running transfers; more are queued (default 8192)",
+    )
+    receive_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this local port",
+    )
+    receive_parser.add_argument(
+        "--durability",
+        choices=("none", "file", "full"),
+        help="What is flushed to disk before a file is reported received"
+        " (default file)",
+    )
+
+    peers_parser = subparsers.add_parser("peers", help="Manage trusted peers")
+    peers_actions = peers_parser.add_subparsers(dest="peers_action", required=True)
+    peers_actions.add_parser("list", help="List senders that skip confirmation")
+    peers_actions.add_parser(
+        "fingerprint",
+        help="Show this machine's key hashes, as a receiver's prompt shows them",
+    )
+    revoke_parser = peers_actions.add_parser(
+        "revoke", help="Forget a peer and invalidate its session tickets"
+    )
+    revoke_parser.add_argument("fingerprint", help="Fingerprint or unique prefix")
 
-    subparsers.add_parser("receive", help="Receive files over the network")
+    queue_parser = subparsers.add_parser("queue", help="Manage queued sends")
+    queue_actions = queue_parser.add_subparsers(dest="queue_action", required=True)
+    queue_actions.add_parser("list", help="Show queued, running and finished sends")
+    run_parser = queue_actions.add_parser(
+        "run", help="Send queued jobs by priority until the queue is empty"
+    )
+    run_parser.add_argument(
+        "--max-concurrent", type=int, help="Sends running at once (default 2)"
+    )
+    run_parser.add_argument(
+        "--limit",
+        type=float,
+        metavar="MB/s",
+        help="Limit all running sends together to this many MB per second",
+    )
+    cancel_parser = queue_actions.add_parser(
+        "cancel", help="Drop a queued send or stop a running one"
+    )
+    cancel_parser.add_argument("job", type=int)
+    move_parser = queue_actions.add_parser("move", help="Reorder a queued send")
+    move_parser.add_argument("job", type=int)
+    move_parser.add_argument("where", choices=("up", "down", "top", "bottom"))
+    priority_parser = queue_actions.add_parser(
+        "priority", help="Change the priority of a queued send"
+    )
+    priority_parser.add_argument("job", type=int)
+    priority_parser.add_argument("level", choices=("high", "normal", "low"))
+    queue_actions.add_parser("clear", help="Remove finished sends from the list")
+
+    history_parser = subparsers.add_parser("history", help="Show finished transfers")
+    history_parser.add_argument("--peer", help="Only transfers with this address")
+    history_parser.add_argument(
+        "--search", help="Match an address or part of a file name"
+    )
+    history_parser.add_argument(
+        "--limit",
+        type=int,
+        help="Newest transfers to show (default 200)",
+    )
 
     args = parser.parse_args()
 
-    if len(sys.argv) == 1 or args.mode == "gui":
+    if args.mode in ("send", "receive"):
+        if args.notify:
+            import transfer
+
+            transfer.NOTIFICATIONS = True
+        if args.tray:
+            start_tray()
+
+    if args.mode is None or args.mode == "gui":
         run_gui()
     elif args.mode == "send":
-        run_cli_send(args.ip, args.file)
+        if not args.file and not args.dir:
+            send_parser.error("at least one --file or --dir is required")
+        ips = list(dict.fromkeys(ip.strip() for ip in args.ip.split(",") if ip.strip()))
+        if not ips:
+            send_parser.error("--ip needs at least one address")
+        if len(ips) > 1 and (
+            args.dir or len(args.file) > 1 or args.delta or args.dedup
+        ):
+            send_parser.error(
+                "several receivers take a single --file without --delta/--dedup"
+            )
+        if len(ips) > 1 and args.streams > 1:
+            send_parser.error("several receivers are sent one stream each")
+        if (args.dir or len(args.file) > 1) and (
+            args.delta or args.dedup or args.streams > 1
+        ):
+            send_parser.error(
+                "several files or a --dir go out as one batch,"
+                " without --delta/--dedup/--streams"
+            )
+        if args.queue:
+            run_cli_enqueue(
+                ips,
+                args.file + args.dir,
+                args.priority,
+                args.streams,
+                args.compress,
+                args.delta,
+                args.dedup,
+            )
+        else:
+            if args.limit:
+                import scheduler
+
+                scheduler.set_rate_limit(args.limit * 1024 * 1024)
+            run_cli_send(
+                ips,
+                args.file,
+                args.dir,
+                args.streams,
+                args.compress,
+                args.delta,
+                args.dedup,
+            )
     elif args.mode == "receive":
-        run_cli_receive()
+        run_cli_receive(
+            args.max_transfers,
+            args.max_per_ip,
+            args.max_inflight,
+            args.metrics_port,
+            args.durability,
+        )
+    elif args.mode == "peers":
+        run_cli_peers(args.peers_action, getattr(args, "fingerprint", None))
+    elif args.mode == "queue":
+        run_cli_queue(args)
+    elif args.mode == "history":
+        run_cli_history(args.peer, args.search, args.limit)
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Every byte range of a transfer is split into leaves of LEAF_SIZE bytes.
+# The leaves are hashed independently, so they can be hashed in parallel
+# as soon as they are complete, and a mismatch names the exact leaves that
+# have to be sent again. Leaf and node hashes are domain-separated.
+LEAF_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def hash_pool():
+    """Shared worker pool for leaf hashing; hashlib releases the GIL."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=HASH_WORKERS, thread_name_prefix="lancryptor-hash"
+            )
+        return _pool
+
+
+def leaf_count(size):
+    return -(-size // LEAF_SIZE)
+
+
+def leaf_span(start, end, leaf):
+    """Bytes [first, last) of the file covered by `leaf` of range [start, end)."""
+    first = start + leaf * LEAF_SIZE
+    return first, min(first + LEAF_SIZE, end)
+
+
+def hash_leaf(*parts):
+    """Digest of the leaf made of `parts`, in order."""
+    digest = hashlib.sha256(LEAF_PREFIX)
+    for part in parts:
+        digest.update(part)
+    return digest.digest()
+
+
+def hash_node(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def root(leaves):
+    """Merkle root over leaf digests; an odd node is carried up unchanged."""
+    level = list(leaves)
+    if not level:
+        return hashlib.sha256(NODE_PREFIX).digest()
+    while len(level) > 1:
+        level = [
+            hash_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+
+def mismatched(ours, theirs):
+    """Indices of the leaves whose digests differ (or exist on one side only)."""
+    bad = [i for i, (a, b) in enumerate(zip(ours, theirs)) if a != b]
+    return bad + list(range(min(len(ours), len(theirs)), max(len(ours), len(theirs))))
+
+
+class LeafHasher:
+    """Hash the leaves of bytes [start, end) of a file as they become final.
+
+    Leaves are hashed on the hash pool, in parallel with the transfer and
+    with each other. A receiver tells `advance` how much of the range is
+    complete on disk, and those leaves are read back from the file. A
+    sender passes the bytes it sends to `update`, so they are hashed from
+    memory. `known(first, last)` may return a future of the digest of
+    bytes [first, last), computed elsewhere. `digests` hashes what is left
+    and returns the digest of every leaf. Time and bytes are recorded in
+    `stats` under `stage`.
+    """
+
+    def __init__(self, path, start, end, stats=None, stage="hash", known=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.count = leaf_count(end - start)
+        self.stats = stats or metrics.NO_METRICS
+        self.stage = stage
+        self.known = known
+        self._futures = []
+        # Futures submitted here; known ones may be shared with other hashers
+        self._owned = []
+        self._next_end = leaf_span(start, end, 0)[1]
+        # Pieces of the next leaf passed to update, or None when the leaf
+        # has to be read back instead; _position is where they end
+        self._parts = None
+        self._position = None
+
+    def ready(self, position):
+        """True if bytes up to `position` complete a leaf not yet hashed."""
+        return len(self._futures) < self.count and position >= self._next_end
+
+    def advance(self, position):
+        """Start hashing every leaf that lies entirely below `position`."""
+        while self.ready(position):
+            self._submit(*leaf_span(self.start, self.end, len(self._futures)))
+
+    def update(self, position, size, data=None):
+        """Hash `size` bytes at `position` of the file from `data`.
+
+        Without `data` (bytes that were sent compressed) the leaf is read
+        back, unless `known` has its digest. So is any leaf that started
+        before the first call, or before a gap.
+        """
+        if position != self._position:
+            self.advance(position)
+            first = leaf_span(self.start, self.end, len(self._futures))[0]
+            self._parts = [] if position == first else None
+        self._position = position + size
+        view = memoryview(data) if data is not None else None
+        offset = 0
+        while offset < size and len(self._futures) < self.count:
+            first, last = leaf_span(self.start, self.end, len(self._futures))
+            taken = min(size - offset, last - position - offset)
+            if view is None:
+                self._parts = None
+            elif self._parts is not None:
+                self._parts.append(view[offset : offset + taken])
+            offset += taken
+            if position + offset == last:
+                self._submit(first, last, self._parts)
+                self._parts = []
+
+    def _submit(self, first, last, parts=None):
+        future = self.known(first, last) if self.known else None
+        if future is None:
+            if parts is not None:
+                future = hash_pool().submit(self._hash_parts, parts)
+            else:
+                future = hash_pool().submit(self._hash, first, last)
+            self._owned.append(future)
+        self._futures.append(future)
+        self._next_end = leaf_span(self.start, self.end, len(self._futures))[1]
+
+    def digests(self):
+        self.advance(self.end)
+        return [future.result() for future in self._futures]
+
+    def rehash(self, leaves):
+        """Hash `leaves` again (after they were rewritten); digests in order."""
+        futures = [
+            hash_pool().submit(self._hash, *leaf_span(self.start, self.end, leaf))
+            for leaf in leaves
+        ]
+        return [future.result() for future in futures]
+
+    def _hash(self, first, last):
+        started = time.perf_counter()
+        with open(self.path, "rb") as f:
+            f.seek(first)
+            data = f.read(last - first)
+        digest = hash_leaf(data)
+        self.stats.add(self.stage, time.perf_counter() - started, len(data))
+        return digest
+
+    def _hash_parts(self, parts):
+        started = time.perf_counter()
+        digest = hash_leaf(*parts)
+        size = sum(len(part) for part in parts)
+        self.stats.add(self.stage, time.perf_counter() - started, size)
+        return digest
+
+    def close(self):
+        for future in self._owned:
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,235 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+
+# One JSON object per finished transfer, written beside the application log
+# (main.LOG_FILE, transfer_history.log); set to None to stop writing the file
+METRICS_FILE = "transfer_metrics.jsonl"
+
+# Stages a transfer spends its time in, roughly in pipeline order
+STAGES = (
+    "keys",  # loading the identity key (or the RSA pair for older peers)
+    "handshake",  # hello and key exchange, including "confirm"
+    "confirm",  # waiting for the receiver's user to approve the key
+    "admission",  # waiting for a slot on a busy receiver
+    "read",  # reading source data (and matching blocks for deltas)
+    "hash",  # sender-side digests (protocol 2 ranges, dedup chunking)
+    "compress",
+    "encrypt",
+    "network",  # writing frames to, or reading frames from, the socket
+    "decrypt",  # includes AES-GCM tag verification
+    "decompress",
+    "verify",  # digest checks of ranges, chunks and delta results
+    "write",  # writing received data to disk
+)
+
+_listeners = []
+_lock = threading.Lock()
+_totals = {}
+
+
+class TransferMetrics:
+    """Seconds and bytes spent in each stage of one transfer.
+
+    Safe to update from several threads. Stages that run in parallel (the
+    crypto pool, extra streams) add up, so their seconds can exceed the
+    transfer's wall time. `finish` publishes the record exactly once.
+    """
+
+    def __init__(self, direction, name="", peer="", size=0):
+        self.direction = direction
+        self.name = name
+        self.peer = peer
+        self.size = size
+        # Key fingerprint of the other side, once the handshake has run
+        self.fingerprint = ""
+        # Socket and chunk parameters of each stream (see tuning.report)
+        self.transport = []
+        self.started = time.time()
+        self.stages = {}
+        self._clock = time.perf_counter()
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def add(self, stage, seconds, size=0):
+        with self._lock:
+            entry = self.stages.setdefault(stage, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += size
+
+    def add_transport(self, params):
+        with self._lock:
+            self.transport.append(params)
+
+    @contextlib.contextmanager
+    def stage(self, stage, size=0):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started, size)
+
+    def as_dict(self, ok):
+        seconds = time.perf_counter() - self._clock
+        with self._lock:
+            stages = {
+                stage: {"seconds": round(spent, 6), "bytes": size}
+                for stage, (spent, size) in sorted(
+                    self.stages.items(), key=lambda item: _stage_order(item[0])
+                )
+            }
+            transport = list(self.transport)
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "direction": self.direction,
+            "name": self.name,
+            "peer": self.peer,
+            "fingerprint": self.fingerprint,
+            "ok": ok,
+            "bytes": self.size,
+            "seconds": round(seconds, 6),
+            "bytes_per_second": round(self.size / seconds) if seconds else 0,
+            "stages": stages,
+            "transport": transport,
+        }
+
+    def finish(self, ok):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        publish(self.as_dict(bool(ok)))
+
+
+class _NoMetrics:
+    """Stand-in used when a caller does not collect metrics."""
+
+    def add(self, stage, seconds, size=0):
+        pass
+
+    def add_transport(self, params):
+        pass
+
+    def stage(self, stage, size=0):
+        return contextlib.nullcontext()
+
+    def finish(self, ok):
+        pass
+
+    def __setattr__(self, name, value):
+        # Details such as the peer fingerprint are dropped as well
+        pass
+
+
+NO_METRICS = _NoMetrics()
+
+
+def _stage_order(stage):
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+def subscribe(callback):
+    """Call `callback(record)` with the dict of every finished transfer."""
+    with _lock:
+        _listeners.append(callback)
+
+
+def unsubscribe(callback):
+    with _lock:
+        if callback in _listeners:
+            _listeners.remove(callback)
+
+
+def publish(record):
+    """Write a finished transfer's record and hand it to every subscriber."""
+    with _lock:
+        listeners = list(_listeners)
+        _count(record)
+        if METRICS_FILE:
+            try:
+                with open(METRICS_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError:
+                logging.exception(f"Could not write {METRICS_FILE}")
+    for callback in listeners:
+        try:
+            callback(record)
+        except Exception:
+            logging.exception("Metrics callback failed")
+
+
+def _count(record):
+    direction = record["direction"]
+    result = "ok" if record["ok"] else "failed"
+
+    def bump(name, labels, value):
+        key = (name, labels)
+        _totals[key] = _totals.get(key, 0) + value
+
+    bump("transfers_total", (("direction", direction), ("result", result)), 1)
+    bump("transfer_bytes_total", (("direction", direction),), record["bytes"])
+    bump("transfer_seconds_total", (("direction", direction),), record["seconds"])
+    for stage, entry in record["stages"].items():
+        labels = (("direction", direction), ("stage", stage))
+        bump("stage_seconds_total", labels, entry["seconds"])
+        bump("stage_bytes_total", labels, entry["bytes"])
+    if record["ok"]:
+        gauge = ("last_transfer_bytes_per_second", (("direction", direction),))
+        _totals[gauge] = record["bytes_per_second"]
+
+
+def describe(record):
+    """One-line summary of a record: throughput and where the time went."""
+    stages = sorted(
+        record["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True
+    )
+    spent = ", ".join(f"{stage} {entry['seconds']:.2f}s" for stage, entry in stages)
+    rate = record["bytes_per_second"] / (1024 * 1024)
+    return f"{record['name']}: {record['seconds']:.2f}s, {rate:.1f} MB/s ({spent})"
+
+
+def render_prometheus():
+    """Return the totals of all finished transfers in Prometheus text format."""
+    with _lock:
+        totals = dict(_totals)
+    lines = []
+    for name in sorted({name for name, _ in totals}):
+        kind = "gauge" if name.startswith("last_") else "counter"
+        lines.append(f"# TYPE lancryptor_{name} {kind}")
+        for (metric, labels), value in sorted(totals.items()):
+            if metric != name:
+                continue
+            label_text = ",".join(f'{key}="{text}"' for key, text in labels)
+            lines.append(f"lancryptor_{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(port, host="127.0.0.1"):
+    """Serve /metrics on a background thread and return the server."""
+    # Imported here so transfers that never serve metrics don't pay for it
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="lancryptor-metrics", daemon=True
+    ).start()
+    logging.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
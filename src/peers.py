@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import secrets
+import struct
+import threading
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Receiver side: senders that may skip the confirmation prompt
+TRUSTED_PEERS_FILE = "trusted_peers.json"
+# Receiver side: key that seals resumption tickets handed to senders
+TICKET_KEY_FILE = "ticket_key.bin"
+# Sender side: tickets received from each receiver, keyed by address
+SESSION_TICKETS_FILE = "session_tickets.json"
+TICKET_LIFETIME = 24 * 3600
+TICKET_AAD = b"LANCryptor ticket"
+SECRET_SIZE = 32
+FINGERPRINT_SIZE = 32
+
+_lock = threading.Lock()
+
+
+def _load(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning(f"Ignoring corrupt {path}")
+        return {}
+
+
+def _save(path, data):
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def list_peers():
+    """Return {fingerprint: info} for every trusted sender."""
+    with _lock:
+        return _load(TRUSTED_PEERS_FILE)
+
+
+def is_trusted(fingerprint):
+    with _lock:
+        return fingerprint in _load(TRUSTED_PEERS_FILE)
+
+
+def trust_peer(fingerprint, address):
+    """Remember a sender so later connections skip the confirmation prompt."""
+    now = int(time.time())
+    with _lock:
+        peers = _load(TRUSTED_PEERS_FILE)
+        peer = peers.setdefault(fingerprint, {"added": now})
+        peer["address"] = address
+        peer["last_seen"] = now
+        _save(TRUSTED_PEERS_FILE, peers)
+
+
+def touch_peer(fingerprint, address):
+    with _lock:
+        peers = _load(TRUSTED_PEERS_FILE)
+        if fingerprint in peers:
+            peers[fingerprint].update(address=address, last_seen=int(time.time()))
+            _save(TRUSTED_PEERS_FILE, peers)
+
+
+def revoke_peer(prefix):
+    """Forget the peer whose fingerprint starts with `prefix`.
+
+    Its outstanding tickets stop working as well, since tickets are only
+    honoured for trusted senders. Cached tickets for receivers with that
+    fingerprint are dropped. Returns the revoked fingerprint, or None.
+    """
+    prefix = prefix.lower()
+    with _lock:
+        peers = _load(TRUSTED_PEERS_FILE)
+        tickets = _load(SESSION_TICKETS_FILE)
+        known = set(peers) | {t["fingerprint"] for t in tickets.values()}
+        matches = [fp for fp in known if fp.startswith(prefix)]
+        if len(matches) > 1:
+            raise ValueError(f"Fingerprint prefix '{prefix}' is ambiguous")
+        if not matches:
+            return None
+        fingerprint = matches[0]
+        if peers.pop(fingerprint, None) is not None:
+            _save(TRUSTED_PEERS_FILE, peers)
+        kept = {a: t for a, t in tickets.items() if t["fingerprint"] != fingerprint}
+        if len(kept) != len(tickets):
+            _save(SESSION_TICKETS_FILE, kept)
+        return fingerprint
+
+
+def _ticket_key():
+    with _lock:
+        try:
+            with open(TICKET_KEY_FILE, "rb") as f:
+                key = f.read()
+            if len(key) == 32:
+                return key
+        except FileNotFoundError:
+            pass
+        key = AESGCM.generate_key(bit_length=256)
+        fd = os.open(TICKET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        return key
+
+
+def issue_ticket(secret, fingerprint):
+    """Seal a resumption secret for the sender with `fingerprint`.
+
+    The ticket is opaque to the sender; only this receiver can open it, so
+    no per-sender state has to be kept.
+    """
+    expires = int(time.time()) + TICKET_LIFETIME
+    plaintext = struct.pack("Q", expires) + secret + bytes.fromhex(fingerprint)
+    nonce = secrets.token_bytes(12)
+    return nonce + AESGCM(_ticket_key()).encrypt(nonce, plaintext, TICKET_AAD)
+
+
+def open_ticket(ticket):
+    """Return (secret, fingerprint) for a valid ticket of a trusted sender."""
+    try:
+        plaintext = AESGCM(_ticket_key()).decrypt(ticket[:12], ticket[12:], TICKET_AAD)
+    except (InvalidTag, ValueError):
+        # Forged, corrupted or truncated, or sealed under an older ticket key
+        return None
+    if len(plaintext) != 8 + SECRET_SIZE + FINGERPRINT_SIZE:
+        return None
+    expires = struct.unpack_from("Q", plaintext)[0]
+    fingerprint = plaintext[8 + SECRET_SIZE :].hex()
+    if expires < time.time() or not is_trusted(fingerprint):
+        return None
+    return plaintext[8 : 8 + SECRET_SIZE], fingerprint
+
+
+def save_ticket(address, ticket, secret, fingerprint):
+    with _lock:
+        tickets = _load(SESSION_TICKETS_FILE)
+        tickets[address] = {
+            "ticket": ticket.hex(),
+            "secret": secret.hex(),
+            "fingerprint": fingerprint,
+            "expires": int(time.time()) + TICKET_LIFETIME,
+        }
+        _save(SESSION_TICKETS_FILE, tickets)
+
+
+def load_ticket(address):
+    """Return (ticket, secret, fingerprint) cached for `address`, or None."""
+    with _lock:
+        entry = _load(SESSION_TICKETS_FILE).get(address)
+    if not entry or entry["expires"] < time.time():
+        return None
+    ticket, secret = bytes.fromhex(entry["ticket"]), bytes.fromhex(entry["secret"])
+    return ticket, secret, entry["fingerprint"]
+
+
+def drop_ticket(address):
+    with _lock:
+        tickets = _load(SESSION_TICKETS_FILE)
+        if tickets.pop(address, None) is not None:
+            _save(SESSION_TICKETS_FILE, tickets)
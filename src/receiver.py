@@ -0,0 +1,518 @@
+import asyncio
+import collections
+import hmac
+import itertools
+import logging
+import secrets
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import serialization
+
+import metrics
+import peers
+import storage
+import transfer
+import tuning
+
+# Every handshake read or write must make progress within this many seconds
+HANDSHAKE_TIMEOUT = 60
+STOP_POLL_INTERVAL = 0.5
+# Handshakes a single address may have open at once; extra ones are dropped
+MAX_CONNECTIONS_PER_IP = 64
+
+AdmissionLimits = collections.namedtuple(
+    "AdmissionLimits",
+    "transfers per_ip inflight_bytes backlog wait",
+    defaults=(8, 4, 8 * 1024 * 1024 * 1024, 64, 5.0),
+)
+AdmissionLimits.__doc__ = """Receiver limits: concurrent transfers, transfers
+per source address, announced bytes of all running transfers, transfers that
+may queue for a slot and how long (seconds) one may wait before the sender is
+told to retry."""
+
+
+class AdmissionControl:
+    """Decide when a transfer may start, queueing it while the receiver is full.
+
+    State is only touched on the event loop; `release` may be called from
+    any thread. A transfer larger than the byte budget is still admitted
+    once nothing else is running, so it cannot starve.
+    """
+
+    def __init__(self, loop, limits, on_change=None):
+        self.loop = loop
+        self.limits = limits
+        self.on_change = on_change
+        self.active = {}
+        self.waiters = collections.deque()
+        self._tokens = itertools.count(1)
+
+    @property
+    def inflight_bytes(self):
+        return sum(size for _, size in self.active.values())
+
+    def _fits(self, ip, size):
+        if len(self.active) >= self.limits.transfers:
+            return False
+        if sum(1 for a, _ in self.active.values() if a == ip) >= self.limits.per_ip:
+            return False
+        return (
+            not self.active or self.inflight_bytes + size <= self.limits.inflight_bytes
+        )
+
+    def _grant(self, ip, size):
+        token = next(self._tokens)
+        self.active[token] = (ip, size)
+        return token
+
+    def retry_after(self):
+        """Seconds a refused sender should wait, growing with the queue."""
+        return min(60, 2 + 2 * len(self.waiters) // max(self.limits.transfers, 1))
+
+    async def admit(self, ip, size):
+        """Return a token once the transfer may start, or raise transfer.ReceiverBusy."""
+        if not self.waiters and self._fits(ip, size):
+            token = self._grant(ip, size)
+            self.changed()
+            return token
+        if len(self.waiters) >= self.limits.backlog:
+            raise transfer.ReceiverBusy(self.retry_after())
+        waiter = (ip, size, self.loop.create_future())
+        self.waiters.append(waiter)
+        self.changed()
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter[2]), self.limits.wait)
+        except asyncio.TimeoutError:
+            if waiter[2].done():
+                return waiter[2].result()
+            raise transfer.ReceiverBusy(self.retry_after()) from None
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                self.changed()
+
+    def release(self, token):
+        """Free a slot; safe to call more than once and from any thread."""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._release, token)
+
+    def _release(self, token):
+        if self.active.pop(token, None) is None:
+            return
+        # Wake queued transfers in order, skipping ones that still do not fit
+        for waiter in list(self.waiters):
+            ip, size, future = waiter
+            if not future.done() and self._fits(ip, size):
+                self.waiters.remove(waiter)
+                future.set_result(self._grant(ip, size))
+        self.changed()
+
+    def load(self):
+        return {
+            "transfers": len(self.active),
+            "max_transfers": self.limits.transfers,
+            "queued": len(self.waiters),
+            "inflight_bytes": self.inflight_bytes,
+        }
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self.load())
+
+
+def describe_load(load):
+    """One-line summary of AdmissionControl.load() for the GUI and CLI."""
+    text = f"{load['transfers']}/{load['max_transfers']} transfers"
+    if load["queued"]:
+        text += f", {load['queued']} queued"
+    return text + f", {load['inflight_bytes'] / (1024 * 1024):.1f} MB in flight"
+
+
+class Connection:
+    """A non-blocking socket driven by the event loop during the handshake."""
+
+    def __init__(self, loop, sock, addr):
+        self.loop = loop
+        self.sock = sock
+        self.addr = addr
+
+    async def recv_exact(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while view:
+            received = await asyncio.wait_for(
+                self.loop.sock_recv_into(self.sock, view), HANDSHAKE_TIMEOUT
+            )
+            if not received:
+                raise ConnectionError("Socket connection lost during handshake")
+            view = view[received:]
+        return bytes(buf)
+
+    async def recv_blob(self, limit=transfer.MAX_HANDSHAKE_BLOB):
+        length = struct.unpack("I", await self.recv_exact(4))[0]
+        if length > limit:
+            raise ConnectionError(f"Handshake message too large: {length} bytes")
+        return await self.recv_exact(length)
+
+    async def sendall(self, data):
+        await asyncio.wait_for(
+            self.loop.sock_sendall(self.sock, data), HANDSHAKE_TIMEOUT
+        )
+
+    async def send_blob(self, data):
+        await self.sendall(struct.pack("I", len(data)) + data)
+
+
+class ReceiverServer:
+    """Accept connections and run handshakes for many peers on one event loop.
+
+    Idle and slow peers only cost a coroutine while they send their hello,
+    go through the key exchange or wait for the user to confirm them. RSA
+    and ticket crypto run on the crypto pool; once a transfer header has
+    arrived the socket is handed to a worker thread running the regular
+    blocking receive pipeline.
+    """
+
+    def __init__(
+        self,
+        status_callback=None,
+        progress_callback=None,
+        cli=False,
+        limits=None,
+        load_callback=None,
+        auto_accept=False,
+    ):
+        self.status_callback = status_callback
+        self.progress_callback = progress_callback
+        self.load_callback = load_callback
+        self.cli = cli
+        # Benchmark mode: every sender is approved without asking
+        self.auto_accept = auto_accept
+        self.limits = limits or AdmissionLimits()
+        self.admission = None
+        self.loop = None
+        # Every stream of every admitted transfer may need a worker
+        self.workers = ThreadPoolExecutor(
+            max_workers=self.limits.transfers * transfer.MAX_STREAMS,
+            thread_name_prefix="lancryptor-recv",
+        )
+        self.tasks = set()
+        self.connections = collections.Counter()
+
+    def status(self, message):
+        if self.status_callback:
+            self.status_callback(message)
+
+    async def crypto(self, func, *args):
+        return await self.loop.run_in_executor(transfer.crypto_pool(), func, *args)
+
+    async def run(self, stop_event=None):
+        self.loop = asyncio.get_running_loop()
+        self.admission = AdmissionControl(self.loop, self.limits, self.load_callback)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Accepted connections inherit the buffer sizes
+            tuning.set_buffers(listener)
+            listener.bind(("", transfer.PORT))
+            listener.listen(socket.SOMAXCONN)
+            listener.setblocking(False)
+            self.status("Listening for incoming files...")
+
+            accept_task = asyncio.create_task(self.accept_loop(listener))
+            last_cleanup = None
+            while not (stop_event and stop_event.is_set()):
+                if accept_task.done():
+                    accept_task.result()
+                if (
+                    last_cleanup is None
+                    or time.monotonic() - last_cleanup > transfer.CLEANUP_INTERVAL
+                ):
+                    last_cleanup = time.monotonic()
+                    await self.loop.run_in_executor(
+                        None, transfer.cleanup_partial_transfers
+                    )
+                await asyncio.sleep(STOP_POLL_INTERVAL)
+            accept_task.cancel()
+            for task in list(self.tasks):
+                task.cancel()
+        finally:
+            listener.close()
+            self.workers.shutdown(wait=False)
+
+    async def accept_loop(self, listener):
+        while True:
+            sock, addr = await self.loop.sock_accept(listener)
+            if self.connections[addr[0]] >= MAX_CONNECTIONS_PER_IP:
+                logging.warning(f"Dropping connection from {addr[0]}: too many open")
+                sock.close()
+                continue
+            sock.setblocking(False)
+            # Handshakes and acks are small writes that must not wait for Nagle
+            tuning.nodelay(sock, True)
+            self.connections[addr[0]] += 1
+            task = asyncio.create_task(self.handle(sock, addr))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            task.add_done_callback(lambda _, ip=addr[0]: self.forget_connection(ip))
+
+    def forget_connection(self, ip):
+        self.connections[ip] -= 1
+        if self.connections[ip] <= 0:
+            del self.connections[ip]
+
+    async def handle(self, sock, addr):
+        conn = Connection(self.loop, sock, addr)
+        handed_off = False
+        token = None
+        try:
+            hello = await conn.recv_exact(len(transfer.HELLO) + 1)
+            magic, offered = hello[:-1], hello[-1]
+            if offered < transfer.MIN_PROTOCOL_VERSION or magic not in (
+                transfer.HELLO,
+                transfer.JOIN_HELLO,
+            ):
+                return
+
+            if magic == transfer.JOIN_HELLO:
+                request = await conn.recv_exact(transfer.join_request_size(offered))
+                handed_off = True
+                await self.hand_off(
+                    sock,
+                    transfer.serve_join,
+                    addr,
+                    offered,
+                    *transfer.parse_join_request(request, offered),
+                    self.status_callback,
+                    self.progress_callback,
+                )
+                return
+
+            # Peers offering 3 or newer are told which version will be spoken
+            version = min(offered, transfer.PROTOCOL_VERSION)
+            if offered >= 3:
+                await conn.sendall(bytes([version]))
+
+            stats = metrics.TransferMetrics("receive", peer=addr[0])
+            with stats.stage("handshake"):
+                master_key = await self.handshake(conn, version, stats)
+            if master_key is None:
+                return
+
+            data = await conn.recv_exact(transfer.header_size(version))
+            header = transfer.parse_header(data, version)
+            stats.name, stats.size = header.filename, header.filesize
+            try:
+                storage.check_free_space(transfer.RECEIVED_DIR, header.filesize)
+            except storage.InsufficientSpace as e:
+                self.status(f"Refused {header.filename} from {addr[0]}: {e.strerror}")
+                if version >= 3:
+                    await conn.sendall(
+                        transfer.RECEIVER_NO_SPACE + struct.pack("Q", e.free)
+                    )
+                return
+            try:
+                with stats.stage("admission"):
+                    token = await self.admission.admit(addr[0], header.filesize)
+            except transfer.ReceiverBusy as busy:
+                logging.info(f"Deferring {addr[0]}: {busy}")
+                if version >= 3:
+                    await conn.sendall(
+                        transfer.RECEIVER_BUSY + struct.pack("H", busy.retry_after)
+                    )
+                return
+
+            handed_off = True
+            await self.hand_off(
+                sock,
+                transfer.receive_session,
+                version,
+                master_key,
+                header,
+                self.status_callback,
+                self.progress_callback,
+                lambda: self.admission.release(token),
+                stats,
+                stats=stats,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            transfer.report_receive_error(e, self.status_callback)
+        finally:
+            if not handed_off:
+                sock.close()
+                if token is not None:
+                    self.admission.release(token)
+
+    async def hand_off(self, sock, func, *args, stats=None):
+        """Run a blocking payload phase for `sock` on a worker thread.
+
+        The connection's transport parameters are logged, and added to
+        `stats` if given.
+        """
+
+        def run():
+            try:
+                sock.setblocking(True)
+                sock.settimeout(tuning.IDLE_TIMEOUT)
+                tuning.report(sock, stats=stats, label="from")
+                func(sock, *args)
+            except Exception as e:
+                transfer.report_receive_error(e, self.status_callback)
+            finally:
+                sock.close()
+
+        await self.loop.run_in_executor(self.workers, run)
+
+    async def confirm(self, fingerprint, addr, trustable):
+        if self.auto_accept:
+            return transfer.ACCEPT_ALWAYS
+        future = transfer.request_confirmation(
+            fingerprint, addr[0], self.cli, trustable
+        )
+        return transfer.confirmation_answer(await asyncio.wrap_future(future))
+
+    async def handshake(self, conn, version, stats=metrics.NO_METRICS):
+        """Run the receiving side of the key exchange.
+
+        Senders presenting a valid ticket, or a signed key that is in the
+        trusted-peer store, are accepted without a prompt; senders the user
+        chooses to always trust are added to the store and get a ticket.
+        Returns the master key, or None if the connection was rejected.
+        """
+        addr = conn.addr
+        if version >= 3 and await conn.recv_exact(1) == transfer.SESSION_RESUME:
+            ticket = await conn.recv_blob()
+            client_nonce = await conn.recv_exact(16)
+            opened = await self.crypto(peers.open_ticket, ticket)
+            if opened:
+                secret, fingerprint = opened
+                server_nonce = secrets.token_bytes(16)
+                await conn.sendall(b"\x01" + server_nonce)
+                master_key = transfer.resumed_master_key(
+                    secret, client_nonce, server_nonce
+                )
+                proof = await conn.recv_exact(32)
+                if not hmac.compare_digest(
+                    proof, transfer.resumption_proof(master_key)
+                ):
+                    raise ConnectionError("Invalid session ticket proof")
+                peers.touch_peer(fingerprint, addr[0])
+                stats.fingerprint = fingerprint
+                self.status(
+                    f"Resumed session with trusted sender {addr[0]} ({fingerprint[:16]})"
+                )
+                return master_key
+            await conn.sendall(b"\x00")
+
+        if version >= 4:
+            return await self.handshake_ecdh(conn, stats)
+
+        # Send receiver's public key with length prefix
+        await conn.send_blob(transfer.public_key_pem())
+        receiver_pubkey_hash = transfer.own_fingerprint(version)
+
+        trusted = False
+        if version >= 3:
+            sender_pubkey_data = await conn.recv_blob()
+            enc_key = await conn.recv_blob()
+            signature = await conn.recv_blob()
+            await self.crypto(
+                transfer.verify_handshake,
+                serialization.load_pem_public_key(sender_pubkey_data),
+                signature,
+                bytes.fromhex(receiver_pubkey_hash) + enc_key,
+            )
+            fingerprint = transfer.key_fingerprint(sender_pubkey_data)
+            stats.fingerprint = fingerprint
+            trusted = peers.is_trusted(fingerprint)
+        else:
+            fingerprint = receiver_pubkey_hash
+
+        whose = "sender" if version >= 3 else "receiver"
+        answer = await self.approve(conn, fingerprint, whose, trusted, stats)
+        if not answer:
+            return None
+
+        # Send approval to sender
+        await conn.sendall(b"\x01")
+
+        if version < 3:
+            enc_key = await conn.recv_blob()
+        master_key = await self.crypto(
+            transfer.decrypt_aes_key, enc_key, transfer.load_private_key()
+        )
+        if version >= 3:
+            await self.send_ticket(conn, master_key, fingerprint, answer)
+        return master_key
+
+    async def handshake_ecdh(self, conn, stats=metrics.NO_METRICS):
+        """Receiving side of transfer.exchange_keys_ecdh (protocol 4)."""
+        identity = transfer.identity_pem()
+        private_share, share = transfer.ecdh_share()
+        await conn.sendall(transfer.blob(identity) + share)
+
+        sender_identity = await conn.recv_blob()
+        sender_share = await conn.recv_exact(transfer.ECDH_SHARE_SIZE)
+        signature = await conn.recv_blob()
+        sender_key = transfer.load_identity_public_key(sender_identity, "Sender")
+        transcript = transfer.ecdh_transcript(
+            identity, share, sender_identity, sender_share
+        )
+        transfer.verify_identity(
+            sender_key, signature, b"sender" + transcript, "Sender"
+        )
+        fingerprint = transfer.key_fingerprint(sender_identity)
+        stats.fingerprint = fingerprint
+
+        trusted = peers.is_trusted(fingerprint)
+        answer = await self.approve(conn, fingerprint, "sender", trusted, stats)
+        if not answer:
+            return None
+
+        signature = transfer.load_identity_key().sign(b"receiver" + transcript)
+        await conn.sendall(b"\x01" + transfer.blob(signature))
+        master_key = transfer.ecdh_master_key(private_share, sender_share, transcript)
+        await self.send_ticket(conn, master_key, fingerprint, answer)
+        return master_key
+
+    async def approve(self, conn, fingerprint, whose, trusted, stats):
+        """Accept trusted senders, ask the user about the rest.
+
+        Returns transfer.ACCEPT_ALWAYS for trusted senders and the user's
+        answer otherwise; a sender the user always trusts from now on is
+        added to the trusted-peer store. Sends the rejection to the peer
+        and returns transfer.REJECT if the user says no.
+        """
+        addr = conn.addr
+        if trusted:
+            peers.touch_peer(fingerprint, addr[0])
+            self.status(
+                f"Connection from trusted sender {addr[0]} ({fingerprint[:16]})"
+            )
+            return transfer.ACCEPT_ALWAYS
+
+        self.status(f"Connection from {addr[0]} - Confirm {whose} key:\n{fingerprint}")
+        # Ask UI to confirm the key hash; only this connection gets the answer
+        with stats.stage("confirm"):
+            answer = await self.confirm(fingerprint, addr, whose == "sender")
+        if not answer:
+            self.status("Connection rejected by user.")
+            if self.status_callback:
+                transfer.notify("LANCryptor", "Connection rejected by user.")
+            await conn.sendall(b"\x00")
+        elif answer == transfer.ACCEPT_ALWAYS and whose == "sender":
+            peers.trust_peer(fingerprint, addr[0])
+        return answer
+
+    async def send_ticket(self, conn, master_key, fingerprint, answer):
+        """Give a trusted sender a resumption ticket; others get an empty one."""
+        ticket = b""
+        if answer == transfer.ACCEPT_ALWAYS:
+            secret = transfer.derive_secret(master_key, b"LANCryptor resumption")
+            ticket = await self.crypto(peers.issue_ticket, secret, fingerprint)
+        await conn.send_blob(ticket)
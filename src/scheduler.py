@@ -0,0 +1,532 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import transfer
+
+# Queued, running and finished sends, shared by the GUI and the CLI
+QUEUE_DB = "send_queue.db"
+# Sends one scheduler runs at once
+MAX_CONCURRENT = 2
+# Lower values run first
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+# Running jobs refresh their heartbeat this often; a running job whose
+# heartbeat is older than STALE_AFTER belonged to a scheduler that died
+# and is queued again
+HEARTBEAT_INTERVAL = 5
+STALE_AFTER = 30
+# How often the queue is checked for jobs added by other processes
+POLL_INTERVAL = 1.0
+# Finished, failed and cancelled jobs are deleted after this many days
+FINISHED_RETENTION_DAYS = 7
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# A running job another process asked to stop; its scheduler notices and
+# stops it within POLL_INTERVAL
+CANCELLING = "cancelling"
+# States of jobs that have not finished yet
+ACTIVE = (QUEUED, RUNNING, CANCELLING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    added REAL NOT NULL,
+    priority INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    ips TEXT NOT NULL,
+    paths TEXT NOT NULL,
+    options TEXT NOT NULL,
+    message TEXT NOT NULL DEFAULT '',
+    heartbeat REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, priority, position);
+"""
+
+
+class TokenBucket:
+    """Limit the bytes per second of every thread paying from one bucket.
+
+    `consume` never refuses: it takes what was asked (going into debt if
+    needed) and sleeps until the debt is paid, so frames of any size pass
+    at the configured rate. Up to `burst` bytes go out at full speed after
+    an idle period.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate // 4, transfer.MAX_FRAME_SIZE)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def set_rate_limit(rate):
+    """Limit all outgoing transfer data of this process to `rate` bytes/s.
+
+    None or 0 removes the limit.
+    """
+    transfer.SEND_LIMIT = TokenBucket(rate) if rate else None
+
+
+def validate(ips, paths, streams=1, delta=False, dedup=False):
+    """Raise ValueError unless the options describe a send that can run."""
+    if not ips:
+        raise ValueError("At least one receiver address is required")
+    if not paths:
+        raise ValueError("At least one file or directory is required")
+    if delta and dedup:
+        raise ValueError("Delta and dedup cannot be combined")
+    if len(ips) > 1:
+        if len(paths) > 1 or os.path.isdir(paths[0]) or delta or dedup:
+            raise ValueError("Several receivers take a single file")
+        if streams > 1:
+            raise ValueError("Several receivers are sent one stream each")
+    elif len(paths) > 1 or os.path.isdir(paths[0]):
+        if delta or dedup or streams > 1:
+            raise ValueError("A batch is sent without delta, dedup or streams")
+
+
+def run_job(job, progress_callback=None, status_callback=None, stop_event=None):
+    """Send what `job` describes the way the CLI would; True if it all arrived."""
+    ips, paths, options = job["ips"], job["paths"], job["options"]
+    compression = options.get("compression", "auto")
+    if len(ips) > 1:
+        progress = dict.fromkeys(ips, 0.0)
+
+        def on_progress(ip, percent):
+            progress[ip] = percent
+            if progress_callback:
+                progress_callback(sum(progress.values()) / len(progress))
+
+        def on_status(ip, message):
+            if status_callback:
+                status_callback(f"{ip}: {message}")
+
+        results = transfer.send_file_fanout(
+            ips, paths[0], on_progress, on_status, stop_event, compression
+        )
+        return all(results.values())
+    # Several files or any directory go out as one batch session
+    if len(paths) > 1 or os.path.isdir(paths[0]):
+        return transfer.send_files(
+            ips[0], paths, progress_callback, status_callback, stop_event, compression
+        )
+    return transfer.send_file(
+        ips[0],
+        paths[0],
+        progress_callback,
+        status_callback,
+        stop_event,
+        streams=options.get("streams", 1),
+        compression=compression,
+        delta=options.get("delta", False),
+        dedup=options.get("dedup", False),
+    )
+
+
+class SendScheduler:
+    """Run queued sends by priority, at most `max_concurrent` at once.
+
+    The queue lives in QUEUE_DB, so jobs survive restarts and other
+    processes may add to it (`main.py send --queue`) while a scheduler runs.
+    Claiming a job is a single UPDATE, so two schedulers never run the same
+    one. Jobs run in order of priority, then position. `on_change()`,
+    `status_callback(job_id, message)` and `progress_callback(job_id,
+    percent)` are called from worker threads.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        max_concurrent=MAX_CONCURRENT,
+        on_change=None,
+        status_callback=None,
+        progress_callback=None,
+    ):
+        self.path = path or QUEUE_DB
+        self.max_concurrent = max_concurrent
+        self.on_change = on_change
+        self.status_callback = status_callback
+        self.progress_callback = progress_callback
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # id -> {"stop": Event, "progress": percent} of jobs run here
+        self._running = {}
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._data_version = None
+        self._prune()
+
+    def _execute(self, query, params=()):
+        with self._lock, self._db:
+            return self._db.execute(query, params)
+
+    def _changed(self):
+        if self.on_change:
+            try:
+                self.on_change()
+            except Exception:
+                logging.exception("Queue change callback failed")
+
+    def add(
+        self,
+        ips,
+        paths,
+        priority="normal",
+        streams=1,
+        compression="auto",
+        delta=False,
+        dedup=False,
+    ):
+        """Queue a send and return its job id; raises ValueError if invalid."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        if compression not in transfer.MODES:
+            raise ValueError(f"Unknown compression mode: {compression}")
+        paths = [os.path.abspath(path) for path in paths]
+        validate(ips, paths, streams, delta, dedup)
+        options = {
+            "streams": streams,
+            "compression": compression,
+            "delta": delta,
+            "dedup": dedup,
+        }
+        with self._lock, self._db:
+            position = self._db.execute(
+                "SELECT COALESCE(MAX(position), 0) + 1 FROM jobs"
+            ).fetchone()[0]
+            job_id = self._db.execute(
+                "INSERT INTO jobs (added, priority, position, state, ips, paths,"
+                " options) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    PRIORITIES[priority],
+                    position,
+                    QUEUED,
+                    json.dumps(list(ips)),
+                    json.dumps(paths),
+                    json.dumps(options),
+                ),
+            ).lastrowid
+        self._wake.set()
+        self._changed()
+        return job_id
+
+    def jobs(self, finished=50):
+        """Return jobs as dicts: running and queued ones in run order, then
+        up to `finished` finished ones, newest first.
+        """
+        with self._lock:
+            active = self._db.execute(
+                "SELECT * FROM jobs WHERE state IN (?, ?, ?)"
+                " ORDER BY state = ?, priority, position",
+                (*ACTIVE, QUEUED),
+            ).fetchall()
+            done = self._db.execute(
+                "SELECT * FROM jobs WHERE state NOT IN (?, ?, ?)"
+                " ORDER BY id DESC LIMIT ?",
+                (*ACTIVE, finished),
+            ).fetchall()
+            running = {job_id: dict(info) for job_id, info in self._running.items()}
+        jobs = []
+        for row in active + done:
+            job = dict(row)
+            for key in ("ips", "paths", "options"):
+                job[key] = json.loads(job[key])
+            job["progress"] = running.get(job["id"], {}).get("progress")
+            jobs.append(job)
+        return jobs
+
+    def move(self, job_id, steps):
+        """Move a queued job `steps` places later (negative: earlier).
+
+        A job moved past one of another priority takes that priority, so
+        the queue keeps running in the order shown.
+        """
+        with self._lock, self._db:
+            rows = self._db.execute(
+                "SELECT id, priority FROM jobs WHERE state = ?"
+                " ORDER BY priority, position",
+                (QUEUED,),
+            ).fetchall()
+            order = [row["id"] for row in rows]
+            if job_id not in order:
+                return False
+            index = order.index(job_id)
+            target = max(0, min(len(order) - 1, index + steps))
+            if target == index:
+                return False
+            priority = rows[target]["priority"]
+            order.insert(target, order.pop(index))
+            self._db.execute(
+                "UPDATE jobs SET priority = ? WHERE id = ?", (priority, job_id)
+            )
+            self._db.executemany(
+                "UPDATE jobs SET position = ? WHERE id = ?",
+                [(position, queued_id) for position, queued_id in enumerate(order)],
+            )
+        self._changed()
+        return True
+
+    def set_priority(self, job_id, priority):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        self._execute(
+            "UPDATE jobs SET priority = ? WHERE id = ?", (PRIORITIES[priority], job_id)
+        )
+        self._wake.set()
+        self._changed()
+
+    def cancel(self, job_id):
+        """Drop a queued job, or stop a running one.
+
+        A job running in another process is marked CANCELLING; the
+        scheduler running it stops it when it next polls the queue.
+        """
+        with self._lock:
+            running = self._running.get(job_id)
+            if running:
+                running["cancelled"] = True
+        if running:
+            running["stop"].set()
+            return True
+        with self._lock, self._db:
+            cancelled = (
+                self._db.execute(
+                    "UPDATE jobs SET state = ? WHERE id = ? AND state = ?",
+                    (CANCELLED, job_id, QUEUED),
+                ).rowcount
+                or self._db.execute(
+                    "UPDATE jobs SET state = ? WHERE id = ? AND state = ?",
+                    (CANCELLING, job_id, RUNNING),
+                ).rowcount
+            )
+        self._changed()
+        return bool(cancelled)
+
+    def clear_finished(self):
+        deleted = self._execute(
+            "DELETE FROM jobs WHERE state NOT IN (?, ?, ?)", ACTIVE
+        ).rowcount
+        self._changed()
+        return deleted
+
+    def start(self):
+        """Start dispatching jobs on a background thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._dispatch, name="lancryptor-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop dispatching; running jobs are stopped and queued again."""
+        self._stopping.set()
+        self._wake.set()
+        with self._lock:
+            for running in self._running.values():
+                running["stop"].set()
+
+    def idle(self):
+        """True when nothing runs here and no job is waiting to run.
+
+        Jobs count as running from the moment they are claimed.
+        """
+        with self._lock:
+            if self._running:
+                return False
+            return not self._db.execute(
+                "SELECT 1 FROM jobs WHERE state = ? LIMIT 1", (QUEUED,)
+            ).fetchone()
+
+    def _dispatch(self):
+        last_heartbeat = 0
+        while not self._stopping.is_set():
+            if time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                self._heartbeat()
+            while len(self._running) < self.max_concurrent:
+                job = self._claim()
+                if job is None:
+                    break
+                self._start_job(job)
+            self._notice_other_writers()
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+    def _heartbeat(self):
+        """Refresh our running jobs and queue those of dead schedulers again."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                [(now, job_id) for job_id in self._running],
+            )
+            requeued = self._db.execute(
+                "UPDATE jobs SET state = ? WHERE state = ? AND heartbeat < ?",
+                (QUEUED, RUNNING, now - STALE_AFTER),
+            ).rowcount
+            # Nobody is left to stop these
+            self._db.execute(
+                "UPDATE jobs SET state = ? WHERE state = ? AND heartbeat < ?",
+                (CANCELLED, CANCELLING, now - STALE_AFTER),
+            )
+        if requeued:
+            logging.info(f"Queued {requeued} abandoned send(s) again")
+            self._changed()
+
+    def _stop_cancelled(self):
+        """Stop our jobs that another process asked to cancel."""
+        with self._lock:
+            ours = list(self._running)
+            if not ours:
+                return
+            rows = self._db.execute(
+                f"SELECT id FROM jobs WHERE state = ? AND id IN"
+                f" ({', '.join('?' * len(ours))})",
+                (CANCELLING, *ours),
+            ).fetchall()
+            for row in rows:
+                running = self._running[row["id"]]
+                running["cancelled"] = True
+                running["stop"].set()
+
+    def _claim(self):
+        """Mark the next queued job as ours and return it, or None."""
+        while True:
+            with self._lock, self._db:
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE state = ? ORDER BY priority, position"
+                    " LIMIT 1",
+                    (QUEUED,),
+                ).fetchone()
+                if row is None:
+                    return None
+                # Another scheduler may have claimed it since the SELECT
+                claimed = self._db.execute(
+                    "UPDATE jobs SET state = ?, heartbeat = ?, message = ''"
+                    " WHERE id = ? AND state = ?",
+                    (RUNNING, time.time(), row["id"], QUEUED),
+                ).rowcount
+                # Registered under the same lock, so idle() never sees a
+                # job that is neither queued nor running
+                if claimed:
+                    self._running[row["id"]] = {
+                        "stop": threading.Event(),
+                        "progress": 0.0,
+                    }
+            if claimed:
+                break
+        job = dict(row)
+        for key in ("ips", "paths", "options"):
+            job[key] = json.loads(job[key])
+        return job
+
+    def _notice_other_writers(self):
+        # data_version changes when another connection commits to the database
+        with self._lock:
+            version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_version is not None and version != self._data_version:
+            self._stop_cancelled()
+            self._changed()
+        self._data_version = version
+
+    def _start_job(self, job):
+        with self._lock:
+            stop_event = self._running[job["id"]]["stop"]
+        threading.Thread(target=self._run, args=(job, stop_event), daemon=True).start()
+        self._changed()
+
+    def _run(self, job, stop_event):
+        job_id = job["id"]
+        last_message = ""
+
+        def on_progress(percent):
+            with self._lock:
+                self._running[job_id]["progress"] = percent
+            if self.progress_callback:
+                self.progress_callback(job_id, percent)
+            self._changed()
+
+        def on_status(message):
+            nonlocal last_message
+            last_message = message
+            if self.status_callback:
+                self.status_callback(job_id, message)
+
+        ok = False
+        try:
+            ok = run_job(job, on_progress, on_status, stop_event)
+        except Exception:
+            logging.exception(f"Send job {job_id} failed")
+        with self._lock:
+            cancelled = self._running[job_id].get("cancelled")
+        if stop_event.is_set():
+            state = QUEUED if self._stopping.is_set() and not cancelled else CANCELLED
+        else:
+            state = DONE if ok else FAILED
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "UPDATE jobs SET state = ?, message = ? WHERE id = ?",
+                    (state, last_message, job_id),
+                )
+            del self._running[job_id]
+        self._wake.set()
+        self._changed()
+
+    def _prune(self):
+        cutoff = time.time() - FINISHED_RETENTION_DAYS * 86400
+        self._execute(
+            "DELETE FROM jobs WHERE state NOT IN (?, ?, ?) AND added < ?",
+            (*ACTIVE, cutoff),
+        )
+
+    def close(self, timeout=10):
+        """Stop, give running jobs `timeout` seconds to wind down, and close."""
+        self.stop()
+        deadline = time.monotonic() + timeout
+        while self._running and time.monotonic() < deadline:
+            time.sleep(0.1)
+        with self._lock:
+            self._db.close()
+
+
+def describe(job):
+    """One line per job, as shown in the Send tab and by the CLI."""
+    priority = {value: name for name, value in PRIORITIES.items()}[job["priority"]]
+    names = ", ".join(os.path.basename(path) for path in job["paths"])
+    state = job["state"]
+    if job.get("progress") is not None:
+        state = f"{state} {job['progress']:.0f}%"
+    receivers = ", ".join(job["ips"])
+    text = f"#{job['id']}  {state:12}  {priority:6}  {names} -> {receivers}"
+    if job["message"] and job["state"] != RUNNING:
+        text += f"  ({job['message'].splitlines()[0]})"
+    return text
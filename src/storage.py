@@ -0,0 +1,91 @@
+import errno
+import logging
+import os
+import shutil
+
+# What is flushed to disk before a received file is renamed into place:
+#   "none": nothing; the OS writes it back when it likes
+#   "file": the file's data, so a crash never leaves a partly written file
+#           under its final name
+#   "full": the data and the directory entry, so a finished file also
+#           survives a power loss right after it was reported received
+DURABILITY = "file"
+DURABILITY_MODES = ("none", "file", "full")
+# Reserve the whole file on disk before writing it; set to False for
+# filesystems where preallocation is slow or pointless
+PREALLOCATE = True
+# Transfers are refused unless this much space would be left afterwards
+FREE_SPACE_RESERVE = 256 * 1024 * 1024
+
+
+class InsufficientSpace(OSError):
+    """The receiving disk cannot hold `needed` more bytes; `free` are left."""
+
+    def __init__(self, needed, free):
+        super().__init__(
+            errno.ENOSPC,
+            f"Not enough disk space: {needed / (1024 * 1024):.1f} MB needed,"
+            f" {free / (1024 * 1024):.1f} MB free",
+        )
+        self.needed = needed
+        self.free = free
+
+
+def free_space(path):
+    """Bytes available to us on the filesystem holding `path` (or its parent)."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def check_free_space(path, size):
+    """Raise InsufficientSpace unless `size` bytes fit beside the reserve."""
+    free = free_space(path)
+    if size + FREE_SPACE_RESERVE > free:
+        raise InsufficientSpace(size, max(free - FREE_SPACE_RESERVE, 0))
+
+
+def preallocate(f, size):
+    """Give the open file `f` `size` bytes of disk space up front.
+
+    Where the platform can (posix_fallocate), the blocks are reserved now,
+    so a full disk fails the transfer before any data arrives and the file
+    is laid out in one piece. Elsewhere the file is only extended.
+    """
+    if PREALLOCATE and size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise InsufficientSpace(size, free_space(f.name)) from None
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            logging.info(f"Cannot preallocate {f.name}: {e}")
+    f.truncate(size)
+
+
+def _sync_directory(path):
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit(tmp_path, path):
+    """Atomically move a verified file into place, flushing it per DURABILITY.
+
+    `tmp_path` must be on the same filesystem as `path`; readers see either
+    the previous file or the complete new one, never a partial one.
+    """
+    if DURABILITY != "none":
+        with open(tmp_path, "r+b") as f:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if DURABILITY == "full":
+        _sync_directory(path)
+    return path
@@ -1,34 +1,188 @@
 from cryptography.hazmat.primitives.asymmetric import padding as asymmetric_padding, rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, x25519
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import serialization, hashes, padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidSignature, InvalidTag
 from cryptography.hazmat.backends import default_backend
-from PIL import Image
-from plyer import notification
+from buffers import BufferPool, FrameReader, file_views, recv_into_exact
+import peers
+import merkle
+import metrics
+import storage
+import tuning
+import delta
+import chunkstore
+from compression import (
+    LEVEL_FAST,
+    LEVEL_MAX,
+    MODE_IDS,
+    MODES,
+    STORED,
+    AdaptiveCompressor,
+    compress_chunk,
+    decompress_chunk,
+    estimate_ratio,
+)
+from concurrent.futures import Future, ThreadPoolExecutor
+import collections
+import contextlib
 import threading
 import secrets
-import pystray
-import zipfile
+import hmac
+import hashlib
+import time
+import random
 import logging
 import socket
 import struct
 import queue
+import tempfile
+import json
+import zlib
 import sys
-import io
 import os
 
 # Configuration
 PORT = 5001
 BUFFER_SIZE = 65536
 AES_KEY_SIZE = 32
+# RSA key pair, only needed by handshakes with protocol 2 and 3 peers
 KEY_FILE_PRIVATE = "private_key.pem"
 KEY_FILE_PUBLIC = "public_key.pem"
+# Ed25519 identity key used by protocol 4 handshakes
+KEY_FILE_IDENTITY = "identity_key.pem"
 RECEIVED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Received")
 
-# Confirmation inter-thread communication for receiver UI
+# Wire protocol
+HELLO = b"REQ_PUBLIC_KEY"
+JOIN_HELLO = b"REQ_JOIN_RANGE"
+JOIN_REJECTED = b"\x00"
+JOIN_ACCEPTED = b"\x01"
+JOIN_COMPLETE = b"\x02"
+# Answer to a transfer header when the receiver is at capacity, followed by
+# the seconds ("H") the sender should wait before trying again
+RECEIVER_BUSY = b"\x03"
+BUSY_ATTEMPTS = 8
+BUSY_MAX_DELAY = 120
+# Answer to a transfer header when the file would not fit on the receiver's
+# disk, followed by the bytes ("Q") it could still take
+RECEIVER_NO_SPACE = b"\x04"
+# 2: one CBC stream per range, 3: independently sealed AES-GCM chunks,
+# 4: as 3, with an X25519/Ed25519 handshake instead of RSA and chunks that
+# grow up to MAX_CHUNK_SIZE on fast links, 5: as 4, with every range
+# verified leaf by leaf on disk and mismatched leaves sent again
+PROTOCOL_VERSION = 5
+MIN_PROTOCOL_VERSION = 2
+# Payload is sent as length-prefixed encrypted frames, a zero length ends it
+FRAME_HEADER = struct.Struct("I")
+# Protocol 3 compresses and seals every CHUNK_SIZE piece of a file on its own
+CHUNK_SIZE = BUFFER_SIZE
+MAX_CHUNK_SIZE = CHUNK_SIZE * 4
+# Room for a sealed MAX_CHUNK_SIZE chunk: method byte and tag
+MAX_FRAME_SIZE = MAX_CHUNK_SIZE + 64
+# zlib levels used for the single deflate stream of protocol 2
+STREAM_LEVELS = {"auto": -1, "none": 0, "fast": LEVEL_FAST, "max": LEVEL_MAX}
+# Large files may be split over several parallel connections
+MAX_STREAMS = 16
+JOIN_TIMEOUT = 60
+# Interrupted protocol 3 transfers are kept on disk and resumed on reconnect
+PARTIAL_DIR = ".partial"
+PARTIAL_RETENTION = 2 * 24 * 3600
+CLEANUP_INTERVAL = 60
+MANIFEST_INTERVAL = 16 * 1024 * 1024
+RESUME_ATTEMPTS = 6
+# Protocol 5 ranges end with the digest of every leaf (see merkle); the
+# receiver answers a mismatch with RANGE_REPAIR and the leaves to send
+# again, up to REPAIR_ATTEMPTS times per connection
+RANGE_REPAIR = b"\x02"
+REPAIR_ATTEMPTS = 3
+LEAF_INDEX = struct.Struct("I")
+LEAVES_PER_RECORD = 4096
+# Protocol 3 sessions start with a full handshake or a resumption ticket
+SESSION_FULL = b"\x00"
+SESSION_RESUME = b"\x01"
+MAX_HANDSHAKE_BLOB = 8192
+# Raw X25519 public key
+ECDH_SHARE_SIZE = 32
+# Protocol 3 headers say whether a single file or a batch of entries follows
+KIND_FILE = 0
+KIND_BATCH = 1
+KIND_DELTA = 2
+KIND_DEDUP = 3
+# Receiver-side content-addressed chunk store used by deduplicated sends
+CHUNK_DIR = ".chunks"
+MANIFEST_ENTRY = struct.Struct("32sI")
+# Chunks whose method byte is CONTROL_RECORD carry instructions instead of
+# file data: batch entry headers (size and "/"-separated relative path),
+# delta copy instructions and leaf digests
+CONTROL_RECORD = b"\x02"
+ENTRY_HEADER = struct.Struct("Q")
+MAX_ENTRY_NAME = 4096
+# Chunks sealed or opened concurrently per stream
+CRYPTO_WORKERS = min(8, os.cpu_count() or 1)
+AEAD_WINDOW = CRYPTO_WORKERS * 2
+# Fan-out sends keep this many compressed chunks for receivers that lag
+# behind the fastest one; a receiver further behind reads on its own
+FANOUT_BUFFER = 512
+FANOUT_READ_AHEAD = AEAD_WINDOW * 2
+# Token bucket (see scheduler.set_rate_limit) every outgoing frame is paid
+# from; None sends at full speed
+SEND_LIMIT = None
+
+# Receive buffers are pooled; the extra block leaves room for update_into
+RECV_POOL = BufferPool(MAX_FRAME_SIZE + 16, count=16)
+
+# Answers to a confirmation request: reject the connection, accept only
+# this one, or accept it and add the sender to the trusted-peer store
+REJECT = False
+ACCEPT_ONCE = "once"
+ACCEPT_ALWAYS = "always"
+
+# Confirmation requests waiting for the receiver UI
 confirmation_queue = queue.Queue()
-confirmation_event = threading.Event()
-confirmation_result = None  # True/False from UI
+_open_requests = []
+_open_requests_lock = threading.Lock()
+_prompt_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lancryptor-prompt")
 v = tray_icon = None
+# Desktop notifications; the GUI and `--notify` turn them on
+NOTIFICATIONS = False
+
+# Transfers whose extra streams may still join, keyed by transfer ID
+pending_transfers = {}
+pending_transfers_lock = threading.Lock()
+
+_crypto_pool = None
+
+# Parsed keys and fingerprints, loaded once per process (see _cached)
+_key_cache = {}
+_key_cache_lock = threading.RLock()
+_crypto_pool_lock = threading.Lock()
+_chunk_store = None
+_chunk_store_lock = threading.Lock()
+
+TransferHeader = collections.namedtuple(
+    "TransferHeader", "filename filesize streams transfer_id compression kind"
+)
+
+
+class ReceiverBusy(ConnectionError):
+    """The receiver is at its transfer limits; retry after `retry_after` s."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Receiver busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ReceiverFull(ConnectionError):
+    """The receiver's disk cannot take the file; `free` bytes are left."""
+
+    def __init__(self, free):
+        super().__init__(
+            f"Receiver does not have enough disk space ({free / (1024 * 1024):.1f} MB free)"
+        )
+        self.free = free
 
 
 def resource_path(relative_path):
@@ -40,6 +194,8 @@ def resource_path(relative_path):
 
 
 def create_image():
+    from PIL import Image
+
     icon_path = resource_path("assets/tray.ico")
     return Image.open(icon_path)
 
@@ -50,6 +206,8 @@ def on_quit(icon, item):
 
 def start_tray_icon():
     global tray_icon
+    import pystray
+
     icon = pystray.Icon(
         "LANCryptor",
         create_image(),
@@ -61,13 +219,9 @@ def start_tray_icon():
 
 
 def recv_exact(sock, n):
-    data = b""
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            raise ConnectionError("Socket connection lost during recv_exact")
-        data += packet
-    return data
+    data = bytearray(n)
+    recv_into_exact(sock, data)
+    return bytes(data)
 
 
 def get_local_ip():
@@ -83,7 +237,29 @@ def get_local_ip():
 
 
 def generate_keys():
-    if not os.path.exists(KEY_FILE_PRIVATE):
+    """Create the identity key on first run; RSA keys follow when first needed."""
+    with _key_cache_lock:
+        if os.path.exists(KEY_FILE_IDENTITY):
+            return
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        key_dir = os.path.dirname(KEY_FILE_IDENTITY)
+        if key_dir:
+            os.makedirs(key_dir, exist_ok=True)
+        fd = os.open(KEY_FILE_IDENTITY, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(
+                private_key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.PKCS8,
+                    encryption_algorithm=serialization.NoEncryption(),
+                )
+            )
+
+
+def generate_rsa_keys():
+    with _key_cache_lock:
+        if os.path.exists(KEY_FILE_PRIVATE):
+            return
         private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
         public_key = private_key.public_key()
 
@@ -109,14 +285,83 @@ def generate_keys():
             )
 
 
+def _cached(kind, path, load):
+    """Return load(), computed once per process for each key file."""
+    key = (kind, os.path.abspath(path))
+    with _key_cache_lock:
+        if key not in _key_cache:
+            _key_cache[key] = load()
+        return _key_cache[key]
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
 def load_private_key():
-    with open(KEY_FILE_PRIVATE, "rb") as f:
-        return serialization.load_pem_private_key(f.read(), password=None)
+    def load():
+        generate_rsa_keys()
+        return serialization.load_pem_private_key(
+            _read(KEY_FILE_PRIVATE), password=None
+        )
+
+    return _cached("rsa private", KEY_FILE_PRIVATE, load)
 
 
 def load_public_key():
-    with open(KEY_FILE_PUBLIC, "rb") as f:
-        return serialization.load_pem_public_key(f.read())
+    return _cached(
+        "rsa public",
+        KEY_FILE_PUBLIC,
+        lambda: serialization.load_pem_public_key(public_key_pem()),
+    )
+
+
+def public_key_pem():
+    """PEM of our RSA public key, as sent in protocol 2 and 3 handshakes."""
+
+    def load():
+        generate_rsa_keys()
+        return _read(KEY_FILE_PUBLIC)
+
+    return _cached("rsa pem", KEY_FILE_PUBLIC, load)
+
+
+def load_identity_key():
+    def load():
+        generate_keys()
+        return serialization.load_pem_private_key(
+            _read(KEY_FILE_IDENTITY), password=None
+        )
+
+    return _cached("identity", KEY_FILE_IDENTITY, load)
+
+
+def identity_pem():
+    """PEM of our Ed25519 public key, as sent in protocol 4 handshakes."""
+    return _cached(
+        "identity pem",
+        KEY_FILE_IDENTITY,
+        lambda: load_identity_key()
+        .public_key()
+        .public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        ),
+    )
+
+
+def own_fingerprint(version):
+    """Fingerprint of the key we present in a handshake of `version`."""
+    if version >= 4:
+        return _cached(
+            "identity fingerprint",
+            KEY_FILE_IDENTITY,
+            lambda: key_fingerprint(identity_pem()),
+        )
+    return _cached(
+        "rsa fingerprint", KEY_FILE_PUBLIC, lambda: key_fingerprint(public_key_pem())
+    )
 
 
 def encrypt_aes_key(aes_key, public_key):
@@ -141,296 +386,2584 @@ def decrypt_aes_key(enc_key, private_key):
     )
 
 
+def sign_handshake(private_key, data):
+    return private_key.sign(
+        data,
+        asymmetric_padding.PSS(
+            mgf=asymmetric_padding.MGF1(hashes.SHA256()),
+            salt_length=asymmetric_padding.PSS.MAX_LENGTH,
+        ),
+        hashes.SHA256(),
+    )
+
+
+def verify_handshake(public_key, signature, data):
+    try:
+        public_key.verify(
+            signature,
+            data,
+            asymmetric_padding.PSS(
+                mgf=asymmetric_padding.MGF1(hashes.SHA256()),
+                salt_length=asymmetric_padding.PSS.MAX_LENGTH,
+            ),
+            hashes.SHA256(),
+        )
+    except InvalidSignature:
+        raise ConnectionError("Sender key signature is invalid") from None
+
+
+def load_identity_public_key(pem_data, whose):
+    try:
+        public_key = serialization.load_pem_public_key(pem_data)
+    except ValueError:
+        public_key = None
+    if not isinstance(public_key, ed25519.Ed25519PublicKey):
+        raise ConnectionError(f"{whose} identity key is not an Ed25519 key")
+    return public_key
+
+
+def verify_identity(public_key, signature, data, whose):
+    try:
+        public_key.verify(signature, data)
+    except InvalidSignature:
+        raise ConnectionError(f"{whose} key signature is invalid") from None
+
+
+def ecdh_transcript(receiver_identity, receiver_share, sender_identity, sender_share):
+    """Digest of a protocol 4 handshake, signed by both sides."""
+    digest = hashlib.sha256(b"LANCryptor ECDH handshake")
+    for part in (receiver_identity, receiver_share, sender_identity, sender_share):
+        digest.update(struct.pack("I", len(part)) + part)
+    return digest.digest()
+
+
+def ecdh_master_key(private_share, peer_share, transcript):
+    """Session key from our ephemeral X25519 key and the peer's public share."""
+    try:
+        peer = x25519.X25519PublicKey.from_public_bytes(peer_share)
+        shared = private_share.exchange(peer)
+    except ValueError:
+        raise ConnectionError("Invalid key share") from None
+    return derive_secret(
+        shared, b"LANCryptor ECDH session", transcript, AES_KEY_SIZE + 16
+    )
+
+
+def ecdh_share():
+    """Return a fresh X25519 private key and its raw public share."""
+    private_share = x25519.X25519PrivateKey.generate()
+    share = private_share.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+    return private_share, share
+
+
+def key_fingerprint(pem_data):
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(pem_data)
+    return digest.finalize().hex()
+
+
+def derive_secret(key, info, salt=None, length=AES_KEY_SIZE):
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(
+        key
+    )
+
+
+def resumed_master_key(secret, client_nonce, server_nonce):
+    return derive_secret(
+        secret,
+        b"LANCryptor resumed session",
+        client_nonce + server_nonce,
+        AES_KEY_SIZE + 16,
+    )
+
+
+def resumption_proof(master_key):
+    return hmac.new(master_key, b"resume", "sha256").digest()
+
+
+def blob(data):
+    return struct.pack("I", len(data)) + data
+
+
+def send_blob(sock, data):
+    sock.sendall(blob(data))
+
+
+def recv_blob(sock, limit=MAX_HANDSHAKE_BLOB):
+    length = struct.unpack("I", recv_exact(sock, 4))[0]
+    if length > limit:
+        raise ConnectionError(f"Handshake message too large: {length} bytes")
+    return recv_exact(sock, length)
+
+
 def create_cipher(key, iv):
     return Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
 
 
-def compress_file(filepath):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        zip_file.write(filepath, os.path.basename(filepath))
-    return zip_buffer.getvalue()
+def compress_file(filepath, start=0, end=None, level=-1):
+    """Yield (bytes_read, deflated_data) pairs for filepath[start:end] in chunks.
+
+    The whole file is never held in memory; deflated output is produced as
+    soon as zlib has enough input, so the sender can start writing right away.
+    """
+    compressor = zlib.compressobj(level)
+    if end is None:
+        end = os.path.getsize(filepath)
+    for chunk in file_views(filepath, start, end, BUFFER_SIZE):
+        yield len(chunk), compressor.compress(chunk)
+    yield 0, compressor.flush()
+
+
+def decompress_file(decompressor, data, out):
+    """Inflate data into the file object out, BUFFER_SIZE bytes at a time.
+
+    Bounding each decompress call keeps memory flat even for payloads that
+    expand enormously.
+    """
+    written = 0
+    while data:
+        chunk = decompressor.decompress(data, BUFFER_SIZE)
+        out.write(chunk)
+        written += len(chunk)
+        data = decompressor.unconsumed_tail
+    return written
+
+
+def partial_path(transfer_id, suffix):
+    return os.path.join(RECEIVED_DIR, PARTIAL_DIR, transfer_id.hex() + suffix)
+
+
+def commit_received_file(part_path, filename):
+    """Move a verified part file into RECEIVED_DIR (see storage.commit)."""
+    path = os.path.join(RECEIVED_DIR, os.path.basename(filename))
+    return storage.commit(part_path, path)
+
+
+def entry_parts(name):
+    """Split a "/"-separated name from a peer into path components.
+
+    Raises ConnectionError for names that would leave RECEIVED_DIR or land
+    in its own PARTIAL_DIR or CHUNK_DIR (compared the way Windows and
+    macOS filesystems would: ignoring case and trailing dots and spaces).
+    """
+    parts = name.split("/")
+    if parts[0].rstrip(". ").lower() in (PARTIAL_DIR, CHUNK_DIR) or any(
+        part in ("", ".", "..") or "\\" in part or ":" in part or "\x00" in part
+        for part in parts
+    ):
+        raise ConnectionError(f"Unsafe file name: {name!r}")
+    return parts
+
+
+def entry_path(name):
+    """Map a batch entry name onto a path inside RECEIVED_DIR (see entry_parts)."""
+    return os.path.join(RECEIVED_DIR, *entry_parts(name))
+
+
+def collect_entries(paths):
+    """Return (path, name, size) for every file in `paths`, walking directories.
+
+    Names are relative and "/"-separated; files under a directory keep the
+    directory's own name as their first component.
+    """
+    entries = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            base = os.path.dirname(path)
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    full = os.path.join(root, filename)
+                    name = os.path.relpath(full, base).replace(os.sep, "/")
+                    entries.append((full, name, os.path.getsize(full)))
+        elif os.path.isfile(path):
+            entries.append((path, os.path.basename(path), os.path.getsize(path)))
+        else:
+            raise FileNotFoundError(f"File '{path}' does not exist.")
+    for _, name, _ in entries:
+        if len(name.encode()) > MAX_ENTRY_NAME:
+            raise ValueError(f"Path is too long to send: {name}")
+    return entries
+
+
+def send_frame(sock, data):
+    if SEND_LIMIT:
+        SEND_LIMIT.consume(FRAME_HEADER.size + len(data))
+    sock.sendall(FRAME_HEADER.pack(len(data)))
+    if data:
+        sock.sendall(data)
+
+
+def open_frame_reader(sock):
+    return FrameReader(sock, RECV_POOL, FRAME_HEADER)
+
+
+def derive_stream_key(master_key, index, salt=b""):
+    """Derive the AES key and IV used by stream `index` of a transfer.
+
+    Every reconnect of a stream sends a fresh salt so resumed chunks never
+    reuse a nonce under the same key.
+    """
+    material = HKDF(
+        algorithm=hashes.SHA256(),
+        length=AES_KEY_SIZE + 16,
+        salt=salt or None,
+        info=b"LANCryptor stream " + struct.pack("B", index),
+    ).derive(master_key)
+    return material[:AES_KEY_SIZE], material[AES_KEY_SIZE:]
+
+
+def transfer_key(master_key, transfer_id, version):
+    """Key a file transfer's streams and joins are derived from.
+
+    From protocol 3 on it is derived from the session's master key, so the
+    key kept in a resumable transfer's manifest reveals neither the master
+    key nor the resumption secret derived from it.
+    """
+    if version < 3:
+        return master_key
+    return derive_secret(master_key, b"LANCryptor transfer " + transfer_id)
+
+
+def join_proof(master_key, transfer_id, index, salt=b""):
+    return hmac.new(
+        master_key, b"join" + transfer_id + struct.pack("B", index) + salt, "sha256"
+    ).digest()
+
+
+def split_ranges(filesize, streams):
+    """Split filesize into `streams` contiguous byte ranges aligned to BUFFER_SIZE."""
+    per_stream = -(-filesize // streams)
+    per_stream = -(-per_stream // BUFFER_SIZE) * BUFFER_SIZE or BUFFER_SIZE
+    return [
+        (min(i * per_stream, filesize), min((i + 1) * per_stream, filesize))
+        for i in range(streams)
+    ]
+
+
+def stream_count(filesize, requested):
+    return max(1, min(requested, MAX_STREAMS, -(-filesize // BUFFER_SIZE)))
+
+
+class IncomingTransfer:
+    """Receiver-side state shared by all streams of one transfer.
+
+    Data is written to a part file under RECEIVED_DIR/.partial. Protocol 3
+    transfers also keep a JSON manifest next to it with the number of bytes
+    of every range that have been verified and written, so a stream can
+    rejoin after a dropped connection, or a receiver restart, and continue
+    from that offset.
+    """
+
+    def __init__(
+        self,
+        transfer_id,
+        version,
+        filename,
+        filesize,
+        streams,
+        key,
+        compression,
+        offsets=None,
+        done=None,
+        on_finish=None,
+        stats=None,
+    ):
+        self.transfer_id = transfer_id
+        self.version = version
+        self.compression = compression
+        self.filename = filename
+        self.filesize = filesize
+        self.streams = streams
+        self.ranges = split_ranges(filesize, streams)
+        self.key = key
+        self.offsets = offsets or [0] * streams
+        self.done = done or [False] * streams
+        self.active = set()
+        self.committed = False
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.part_path = partial_path(transfer_id, ".part")
+        self.manifest_path = partial_path(transfer_id, ".json")
+        self.on_finish = on_finish
+        self.stats = stats
+
+        if offsets is None:
+            os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+            try:
+                with open(self.part_path, "wb") as out:
+                    storage.preallocate(out, filesize)
+            except BaseException:
+                os.remove(self.part_path)
+                raise
+            self.save()
+
+    @property
+    def resumable(self):
+        return self.version >= 3
+
+    @property
+    def received(self):
+        return sum(self.offsets)
+
+    @classmethod
+    def load(cls, transfer_id):
+        """Restore a resumable transfer from its manifest, or return None."""
+        try:
+            with open(partial_path(transfer_id, ".json")) as f:
+                manifest = json.load(f)
+            if not os.path.exists(partial_path(transfer_id, ".part")):
+                return None
+            return cls(
+                transfer_id,
+                manifest["version"],
+                manifest["filename"],
+                manifest["filesize"],
+                manifest["streams"],
+                bytes.fromhex(manifest["key"]),
+                manifest["compression"],
+                manifest["offsets"],
+                manifest["done"],
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self):
+        if not self.resumable:
+            return
+        with self.save_lock:
+            with self.lock:
+                if self.committed:
+                    return
+                manifest = {
+                    "version": self.version,
+                    "filename": self.filename,
+                    "filesize": self.filesize,
+                    "streams": self.streams,
+                    "compression": self.compression,
+                    "key": self.key.hex(),
+                    "offsets": list(self.offsets),
+                    "done": list(self.done),
+                    "chunk_size": CHUNK_SIZE,
+                    "updated": self.updated,
+                }
+            tmp_path = self.manifest_path + ".tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+
+    def join(self, index):
+        """Claim stream `index`; returns its verified offset or None if busy."""
+        with self.lock:
+            if index >= len(self.ranges) or index in self.active:
+                return None
+            self.active.add(index)
+            self.updated = time.time()
+            return self.offsets[index]
+
+    def advance(self, index, count):
+        with self.lock:
+            self.offsets[index] += count
+            self.updated = time.time()
+            return sum(self.offsets)
+
+    def release(self, index, ok):
+        """Give stream `index` back; True for the caller that completed the file."""
+        with self.lock:
+            self.active.discard(index)
+            self.updated = time.time()
+            if ok:
+                self.done[index] = True
+            completed = all(self.done) and not self.committed
+            if completed:
+                self.committed = True
+        if not completed:
+            self.save()
+        return completed
+
+    def finish(self):
+        """Run on_finish once, when the transfer leaves pending_transfers."""
+        with self.lock:
+            on_finish, self.on_finish = self.on_finish, None
+        if on_finish:
+            on_finish()
+        if self.stats:
+            self.stats.finish(self.committed)
+
+    def discard(self):
+        with self.save_lock:
+            for path in (self.part_path, self.manifest_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def find_transfer(transfer_id):
+    """Look up a transfer in memory, falling back to a manifest on disk."""
+    with pending_transfers_lock:
+        transfer = pending_transfers.get(transfer_id)
+        if transfer is None:
+            transfer = IncomingTransfer.load(transfer_id)
+            if transfer is not None:
+                pending_transfers[transfer_id] = transfer
+        return transfer
+
+
+def forget_transfer(transfer):
+    with pending_transfers_lock:
+        if pending_transfers.get(transfer.transfer_id) is transfer:
+            del pending_transfers[transfer.transfer_id]
+    transfer.finish()
+
+
+def cleanup_partial_transfers(max_age=None):
+    """Apply the retention policy to abandoned partial transfers.
+
+    Idle transfers are dropped from memory after JOIN_TIMEOUT; protocol 2
+    transfers cannot resume so their data goes too. Part files and manifests
+    untouched for longer than PARTIAL_RETENTION are deleted from disk.
+    """
+    max_age = PARTIAL_RETENTION if max_age is None else max_age
+    now = time.time()
+    with pending_transfers_lock:
+        for transfer_id, transfer in list(pending_transfers.items()):
+            if transfer.active or now - transfer.updated < JOIN_TIMEOUT:
+                continue
+            del pending_transfers[transfer_id]
+            transfer.finish()
+            if not transfer.resumable:
+                transfer.discard()
+        active = {transfer_id.hex() for transfer_id in pending_transfers}
+
+    partial_dir = os.path.join(RECEIVED_DIR, PARTIAL_DIR)
+    if not os.path.isdir(partial_dir):
+        return
+    for name in os.listdir(partial_dir):
+        path = os.path.join(partial_dir, name)
+        if name.split(".")[0] in active:
+            continue
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                logging.info(f"Removed abandoned partial transfer file {name}")
+        except OSError:
+            logging.exception(f"Could not clean up {path}")
+
 
+def send_range_cbc(
+    sock, filepath, start, end, key, iv, on_progress, stop_event, level=-1, stats=None
+):
+    """Send bytes [start, end) of filepath as one CBC stream (protocol 2)."""
+    stats = stats or metrics.NO_METRICS
+    encryptor = create_cipher(key, iv).encryptor()
+    padder = padding.PKCS7(128).padder()
+    digest = hashes.Hash(hashes.SHA256())
+
+    chunks = compress_file(filepath, start, end, level)
+    while True:
+        with stats.stage("compress"):
+            read, compressed = next(chunks, (None, None))
+        if compressed is None:
+            break
+        stats.add("compress", 0, read)
+        if stop_event and stop_event.is_set():
+            return False
+        with stats.stage("hash", len(compressed)):
+            digest.update(compressed)
+        with stats.stage("encrypt", len(compressed)):
+            encrypted = encryptor.update(padder.update(compressed))
+        if encrypted:
+            with stats.stage("network", len(encrypted)):
+                send_frame(sock, encrypted)
+        on_progress(read)
+
+    with stats.stage("network"):
+        send_frame(sock, encryptor.update(padder.finalize()) + encryptor.finalize())
+        send_frame(sock, b"")
+
+    range_hash = digest.finalize()
+    sock.sendall(range_hash)
+    logging.info(f"Sent range {start}-{end} hash: {range_hash.hex()}")
+    return True
+
+
+def receive_range_cbc(conn, transfer, index, key, iv, on_progress):
+    """Receive one CBC stream's range into the part file and verify it."""
+    start, end = transfer.ranges[index]
+    decryptor = create_cipher(key, iv).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    decompressor = zlib.decompressobj()
+    digest = hashes.Hash(hashes.SHA256())
+
+    # Decrypt, hash and inflate straight to disk at this range's offset
+    stats = transfer.stats or metrics.NO_METRICS
+    written = 0
+    with open(transfer.part_path, "r+b") as out, open_frame_reader(conn) as reader:
+        out.seek(start)
+        while True:
+            with stats.stage("network"):
+                frame = reader.read()
+            if not frame:
+                break
+            stats.add("network", 0, len(frame))
+            with stats.stage("decrypt", len(frame)):
+                size = decryptor.update_into(frame, reader.scratch)
+                compressed = unpadder.update(reader.scratch_view[:size])
+            with stats.stage("verify", len(compressed)):
+                digest.update(compressed)
+            with stats.stage("decompress", len(compressed)):
+                count = decompress_file(decompressor, compressed, out)
+            written += count
+            if written > end - start:
+                raise ConnectionError("Stream overran its byte range")
+            on_progress(count)
+        compressed = unpadder.update(decryptor.finalize()) + unpadder.finalize()
+        digest.update(compressed)
+        written += decompress_file(decompressor, compressed, out)
+        written += out.write(decompressor.flush())
+
+    expected_hash = recv_exact(conn, 32)
+    actual_hash = digest.finalize()
+
+    logging.info(f"Range {start}-{end} expected hash: {expected_hash.hex()}")
+    logging.info(f"Range {start}-{end} actual hash:   {actual_hash.hex()}")
+
+    return actual_hash == expected_hash and decompressor.eof and written == end - start
+
+
+def crypto_pool():
+    """Shared worker pool for chunk encryption; cryptography releases the GIL."""
+    global _crypto_pool
+    with _crypto_pool_lock:
+        if _crypto_pool is None:
+            _crypto_pool = ThreadPoolExecutor(
+                max_workers=CRYPTO_WORKERS, thread_name_prefix="lancryptor-crypto"
+            )
+        return _crypto_pool
 
-def decompress_file(zip_data):
-    with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
-        zip_file.extractall(RECEIVED_DIR)
 
+def chunk_nonce(iv, counter):
+    return iv[:4] + struct.pack(">Q", counter)
 
-def confirm_receiver(pubkey_hash: str, cli: bool) -> bool:
-    global confirmation_result
 
-    if cli:
-        print("\nIncoming connection request.")
-        print(f"Sender public key hash:\n  {pubkey_hash}")
+def seal_chunk(aead, iv, counter, data, last):
+    """Seal one chunk; the frame is a last-chunk flag followed by ciphertext+tag."""
+    flag = struct.pack("B", last)
+    return flag + aead.encrypt(
+        chunk_nonce(iv, counter), data, struct.pack(">Q", counter) + flag
+    )
+
+
+def open_chunk(aead, iv, counter, frame):
+    """Authenticate and decrypt one sealed frame, returning (last, plaintext)."""
+    flag = frame[:1]
+    try:
+        data = aead.decrypt(
+            chunk_nonce(iv, counter), frame[1:], struct.pack(">Q", counter) + flag
+        )
+    except InvalidTag:
+        raise ConnectionError(f"Chunk {counter} failed authentication") from None
+    return flag[0] == 1, data
+
+
+def read_chunks(filepath, start, end, size=CHUNK_SIZE):
+    """Yield raw views of filepath[start:end] (see file_views)."""
+    return file_views(filepath, start, end, size)
+
+
+# A chunk compressed once and shared by several streams (see SharedChunks)
+Precompressed = collections.namedtuple(
+    "Precompressed", "method payload raw_size packed_size level"
+)
+
+
+def pack_chunk(aead, iv, counter, chunk, level, last, control=False, stats=None):
+    """Compress (when worthwhile) and seal one chunk on a worker thread."""
+    stats = stats or metrics.NO_METRICS
+    if control:
+        return seal_chunk(aead, iv, counter, CONTROL_RECORD + chunk, last), len(chunk)
+    if isinstance(chunk, Precompressed):
+        with stats.stage("encrypt", len(chunk.payload)):
+            plaintext = struct.pack("B", chunk.method) + chunk.payload
+            frame = seal_chunk(aead, iv, counter, plaintext, last)
+        return frame, chunk.packed_size
+    started = time.perf_counter()
+    method, payload, packed_size = compress_chunk(chunk, level)
+    sealing = time.perf_counter()
+    frame = seal_chunk(aead, iv, counter, struct.pack("B", method) + payload, last)
+    if level is not None:
+        stats.add("compress", sealing - started, len(chunk))
+    stats.add("encrypt", time.perf_counter() - sealing, len(payload))
+    return frame, packed_size
+
+
+def unpack_chunk(aead, iv, counter, frame, allow_deflate, stats=None):
+    """Open and inflate one chunk on a worker thread.
+
+    Returns (last, control, data) where `control` marks a control record.
+    """
+    stats = stats or metrics.NO_METRICS
+    with stats.stage("decrypt", len(frame)):
+        last, plaintext = open_chunk(aead, iv, counter, frame)
+    if not plaintext:
+        return last, False, b""
+    method = plaintext[0]
+    if plaintext[:1] == CONTROL_RECORD:
+        return last, True, plaintext[1:]
+    if method != STORED and not allow_deflate:
+        raise ConnectionError(f"Chunk {counter} is compressed in a stored transfer")
+    try:
+        with stats.stage("decompress", len(plaintext) - 1):
+            data = decompress_chunk(method, plaintext[1:], MAX_CHUNK_SIZE)
+            return last, False, data
+    except ValueError as e:
+        raise ConnectionError(f"Chunk {counter}: {e}") from None
+
+
+def send_chunks(
+    sock, records, key, iv, on_progress, stop_event, compressor, stats=None
+):
+    """Seal and send (data, control) records, then the final chunk.
+
+    File data is compressed at the level picked by `compressor` and sealed
+    on the crypto pool while earlier chunks are being written, keeping at
+    most AEAD_WINDOW chunks in flight. Control records and Precompressed
+    chunks are sealed as they are.
+    """
+    stats = stats or metrics.NO_METRICS
+    aead = AESGCM(key)
+    pool = crypto_pool()
+    pending = collections.deque()
+    records = iter(records)
+    counter = 0
+    # Frame headers are separate small writes; let Nagle merge them with data
+    tuning.nodelay(sock, False)
+
+    def drain(limit):
+        while len(pending) > limit:
+            future, raw_size, level = pending.popleft()
+            frame, packed_size = future.result()
+            with stats.stage("network", len(frame)):
+                send_frame(sock, frame)
+            compressor.record(raw_size, packed_size, level)
+            on_progress(raw_size)
+
+    try:
+        while True:
+            with stats.stage("read"):
+                record = next(records, None)
+            if record is None:
+                break
+            chunk, control = record
+            if stop_event and stop_event.is_set():
+                return False
+            shared = isinstance(chunk, Precompressed)
+            level = None if control or shared else compressor.choose()
+            raw_size = 0
+            if not control:
+                raw_size = chunk.raw_size if shared else len(chunk)
+                stats.add("read", 0, raw_size)
+            future = pool.submit(
+                pack_chunk, aead, iv, counter, chunk, level, False, control, stats
+            )
+            # Shared chunks were already fed back to their own compressor
+            pending.append((future, raw_size, None if shared else level))
+            counter += 1
+            drain(AEAD_WINDOW)
+        future = pool.submit(pack_chunk, aead, iv, counter, b"", None, True)
+        pending.append((future, 0, None))
+        drain(0)
+    finally:
+        for future, _, _ in pending:
+            future.cancel()
+
+    send_frame(sock, b"")
+    tuning.nodelay(sock, True)
+    return True
+
+
+def receive_chunks(conn, key, iv, allow_deflate, stats=None):
+    """Yield (control, data) for every chunk of a sealed stream, in order.
+
+    Chunks are opened and inflated in parallel on the crypto pool, up to
+    AEAD_WINDOW ahead of the consumer. Raises ConnectionError if a chunk
+    fails authentication or the stream ends before its final chunk.
+    """
+    stats = stats or metrics.NO_METRICS
+    aead = AESGCM(key)
+    pool = crypto_pool()
+    pending = collections.deque()
+    counter = 0
+    last = False
+
+    def drain(limit):
+        nonlocal last
+        while len(pending) > limit:
+            future, buf = pending.popleft()
+            try:
+                chunk_last, control, data = future.result()
+            finally:
+                RECV_POOL.release(buf)
+            if last:
+                raise ConnectionError("Data received after the final chunk")
+            last = chunk_last
+            if control or data:
+                yield control, data
+
+    with open_frame_reader(conn) as reader:
+        try:
+            while True:
+                buf = RECV_POOL.acquire()
+                with stats.stage("network"):
+                    frame = reader.read_into(buf)
+                if not frame:
+                    RECV_POOL.release(buf)
+                    break
+                stats.add("network", 0, len(frame))
+                future = pool.submit(
+                    unpack_chunk, aead, iv, counter, frame, allow_deflate, stats
+                )
+                pending.append((future, buf))
+                counter += 1
+                yield from drain(AEAD_WINDOW)
+            yield from drain(0)
+        finally:
+            for future, buf in pending:
+                if future.cancel():
+                    RECV_POOL.release(buf)
+
+    if not last:
+        raise ConnectionError("Stream ended before its final chunk")
+
+
+class SharedChunks:
+    """Read and compress a file once for several protocol 3 streams.
+
+    Chunks are compressed on the crypto pool as the fastest reader asks for
+    them, at most FANOUT_READ_AHEAD ahead of it, and the last FANOUT_BUFFER
+    are kept for the others. Nobody waits for a slow reader: one that falls
+    out of the buffer (or resumes from before it) reads and compresses the
+    rest of the file itself. The merkle leaf digests of the file are
+    computed once from the chunks read here, for every stream (see
+    `leaf`).
+    """
+
+    def __init__(self, filepath, compression="auto"):
+        self.filepath = filepath
+        self.size = os.path.getsize(filepath)
+        self.count = -(-self.size // CHUNK_SIZE)
+        initial_ratio = estimate_ratio(filepath) if compression == "auto" else None
+        self.compressor = AdaptiveCompressor(compression, initial_ratio)
+        self.chunks = {}
+        self.produced = 0
+        # Leaf index -> future of its digest; leaves are only 32 bytes each
+        self.leaves = {}
+        self._leaf_parts = []
+        # Open until close(), for as long as any stream may still read
+        with contextlib.ExitStack() as files:
+            self._file = files.enter_context(open(filepath, "rb"))
+            self._files = files.pop_all()
+        self._lock = threading.Lock()
+
+    @property
+    def ratio(self):
+        return self.compressor.ratio
+
+    def _compress(self, data, level):
+        method, payload, packed_size = compress_chunk(data, level)
+        self.compressor.record(len(data), packed_size, level)
+        return Precompressed(method, payload, len(data), packed_size, level)
+
+    def get(self, index):
+        """Return chunk `index` as Precompressed, or None if it was dropped."""
+        with self._lock:
+            target = min(index + FANOUT_READ_AHEAD, self.count)
+            while self.produced < target:
+                # Chunks are read in order under the lock (no os.pread on Windows)
+                self._file.seek(self.produced * CHUNK_SIZE)
+                data = self._file.read(CHUNK_SIZE)
+                level = self.compressor.choose()
+                self.chunks[self.produced] = crypto_pool().submit(
+                    self._compress, data, level
+                )
+                self.chunks.pop(self.produced - FANOUT_BUFFER, None)
+                self.produced += 1
+                self._hash_leaf(data)
+            future = self.chunks.get(index)
+        return future.result() if future else None
+
+    def _hash_leaf(self, data):
+        # CHUNK_SIZE divides LEAF_SIZE, so leaves end on chunk boundaries
+        self._leaf_parts.append(data)
+        end = self.produced * CHUNK_SIZE
+        if end % merkle.LEAF_SIZE == 0 or self.produced == self.count:
+            leaf = (end - 1) // merkle.LEAF_SIZE
+            self.leaves[leaf] = merkle.hash_pool().submit(
+                merkle.hash_leaf, *self._leaf_parts
+            )
+            self._leaf_parts = []
+
+    def leaf(self, first, last):
+        """Future of the digest of bytes [first, last) if that is a leaf here."""
+        leaf, offset = divmod(first, merkle.LEAF_SIZE)
+        if offset or last != min(first + merkle.LEAF_SIZE, self.size):
+            return None
+        with self._lock:
+            return self.leaves.get(leaf)
+
+    def records(self, start, end):
+        """Yield send_chunks records for bytes [start, end) of the file."""
+        index = start // CHUNK_SIZE
+        while start % CHUNK_SIZE == 0 and start < end:
+            chunk = self.get(index)
+            if chunk is None:
+                logging.info(f"Fan-out stream fell behind at {start}, reading alone")
+                break
+            yield chunk, False
+            start += chunk.raw_size
+            index += 1
+        for chunk in read_chunks(self.filepath, start, end):
+            yield chunk, False
+
+    def close(self):
+        self._files.close()
+        self.chunks.clear()
+        self.leaves.clear()
+
+
+def hashed_records(records, hasher, position):
+    """Pass records on while `hasher` hashes the bytes they carry.
+
+    The leaf digests of the whole range follow as control records.
+    """
+    hasher.advance(position)
+    for chunk, control in records:
+        yield chunk, control
+        if control:
+            continue
+        if isinstance(chunk, Precompressed):
+            hasher.update(position, chunk.raw_size)
+            position += chunk.raw_size
+        else:
+            hasher.update(position, len(chunk), chunk)
+            position += len(chunk)
+    digests = hasher.digests()
+    logging.info(
+        f"Sent range {hasher.start}-{hasher.end} root: {merkle.root(digests).hex()}"
+    )
+    for first in range(0, len(digests), LEAVES_PER_RECORD):
+        leaves = digests[first : first + LEAVES_PER_RECORD]
+        yield LEAF_INDEX.pack(first) + b"".join(leaves), True
+
+
+def send_range_aead(
+    sock,
+    filepath,
+    start,
+    end,
+    key,
+    iv,
+    on_progress,
+    stop_event,
+    compressor,
+    stats=None,
+    source=None,
+    chunk_size=CHUNK_SIZE,
+    hasher=None,
+):
+    """Send bytes [start, end) of filepath as independently sealed AES-GCM chunks.
+
+    With a SharedChunks `source` the chunks come compressed from there;
+    otherwise they are read in pieces of `chunk_size` bytes, which may be a
+    tuning.ChunkSizer. With a merkle.LeafHasher the leaf digests of its
+    range are sent after the data.
+    """
+    if source:
+        records = source.records(start, end)
+    else:
+        chunks = read_chunks(filepath, start, end, chunk_size)
+        records = ((chunk, False) for chunk in chunks)
+    if hasher:
+        records = hashed_records(records, hasher, start)
+    return send_chunks(
+        sock, records, key, iv, on_progress, stop_event, compressor, stats
+    )
+
+
+def receive_range_aead(conn, transfer, index, key, iv, offset, on_progress):
+    """Receive sealed chunks for one range from `offset`, stopping at a bad chunk.
+
+    Progress is flushed and recorded in the transfer manifest every
+    MANIFEST_INTERVAL bytes so an interrupted stream can resume close to
+    where it stopped. Protocol 5 leaves are hashed from the part file as
+    they are completed and checked against the sender's digests at the end
+    (see verify_range).
+    """
+    start, end = transfer.ranges[index]
+    allow_deflate = transfer.compression != "none"
+    stats = transfer.stats or metrics.NO_METRICS
+    written = offset
+    unsaved = 0
+    hasher = announced = None
+    if transfer.version >= 5:
+        hasher = merkle.LeafHasher(transfer.part_path, start, end, stats, "verify")
+        announced = [None] * hasher.count
+
+    try:
+        with open(transfer.part_path, "r+b") as out:
+            out.seek(start + offset)
+            for control, data in receive_chunks(conn, key, iv, allow_deflate, stats):
+                if control:
+                    if hasher is None:
+                        raise ConnectionError(
+                            "Unexpected control record in a file transfer"
+                        )
+                    add_leaf_digests(announced, data)
+                    continue
+                written += len(data)
+                if written > end - start:
+                    raise ConnectionError("Stream overran its byte range")
+                with stats.stage("write", len(data)):
+                    out.write(data)
+                on_progress(len(data))
+                unsaved += len(data)
+                if unsaved >= MANIFEST_INTERVAL:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    transfer.save()
+                    unsaved = 0
+                if hasher and hasher.ready(start + written):
+                    out.flush()
+                    hasher.advance(start + written)
+
+        if written != end - start:
+            return False
+        return hasher is None or verify_range(conn, transfer, key, hasher, announced)
+    finally:
+        if hasher:
+            hasher.close()
+
+
+def add_leaf_digests(announced, record):
+    """Store the digests of a leaf digest record at their leaf indices."""
+    digests = record[LEAF_INDEX.size :]
+    if len(record) < LEAF_INDEX.size or len(digests) % merkle.DIGEST_SIZE:
+        raise ConnectionError("Malformed leaf digest record")
+    first = LEAF_INDEX.unpack_from(record)[0]
+    count = len(digests) // merkle.DIGEST_SIZE
+    if first + count > len(announced):
+        raise ConnectionError("Leaf digests beyond the end of the range")
+    for i in range(count):
+        announced[first + i] = digests[
+            i * merkle.DIGEST_SIZE : (i + 1) * merkle.DIGEST_SIZE
+        ]
+
+
+def repair_key(key, attempt):
+    """Key and IV for a stream's `attempt`th repair, distinct from its own."""
+    material = derive_secret(
+        key, b"LANCryptor repair" + struct.pack("B", attempt), None, AES_KEY_SIZE + 16
+    )
+    return material[:AES_KEY_SIZE], material[AES_KEY_SIZE:]
+
+
+def verify_range(conn, transfer, key, hasher, announced):
+    """Check a received range against the sender's leaf digests.
+
+    Leaves that do not match are requested again and rewritten in place,
+    up to REPAIR_ATTEMPTS times. Returns True once every leaf matches.
+    """
+    if None in announced:
+        raise ConnectionError("Range ended without its leaf digests")
+    ours = hasher.digests()
+    span = f"{hasher.start}-{hasher.end}"
+    for attempt in range(REPAIR_ATTEMPTS + 1):
+        bad = merkle.mismatched(ours, announced)
+        if not bad:
+            logging.info(f"Range {span} root: {merkle.root(ours).hex()}")
+            return True
+        first = merkle.leaf_span(hasher.start, hasher.end, bad[0])[0]
+        logging.warning(
+            f"Range {span}: {len(bad)} of {hasher.count} leaves do not match,"
+            f" first at byte {first}"
+        )
+        if attempt == REPAIR_ATTEMPTS:
+            return False
+        conn.sendall(
+            RANGE_REPAIR
+            + LEAF_INDEX.pack(len(bad))
+            + b"".join(LEAF_INDEX.pack(leaf) for leaf in bad)
+        )
+        receive_repair(conn, transfer, hasher, bad, *repair_key(key, attempt))
+        for leaf, digest in zip(bad, hasher.rehash(bad)):
+            ours[leaf] = digest
+
+
+def receive_repair(conn, transfer, hasher, leaves, key, iv):
+    """Write leaves the sender sent again over their place in the part file."""
+    allow_deflate = transfer.compression != "none"
+    requested = set(leaves)
+    position = last = None
+    with open(transfer.part_path, "r+b") as out:
+        for control, data in receive_chunks(
+            conn, key, iv, allow_deflate, transfer.stats
+        ):
+            if control:
+                leaf = (
+                    LEAF_INDEX.unpack(data)[0] if len(data) == LEAF_INDEX.size else None
+                )
+                if leaf not in requested:
+                    raise ConnectionError("Repair sent a leaf that was not requested")
+                position, last = merkle.leaf_span(hasher.start, hasher.end, leaf)
+                out.seek(position)
+                continue
+            if position is None or position + len(data) > last:
+                raise ConnectionError("Repair data outside its leaf")
+            out.write(data)
+            position += len(data)
+
+
+def repair_records(filepath, start, end, leaves):
+    """Yield send_chunks records resending `leaves` of range [start, end)."""
+    for leaf in leaves:
+        first, last = merkle.leaf_span(start, end, leaf)
+        yield LEAF_INDEX.pack(leaf), True
+        for chunk in read_chunks(filepath, first, last):
+            yield chunk, False
+
+
+def confirm_range(conn, filepath, start, end, key, stop_event=None, stats=None):
+    """Wait for the receiver to verify a range, resending leaves it asks for.
+
+    Returns True once the receiver has confirmed the range.
+    """
+    count = merkle.leaf_count(end - start)
+    for attempt in range(REPAIR_ATTEMPTS + 1):
+        with tuning.waiting(conn, tuning.VERIFY_TIMEOUT):
+            reply = recv_exact(conn, 1)
+        if reply != RANGE_REPAIR:
+            return reply == b"\x01"
+        requested = LEAF_INDEX.unpack(recv_exact(conn, LEAF_INDEX.size))[0]
+        if requested > count:
+            raise ConnectionError("Receiver asked for leaves outside the range")
+        leaves = struct.unpack(
+            f"{requested}I", recv_exact(conn, requested * LEAF_INDEX.size)
+        )
+        if any(leaf >= count for leaf in leaves):
+            raise ConnectionError("Receiver asked for leaves outside the range")
+        logging.warning(f"Sending {requested} leaves of range {start}-{end} again")
+        if not send_chunks(
+            conn,
+            repair_records(filepath, start, end, leaves),
+            *repair_key(key, attempt),
+            lambda count: None,
+            stop_event,
+            AdaptiveCompressor("none"),
+            stats,
+        ):
+            return False
+    return False
+
+
+def send_range(
+    sock,
+    version,
+    filepath,
+    start,
+    end,
+    key,
+    iv,
+    on_progress,
+    stop_event,
+    compression="auto",
+    initial_ratio=None,
+    stats=None,
+    source=None,
+    range_start=None,
+):
+    """Send one byte range using the framing of the negotiated protocol version.
+
+    Protocol 4 chunks grow with the measured throughput; the parameters the
+    range ran with are logged and added to `stats` (see tuning.report).
+    Protocol 5 also sends the leaf digests of the whole range, which starts
+    at `range_start` when a stream resumes at `start`.
+    """
+    if version >= 3:
+        compressor = AdaptiveCompressor(compression, initial_ratio)
+        sizer = tuning.ChunkSizer(
+            CHUNK_SIZE,
+            MAX_CHUNK_SIZE if version >= 4 and not source else CHUNK_SIZE,
+            sock,
+        )
+        hasher = None
+        if version >= 5:
+            first = start if range_start is None else range_start
+            known = source.leaf if source else None
+            hasher = merkle.LeafHasher(filepath, first, end, stats, known=known)
+        try:
+            ok = send_range_aead(
+                sock,
+                filepath,
+                start,
+                end,
+                key,
+                iv,
+                on_progress,
+                stop_event,
+                compressor,
+                stats,
+                source,
+                sizer,
+                hasher,
+            )
+        finally:
+            if hasher:
+                hasher.close()
+        tuning.report(sock, sizer, stats, f"range {start}-{end} to")
+        return ok
+    tuning.report(sock, None, stats, f"range {start}-{end} to")
+    return send_range_cbc(
+        sock,
+        filepath,
+        start,
+        end,
+        key,
+        iv,
+        on_progress,
+        stop_event,
+        STREAM_LEVELS[compression],
+        stats,
+    )
+
+
+def receive_range(conn, transfer, index, key, iv, offset, on_progress):
+    if transfer.version >= 3:
+        return receive_range_aead(conn, transfer, index, key, iv, offset, on_progress)
+    return receive_range_cbc(conn, transfer, index, key, iv, on_progress)
+
+
+def batch_records(entries):
+    """Yield an entry header followed by the data chunks of every entry."""
+    for path, name, size in entries:
+        yield ENTRY_HEADER.pack(size) + name.encode(), True
+        sent = 0
+        for chunk in read_chunks(path, 0, size):
+            sent += len(chunk)
+            yield chunk, False
+        if sent != size:
+            raise ValueError(f"{name} changed while it was being sent")
+
+
+def receive_batch(conn, master_key, compression, on_progress, stats=None):
+    """Receive the entries of a batch into RECEIVED_DIR and return their count.
+
+    Each entry is written to a hidden temporary file beside its destination
+    and renamed into place once all of its bytes have arrived.
+    """
+    stats = stats or metrics.NO_METRICS
+    key, iv = derive_stream_key(master_key, 0)
+    count = 0
+    out = tmp_path = path = None
+    remaining = 0
+
+    def finish_entry():
+        nonlocal out, count
+        if out is None:
+            return
+        out.close()
+        out = None
+        if remaining:
+            os.remove(tmp_path)
+            raise ConnectionError(f"Entry {path} ended {remaining} bytes short")
+        storage.commit(tmp_path, path)
+        count += 1
+
+    try:
+        records = receive_chunks(conn, key, iv, compression != "none", stats)
+        for control, data in records:
+            if not control:
+                if out is None or len(data) > remaining:
+                    raise ConnectionError("Batch data does not match its entry")
+                with stats.stage("write", len(data)):
+                    out.write(data)
+                remaining -= len(data)
+                on_progress(len(data))
+                continue
+            finish_entry()
+            if len(data) <= ENTRY_HEADER.size:
+                raise ConnectionError("Malformed batch entry header")
+            remaining = ENTRY_HEADER.unpack_from(data)[0]
+            path = entry_path(bytes(data[ENTRY_HEADER.size :]).decode())
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), prefix=".", suffix=".part"
+            )
+            out = os.fdopen(fd, "wb")
+            storage.preallocate(out, remaining)
+        finish_entry()
+    finally:
+        if out is not None:
+            out.close()
+            os.remove(tmp_path)
+    return count
+
+
+def side_stream_key(master_key, purpose):
+    """Key and IV for auxiliary sealed streams such as delta signatures."""
+    material = derive_secret(
+        master_key, b"LANCryptor " + purpose, length=AES_KEY_SIZE + 16
+    )
+    return material[:AES_KEY_SIZE], material[AES_KEY_SIZE:]
+
+
+def send_blob_sealed(sock, blob, key, iv):
+    """Send a byte string of any size as a stored, sealed chunk stream."""
+    pieces = (
+        (blob[i : i + CHUNK_SIZE], False) for i in range(0, len(blob), CHUNK_SIZE)
+    )
+    send_chunks(
+        sock, pieces, key, iv, lambda count: None, None, AdaptiveCompressor("none")
+    )
+
+
+def receive_blob_sealed(sock, key, iv):
+    parts = []
+    for control, data in receive_chunks(sock, key, iv, allow_deflate=False):
+        if control:
+            raise ConnectionError("Unexpected control record")
+        parts.append(bytes(data))
+    return b"".join(parts)
+
+
+def send_delta(
+    sock, master_key, filepath, on_progress, stop_event, compressor, stats=None
+):
+    """Send filepath as changes against the receiver's existing copy.
+
+    The receiver first sends the block signature of its copy. Literal data
+    is then sent as ordinary chunks and matching blocks as copy instructions
+    in control records, ending with the SHA-256 of the whole file.
+    Returns the number of literal bytes sent, or None if stopped.
+    """
+    key, iv = side_stream_key(master_key, b"delta signature")
+    # The receiver reads its whole copy before it answers
+    with tuning.waiting(sock, tuning.VERIFY_TIMEOUT):
+        signature = receive_blob_sealed(sock, key, iv)
+    try:
+        block_size, _, table = delta.parse_signature(signature)
+    except ValueError as e:
+        raise ConnectionError(str(e)) from None
+
+    literal = 0
+
+    def records():
+        nonlocal literal
+        for op in delta.delta_ops(filepath, block_size, table):
+            if op[0] == "data":
+                literal += len(op[1])
+                yield op[1], False
+            elif op[0] == "copy":
+                on_progress(op[2] * block_size)
+                yield delta.OP_COPY + delta.COPY_OP.pack(op[1], op[2]), True
+            else:
+                yield delta.OP_DIGEST + op[1], True
+
+    key, iv = derive_stream_key(master_key, 0)
+    if not send_chunks(
+        sock, records(), key, iv, on_progress, stop_event, compressor, stats
+    ):
+        return None
+    return literal
+
+
+def receive_delta(
+    conn, master_key, filename, filesize, compression, on_progress, stats=None
+):
+    """Rebuild `filename` from the copy in RECEIVED_DIR and a delta stream.
+
+    The result is assembled in the partial directory and only replaces the
+    existing copy once its SHA-256 matches the sender's.
+    """
+    stats = stats or metrics.NO_METRICS
+    basis_path = os.path.join(RECEIVED_DIR, os.path.basename(filename))
+    with stats.stage("hash"):
+        signature = delta.file_signature(basis_path)
+    block_size, block_count = delta.SIGNATURE_HEADER.unpack_from(signature)
+    key, iv = side_stream_key(master_key, b"delta signature")
+    send_blob_sealed(conn, signature, key, iv)
+
+    partial_dir = os.path.join(RECEIVED_DIR, PARTIAL_DIR)
+    os.makedirs(partial_dir, exist_ok=True)
+    fd, part_path = tempfile.mkstemp(dir=partial_dir, suffix=".part")
+    digest = hashlib.sha256()
+    written = 0
+    verified = False
+    try:
+        with os.fdopen(fd, "wb") as out, contextlib.ExitStack() as files:
+            basis = None
+            if block_count:
+                basis = files.enter_context(open(basis_path, "rb"))
+            storage.preallocate(out, filesize)
+
+            def write(data):
+                nonlocal written
+                written += len(data)
+                if written > filesize:
+                    raise ConnectionError("Delta produced more data than announced")
+                with stats.stage("verify", len(data)):
+                    digest.update(data)
+                with stats.stage("write", len(data)):
+                    out.write(data)
+                on_progress(len(data))
+
+            key, iv = derive_stream_key(master_key, 0)
+            records = receive_chunks(conn, key, iv, compression != "none", stats)
+            for control, data in records:
+                if verified:
+                    raise ConnectionError("Delta continued after its digest")
+                if not control:
+                    write(data)
+                    continue
+                op, body = data[:1], data[1:]
+                if op == delta.OP_COPY and len(body) == delta.COPY_OP.size:
+                    index, blocks = delta.COPY_OP.unpack(body)
+                    if index + blocks > block_count:
+                        raise ConnectionError("Delta copies blocks that do not exist")
+                    basis.seek(index * block_size)
+                    remaining = blocks * block_size
+                    while remaining:
+                        piece = basis.read(min(remaining, MAX_FRAME_SIZE))
+                        if not piece:
+                            raise ConnectionError("Existing copy changed during delta")
+                        write(piece)
+                        remaining -= len(piece)
+                elif op == delta.OP_DIGEST:
+                    if written != filesize or not hmac.compare_digest(
+                        body, digest.digest()
+                    ):
+                        raise ConnectionError("Delta result does not match the file")
+                    verified = True
+                else:
+                    raise ConnectionError("Malformed delta instruction")
+        if not verified:
+            raise ConnectionError("Delta ended without a digest")
+        commit_received_file(part_path, filename)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+
+def chunk_store():
+    """The receiver's chunk store, opened on first use."""
+    global _chunk_store
+    with _chunk_store_lock:
+        if _chunk_store is None:
+            _chunk_store = chunkstore.ChunkStore(os.path.join(RECEIVED_DIR, CHUNK_DIR))
+        return _chunk_store
+
+
+def send_dedup(
+    sock, master_key, filepath, on_progress, stop_event, compressor, stats=None
+):
+    """Send filepath as content-defined chunks, skipping those already stored.
+
+    The sender announces the digest and length of every chunk; the receiver
+    answers with a bitmap of the chunks it still needs, and only those are
+    sent. Returns the number of chunk bytes sent, or None if stopped.
+    """
+    stats = stats or metrics.NO_METRICS
+    with stats.stage("hash", os.path.getsize(filepath)):
+        chunks = list(chunkstore.file_chunks(filepath))
+    manifest = b"".join(
+        MANIFEST_ENTRY.pack(digest, length) for _, length, digest in chunks
+    )
+    key, iv = side_stream_key(master_key, b"dedup manifest")
+    send_blob_sealed(sock, manifest, key, iv)
+    key, iv = side_stream_key(master_key, b"dedup missing")
+    bitmap = receive_blob_sealed(sock, key, iv)
+    if len(bitmap) != (len(chunks) + 7) // 8:
+        raise ConnectionError("Receiver sent a malformed chunk bitmap")
+
+    sent = 0
+
+    def records():
+        nonlocal sent
+        with open(filepath, "rb") as f:
+            for index, (offset, length, digest) in enumerate(chunks):
+                if not bitmap[index >> 3] >> (index & 7) & 1:
+                    on_progress(length)
+                    continue
+                f.seek(offset)
+                data = f.read(length)
+                if chunkstore.chunk_digest(data) != digest:
+                    raise ValueError(f"{filepath} changed while it was being sent")
+                sent += length
+                yield data, False
+
+    key, iv = derive_stream_key(master_key, 0)
+    if not send_chunks(
+        sock, records(), key, iv, on_progress, stop_event, compressor, stats
+    ):
+        return None
+    return sent
+
+
+def receive_dedup(
+    conn, master_key, filename, filesize, compression, on_progress, stats=None
+):
+    """Rebuild `filename` from stored chunks plus the ones the sender sends.
+
+    Every received chunk is checked against its digest and added to the
+    chunk store, so later transfers carrying the same data can skip it.
+    """
+    stats = stats or metrics.NO_METRICS
+    store = chunk_store()
+    key, iv = side_stream_key(master_key, b"dedup manifest")
+    manifest = receive_blob_sealed(conn, key, iv)
+    if len(manifest) % MANIFEST_ENTRY.size:
+        raise ConnectionError("Malformed chunk manifest")
+    entries = list(MANIFEST_ENTRY.iter_unpack(manifest))
+    if sum(length for _, length in entries) != filesize or any(
+        not 0 < length <= chunkstore.MAX_CHUNK for _, length in entries
+    ):
+        raise ConnectionError("Chunk manifest does not match the file size")
+    digests = [digest for digest, _ in entries]
+
+    store.pin(digests)
+    try:
+        # Only the first occurrence of a missing chunk is requested
+        missing = store.missing(digests)
+        bitmap = bytearray((len(entries) + 7) // 8)
+        for index, digest in enumerate(digests):
+            if digest in missing:
+                bitmap[index >> 3] |= 1 << (index & 7)
+                missing.discard(digest)
+        key, iv = side_stream_key(master_key, b"dedup missing")
+        send_blob_sealed(conn, bytes(bitmap), key, iv)
+
+        partial_dir = os.path.join(RECEIVED_DIR, PARTIAL_DIR)
+        os.makedirs(partial_dir, exist_ok=True)
+        fd, part_path = tempfile.mkstemp(dir=partial_dir, suffix=".part")
+        try:
+            key, iv = derive_stream_key(master_key, 0)
+            records = receive_chunks(conn, key, iv, compression != "none", stats)
+            with os.fdopen(fd, "wb") as out:
+                storage.preallocate(out, filesize)
+                for index, (digest, length) in enumerate(entries):
+                    if bitmap[index >> 3] >> (index & 7) & 1:
+                        control, data = next(records, (True, None))
+                        if control:
+                            raise ConnectionError("Chunk stream ended early")
+                        data = bytes(data)
+                        with stats.stage("verify", len(data)):
+                            valid = (
+                                len(data) == length
+                                and chunkstore.chunk_digest(data) == digest
+                            )
+                        if not valid:
+                            raise ConnectionError(f"Chunk {index} failed verification")
+                        with stats.stage("write", length):
+                            store.put(digest, data)
+                    else:
+                        with stats.stage("read", length):
+                            data = store.get(digest)
+                        if data is None:
+                            raise ConnectionError(f"Stored chunk {index} is gone")
+                    with stats.stage("write", length):
+                        out.write(data)
+                    on_progress(length)
+                for _ in records:
+                    raise ConnectionError("Data received after the last chunk")
+            commit_received_file(part_path, filename)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+    finally:
+        store.unpin(digests)
+        store.evict()
+
+
+def confirmation_answer(answer):
+    """Map a UI answer to REJECT, ACCEPT_ONCE or ACCEPT_ALWAYS (True is once)."""
+    if answer in (ACCEPT_ONCE, ACCEPT_ALWAYS):
+        return answer
+    return ACCEPT_ONCE if answer else REJECT
+
+
+class ConfirmationRequest:
+    """A pending decision about the key hash of one connection.
+
+    Requests reach the UI through `confirmation_queue`. Each carries its own
+    future, so concurrent connections never receive each other's answers.
+    `trustable` requests show a sender's key, which may be trusted for good
+    (ACCEPT_ALWAYS) instead of for this connection only.
+    """
+
+    def __init__(self, pubkey_hash, address=None, trustable=False):
+        self.pubkey_hash = pubkey_hash
+        self.address = address
+        self.trustable = trustable
+        self.future = Future()
+        with _open_requests_lock:
+            _open_requests.append(self)
+        self.future.add_done_callback(self._forget)
+
+    def resolve(self, answer):
+        if not self.future.done():
+            self.future.set_result(confirmation_answer(answer))
+
+    def _forget(self, future):
+        with _open_requests_lock:
+            if self in _open_requests:
+                _open_requests.remove(self)
+
+
+def prompt_cli(pubkey_hash, trustable=False):
+    print("\nIncoming connection request.")
+    if not trustable:
+        print(f"Public key hash:\n  {pubkey_hash}")
         while True:
             answer = input("Accept connection? [y/n]: ").strip().lower()
             if answer in ("y", "yes"):
-                return True
+                return ACCEPT_ONCE
             elif answer in ("n", "no"):
-                return False
+                return REJECT
             else:
                 print("Please type 'y' or 'n'.")
-    else:
-        confirmation_queue.put(pubkey_hash)
-        confirmation_event.wait()
-        confirmation_event.clear()
-        return confirmation_result
+    print(f"Sender public key hash (compare it with the sender's):\n  {pubkey_hash}")
+    while True:
+        answer = (
+            input("Accept [o]nce, [a]lways trust this sender, or [n]o? ")
+            .strip()
+            .lower()
+        )
+        if answer in ("o", "once", "y", "yes"):
+            return ACCEPT_ONCE
+        elif answer in ("a", "always"):
+            return ACCEPT_ALWAYS
+        elif answer in ("n", "no"):
+            return REJECT
+        else:
+            print("Please type 'o', 'a' or 'n'.")
+
+
+def request_confirmation(pubkey_hash, address=None, cli=False, trustable=False):
+    """Ask the user about a connection; returns a Future of the answer.
+
+    The answer is REJECT, ACCEPT_ONCE or, for `trustable` requests,
+    ACCEPT_ALWAYS. CLI prompts run one at a time on a dedicated thread;
+    otherwise the request is queued for the GUI.
+    """
+    if cli:
+        return _prompt_pool.submit(prompt_cli, pubkey_hash, trustable)
+    request = ConfirmationRequest(pubkey_hash, address, trustable)
+    confirmation_queue.put(request)
+    return request.future
+
+
+def confirm_receiver(pubkey_hash: str, cli: bool) -> bool:
+    return bool(request_confirmation(pubkey_hash, cli=cli).result())
 
 
 def set_confirmation_result(result: bool):
-    global confirmation_result
-    confirmation_result = result
-    confirmation_event.set()
+    """Answer the oldest open request; prefer ConfirmationRequest.resolve."""
+    with _open_requests_lock:
+        request = _open_requests[0] if _open_requests else None
+    if request:
+        request.resolve(result)
+
+
+def open_session(ip):
+    """Connect to the receiver and agree on a protocol version.
+
+    The hello offers PROTOCOL_VERSION; receivers that speak 3 or newer answer
+    with the version they picked. Receivers that only know version 2 close the
+    connection instead, in which case the sender reconnects offering 2.
+    """
+    for offered in (PROTOCOL_VERSION, MIN_PROTOCOL_VERSION):
+        s = tuning.connect((ip, PORT))
+        try:
+            s.sendall(HELLO + struct.pack("B", offered))
+            if offered < 3:
+                return s, offered
+            reply = s.recv(1)
+            if reply:
+                version = reply[0]
+                if not MIN_PROTOCOL_VERSION <= version <= offered:
+                    raise ConnectionError(f"Unsupported protocol version: {version}")
+                return s, version
+        except BaseException:
+            s.close()
+            raise
+        s.close()
+        logging.info("Receiver closed the hello, retrying with protocol 2")
+    raise ConnectionError("Receiver does not speak a supported protocol")
 
 
-def send_file(
-    ip, filepath, progress_callback=None, status_callback=None, stop_event=None
-):
+def join_transfer(ip, version, transfer_id, key, index):
+    """Open a stream of an already confirmed transfer.
+
+    Returns (socket, salt, status, offset). Protocol 3 receivers answer with
+    JOIN_ACCEPTED and the verified offset to continue from, JOIN_COMPLETE if
+    the range already arrived, or JOIN_REJECTED.
+    """
+    salt = secrets.token_bytes(16) if version >= 3 else b""
+    s = tuning.connect((ip, PORT))
     try:
-        if not os.path.isfile(filepath):
-            raise FileNotFoundError(f"File '{filepath}' does not exist.")
+        s.sendall(
+            JOIN_HELLO
+            + struct.pack("B", version)
+            + transfer_id
+            + struct.pack("B", index)
+            + salt
+            + join_proof(key, transfer_id, index, salt)
+        )
+        if version < 3:
+            return s, salt, JOIN_ACCEPTED, 0
+        status = recv_exact(s, 1)
+        if status == JOIN_REJECTED:
+            raise ConnectionError(f"Receiver rejected stream {index}")
+        offset = struct.unpack("Q", recv_exact(s, 8))[0]
+    except BaseException:
+        s.close()
+        raise
+    return s, salt, status, offset
+
+
+def resume_session(s, ticket, secret):
+    """Derive a session key from a resumption ticket, without any RSA work.
+
+    Returns the master key, or None if the receiver no longer accepts the
+    ticket; the full handshake then continues on the same connection.
+    """
+    client_nonce = secrets.token_bytes(16)
+    s.sendall(SESSION_RESUME)
+    send_blob(s, ticket)
+    s.sendall(client_nonce)
+    if recv_exact(s, 1) != b"\x01":
+        return None
+    server_nonce = recv_exact(s, 16)
+    master_key = resumed_master_key(secret, client_nonce, server_nonce)
+    s.sendall(resumption_proof(master_key))
+    return master_key
+
+
+def exchange_keys(s, ip, version, status_callback=None, stats=None):
+    """Agree on a master key with the receiver behind `s`.
+
+    Protocol 3 senders first try a cached resumption ticket. Otherwise
+    protocol 4 runs exchange_keys_ecdh, and older versions wrap a fresh
+    master key for the receiver's RSA key and sign it with their own, so
+    receivers can recognise trusted senders and skip the prompt.
+    Returns the master key, or None if the receiver rejected the connection.
+    """
+    stats = stats or metrics.NO_METRICS
+    if version >= 3:
+        cached = peers.load_ticket(ip)
+        if cached:
+            ticket, secret, fingerprint = cached
+            master_key = resume_session(s, ticket, secret)
+            if master_key:
+                stats.fingerprint = fingerprint
+                return master_key
+            logging.info("Session ticket was refused, doing a full handshake")
+            peers.drop_ticket(ip)
+        else:
+            s.sendall(SESSION_FULL)
+    if version >= 4:
+        return exchange_keys_ecdh(s, ip, status_callback, stats)
+
+    # Receive length-prefixed public key of receiver
+    pub_key_data = recv_blob(s)
+    receiver_pubkey = serialization.load_pem_public_key(pub_key_data)
+
+    # Compute receiver's public key hash
+    receiver_pubkey_hash = key_fingerprint(pub_key_data)
+    show_receiver_key(receiver_pubkey_hash, status_callback, stats, version)
+
+    master_key = secrets.token_bytes(AES_KEY_SIZE + 16)
+    encrypted_key = encrypt_aes_key(master_key, receiver_pubkey)
+
+    if version >= 3:
+        send_blob(s, public_key_pem())
+        send_blob(s, encrypted_key)
+        signed = bytes.fromhex(receiver_pubkey_hash) + encrypted_key
+        send_blob(s, sign_handshake(load_private_key(), signed))
+
+    if not receiver_confirmed(s, status_callback, stats):
+        return None
+
+    if version >= 3:
+        save_ticket(s, ip, master_key, receiver_pubkey_hash)
+    else:
+        send_blob(s, encrypted_key)
+    return master_key
+
+
+def exchange_keys_ecdh(s, ip, status_callback=None, stats=metrics.NO_METRICS):
+    """Protocol 4 full handshake: ephemeral X25519 shares signed with Ed25519.
+
+    Both sides sign the transcript of both identity keys and both shares, so
+    the session key is bound to the keys whose fingerprints are compared,
+    and is forward secret: the identity keys never encrypt anything.
+    Returns the master key, or None if the receiver rejected the connection.
+    """
+    receiver_identity = recv_blob(s)
+    receiver_key = load_identity_public_key(receiver_identity, "Receiver")
+    receiver_share = recv_exact(s, ECDH_SHARE_SIZE)
+    fingerprint = key_fingerprint(receiver_identity)
+    show_receiver_key(fingerprint, status_callback, stats, 4)
+
+    private_share, share = ecdh_share()
+    transcript = ecdh_transcript(
+        receiver_identity, receiver_share, identity_pem(), share
+    )
+    signature = load_identity_key().sign(b"sender" + transcript)
+    s.sendall(blob(identity_pem()) + share + blob(signature))
 
-        generate_keys()
+    if not receiver_confirmed(s, status_callback, stats):
+        return None
+    verify_identity(receiver_key, recv_blob(s), b"receiver" + transcript, "Receiver")
+    master_key = ecdh_master_key(private_share, receiver_share, transcript)
+    save_ticket(s, ip, master_key, fingerprint)
+    return master_key
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(10)
-            s.connect((ip, PORT))
 
-            s.sendall(b"REQ_PUBLIC_KEY")
+def show_receiver_key(fingerprint, status_callback, stats, version):
+    """Show the receiver's key hash and, from protocol 3 on, our own.
+
+    Protocol 3 and newer receivers are asked to confirm the sender's key,
+    so that is the hash their user compares with ours.
+    """
+    stats.fingerprint = fingerprint
+    if status_callback:
+        message = f"Receiver public key hash:\n{fingerprint}\n"
+        if version >= 3:
+            message += (
+                "Your public key hash (the receiver is asked to confirm it):\n"
+                f"{own_fingerprint(version)}\n"
+            )
+        status_callback(message + "Waiting for receiver confirmation...")
+
+
+def receiver_confirmed(s, status_callback, stats):
+    """Wait for the receiver's user; closes `s` and returns False if rejected."""
+    with stats.stage("confirm"), tuning.waiting(s, tuning.CONFIRM_TIMEOUT):
+        confirmation_byte = s.recv(1)
+    if confirmation_byte != b"\x01":
+        if status_callback:
+            status_callback("Receiver rejected the connection.")
+            notify("LANCryptor", "Receiver rejected the connection.")
+        s.close()
+        return False
+    return True
+
+
+def save_ticket(s, ip, master_key, fingerprint):
+    """Keep the resumption ticket the receiver sent, if it trusts us."""
+    ticket = recv_blob(s)
+    if not ticket:
+        peers.drop_ticket(ip)
+        return
+    secret = derive_secret(master_key, b"LANCryptor resumption")
+    peers.save_ticket(ip, ticket, secret, fingerprint)
+
+
+def expect_admission(s):
+    """Wait for the receiver to accept the transfer header.
+
+    Raises ReceiverBusy when the receiver is at capacity and asks the
+    sender to come back later.
+    """
+    reply = recv_exact(s, 1)
+    if reply == RECEIVER_BUSY:
+        raise ReceiverBusy(struct.unpack("H", recv_exact(s, 2))[0])
+    if reply == RECEIVER_NO_SPACE:
+        raise ReceiverFull(struct.unpack("Q", recv_exact(s, 8))[0])
+    if reply != b"\x01":
+        raise ConnectionError("Receiver refused the transfer")
+
+
+def retry_when_busy(send, status_callback=None, stop_event=None):
+    """Run `send`, backing off while the receiver reports it is busy.
+
+    Each retry waits at least as long as the receiver asked and doubles
+    with every attempt, plus some jitter so refused senders spread out.
+    Returns what `send` returned, or False if stop_event was set while waiting.
+    """
+    attempt = 0
+    while True:
+        try:
+            return send()
+        except ReceiverBusy as busy:
+            attempt += 1
+            if attempt > BUSY_ATTEMPTS:
+                raise
+            delay = min(max(busy.retry_after, 2**attempt), BUSY_MAX_DELAY)
+            delay *= random.uniform(1.0, 1.25)
+            logging.info(f"Receiver busy, retrying in {delay:.1f}s")
+            if status_callback:
+                status_callback(f"Receiver busy, retrying in {delay:.0f}s...")
+            if stop_event is None:
+                time.sleep(delay)
+            elif stop_event.wait(delay):
+                if status_callback:
+                    status_callback("Transfer stopped by user.")
+                return False
 
-            # Receive length-prefixed public key of receiver
-            receiver_pubkey_len_bytes = recv_exact(s, 4)
-            receiver_pubkey_len = struct.unpack("I", receiver_pubkey_len_bytes)[0]
-            pub_key_data = recv_exact(s, receiver_pubkey_len)
-            receiver_pubkey = serialization.load_pem_public_key(pub_key_data)
 
-            # Compute receiver's public key hash
-            digest = hashes.Hash(hashes.SHA256())
-            digest.update(pub_key_data)
-            receiver_pubkey_hash = digest.finalize().hex()
+def send_file_session(
+    ip,
+    filepath,
+    progress_callback,
+    status_callback,
+    stop_event,
+    streams,
+    compression,
+    delta,
+    dedup,
+    stats,
+    source=None,
+):
+    """Run one send_file session; raises ReceiverBusy if it was deferred.
+
+    Returns True once the receiver has confirmed the whole file. A
+    SharedChunks `source` (fan-out) is used by protocol 3 receivers.
+    """
+    with stats.stage("handshake"):
+        s, version = open_session(ip)
+    with s:
+        with stats.stage("handshake"):
+            master_key = exchange_keys(s, ip, version, status_callback, stats)
+        if master_key is None:
+            return
 
+        filename = os.path.basename(filepath)
+        s.sendall(filename.encode().ljust(256, b"\x00"))
+
+        filesize = os.path.getsize(filepath)
+        # Deltas and deduplicated sends need protocol 3 and a single stream
+        kind = KIND_FILE
+        if version >= 3 and (delta or dedup):
+            kind = KIND_DELTA if delta else KIND_DEDUP
+            streams = 1
+        if version < 3:
+            source = None
+        elif source:
+            streams = 1
+        ranges = split_ranges(filesize, stream_count(filesize, streams))
+        transfer_id = secrets.token_bytes(16)
+        header = struct.pack("QB", filesize, len(ranges)) + transfer_id
+
+        # Sample the file up front so the first chunks start at a sensible level
+        initial_ratio = None
+        if version >= 3:
+            if source:
+                initial_ratio = source.ratio
+            elif compression == "auto":
+                initial_ratio = estimate_ratio(filepath)
+                logging.info(f"Estimated compression ratio: {initial_ratio:.2f}")
+            header += struct.pack("BB", MODE_IDS[compression], kind)
+        s.sendall(header)
+
+        # The receiver acknowledges once the transfer is ready for joins
+        with stats.stage("admission"):
+            expect_admission(s)
+
+        sent = [0] * len(ranges)
+        sent_lock = threading.Lock()
+
+        def stream_progress(index):
+            def on_progress(count):
+                with sent_lock:
+                    sent[index] += count
+                    if progress_callback and filesize:
+                        progress_callback(sum(sent) / filesize * 100)
+
+            return on_progress
+
+        if kind == KIND_DELTA:
+            literal = send_delta(
+                s,
+                master_key,
+                filepath,
+                stream_progress(0),
+                stop_event,
+                AdaptiveCompressor(compression, initial_ratio),
+                stats,
+            )
+            if literal is None:
+                if status_callback:
+                    status_callback("Transfer stopped by user.")
+                return
+            with tuning.waiting(s, tuning.VERIFY_TIMEOUT):
+                applied = recv_exact(s, 1)
+            if applied != b"\x01":
+                raise ConnectionError("Receiver could not apply the delta")
+            logging.info(f"Delta sent {literal} of {filesize} bytes as data")
             if status_callback:
                 status_callback(
-                    f"Receiver public key hash:\n{receiver_pubkey_hash}\nWaiting for receiver confirmation..."
+                    f"File sent successfully ✅ (delta: {literal} of {filesize} bytes changed)"
                 )
-
-            # Wait for confirmation byte from receiver
-            confirmation_byte = s.recv(1)
-            if confirmation_byte != b"\x01":
+                notify("LANCryptor", "File sent successfully ✅")
+            return True
+
+        if kind == KIND_DEDUP:
+            sent_bytes = send_dedup(
+                s,
+                master_key,
+                filepath,
+                stream_progress(0),
+                stop_event,
+                AdaptiveCompressor(compression, initial_ratio),
+                stats,
+            )
+            if sent_bytes is None:
                 if status_callback:
-                    status_callback("Receiver rejected the connection.")
-                    notify("LANCryptor", "Receiver rejected the connection.")
-                s.close()
+                    status_callback("Transfer stopped by user.")
                 return
+            with tuning.waiting(s, tuning.VERIFY_TIMEOUT):
+                rebuilt = recv_exact(s, 1)
+            if rebuilt != b"\x01":
+                raise ConnectionError("Receiver could not rebuild the file")
+            logging.info(f"Dedup sent {sent_bytes} of {filesize} bytes")
+            if status_callback:
+                status_callback(
+                    f"File sent successfully ✅ ({filesize - sent_bytes} of {filesize} bytes already on receiver)"
+                )
+                notify("LANCryptor", "File sent successfully ✅")
+            return True
+
+        results = [None] * len(ranges)
+        streams_key = transfer_key(master_key, transfer_id, version)
+
+        def run_stream(index):
+            start, end = ranges[index]
+            attempt = 0
+            while True:
+                try:
+                    if index == 0 and attempt == 0:
+                        conn, salt, status, offset = s, b"", JOIN_ACCEPTED, 0
+                    else:
+                        conn, salt, status, offset = join_transfer(
+                            ip, version, transfer_id, streams_key, index
+                        )
+                    with conn:
+                        with sent_lock:
+                            sent[index] = offset
+                        if status == JOIN_COMPLETE:
+                            results[index] = True
+                            return
+                        key, iv = derive_stream_key(streams_key, index, salt)
+                        results[index] = send_range(
+                            conn,
+                            version,
+                            filepath,
+                            start + offset,
+                            end,
+                            key,
+                            iv,
+                            stream_progress(index),
+                            stop_event,
+                            compression,
+                            initial_ratio,
+                            stats,
+                            source,
+                            range_start=start,
+                        )
+                        # Protocol 3 receivers confirm each verified range
+                        if (
+                            results[index]
+                            and version >= 3
+                            and not confirm_range(
+                                conn, filepath, start, end, key, stop_event, stats
+                            )
+                        ):
+                            raise ConnectionError("Range was not verified")
+                    return
+                except (ConnectionError, TimeoutError) as e:
+                    if version < 3 or attempt >= RESUME_ATTEMPTS:
+                        results[index] = e
+                        return
+                    attempt += 1
+                    logging.warning(f"Stream {index} interrupted ({e}), resuming")
+                    if status_callback:
+                        status_callback(
+                            f"Connection lost, resuming (attempt {attempt})..."
+                        )
+                    time.sleep(min(2**attempt, 30))
+                except Exception as e:
+                    results[index] = e
+                    return
+
+        # Every range goes over its own connection with its own key/IV
+        workers = [
+            threading.Thread(target=run_stream, args=(index,), daemon=True)
+            for index in range(1, len(ranges))
+        ]
+        for worker in workers:
+            worker.start()
+        run_stream(0)
+        for worker in workers:
+            worker.join()
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        if not all(results):
+            if status_callback:
+                status_callback("Transfer stopped by user.")
+            return
 
-            # Optionally, sender UI can show this hash for sender user awareness
-            # Here you could add a prompt or auto-continue
+        if status_callback:
+            status_callback("File sent successfully ✅")
+            notify("LANCryptor", "File sent successfully ✅")
+        return True
 
-            aes_key = secrets.token_bytes(AES_KEY_SIZE)
-            iv = secrets.token_bytes(16)
-            encrypted_key = encrypt_aes_key(aes_key + iv, receiver_pubkey)
 
-            s.sendall(struct.pack("I", len(encrypted_key)))
-            s.sendall(encrypted_key)
+def send_file(
+    ip,
+    filepath,
+    progress_callback=None,
+    status_callback=None,
+    stop_event=None,
+    streams=1,
+    compression="auto",
+    delta=False,
+    dedup=False,
+    source=None,
+):
+    """Send one file to `ip`; returns True if the receiver confirmed it."""
+    stats = metrics.TransferMetrics("send", os.path.basename(filepath), ip)
+    ok = False
+    try:
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError(f"File '{filepath}' does not exist.")
+        if compression not in MODES:
+            raise ValueError(f"Unknown compression mode: {compression}")
+        stats.size = os.path.getsize(filepath)
+
+        with stats.stage("keys"):
+            generate_keys()
+
+        ok = retry_when_busy(
+            lambda: send_file_session(
+                ip,
+                filepath,
+                progress_callback,
+                status_callback,
+                stop_event,
+                streams,
+                compression,
+                delta,
+                dedup,
+                stats,
+                source,
+            ),
+            status_callback,
+            stop_event,
+        )
+
+    except Exception as e:
+        report_send_error(e, status_callback)
+    finally:
+        stats.finish(ok)
+    return bool(ok)
 
-            filename = os.path.basename(filepath)
-            s.sendall(filename.encode().ljust(256, b"\x00"))
 
-            compressed_data = compress_file(filepath)
+def send_file_fanout(
+    ips,
+    filepath,
+    progress_callback=None,
+    status_callback=None,
+    stop_event=None,
+    compression="auto",
+):
+    """Send one file to several receivers at once.
 
-            digest = hashes.Hash(hashes.SHA256())
-            digest.update(compressed_data)
-            file_hash = digest.finalize()
-            s.sendall(file_hash)
-            logging.info(f"Sent file hash: {file_hash.hex()}")
+    The file is read and compressed once (see SharedChunks) and sealed
+    separately with each receiver's session key. Every receiver gets its own
+    session, retries and result; `progress_callback(ip, percent)` and
+    `status_callback(ip, message)` say which one they are about.
+    Returns {ip: True if that receiver confirmed the file}.
+    """
 
-            cipher = create_cipher(aes_key, iv)
-            encryptor = cipher.encryptor()
+    def for_peer(callback, ip):
+        if callback:
+            return lambda value: callback(ip, value)
 
-            sent = 0
-            padder = padding.PKCS7(128).padder()
-            padded_data = padder.update(compressed_data) + padder.finalize()
+    results = {}
+    try:
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError(f"File '{filepath}' does not exist.")
+        if compression not in MODES:
+            raise ValueError(f"Unknown compression mode: {compression}")
+        generate_keys()
+        source = SharedChunks(filepath, compression)
+    except (OSError, ValueError) as e:
+        for ip in ips:
+            report_send_error(e, for_peer(status_callback, ip))
+        return {ip: False for ip in ips}
+
+    def send_to(ip):
+        results[ip] = send_file(
+            ip,
+            filepath,
+            for_peer(progress_callback, ip),
+            for_peer(status_callback, ip),
+            stop_event,
+            compression=compression,
+            source=source,
+        )
 
-            s.sendall(struct.pack("Q", len(padded_data)))
+    workers = [threading.Thread(target=send_to, args=(ip,), daemon=True) for ip in ips]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        source.close()
+    return results
+
+
+def send_files_session(
+    ip,
+    entries,
+    label,
+    progress_callback,
+    status_callback,
+    stop_event,
+    compression,
+    stats,
+):
+    """Run one send_files session; raises ReceiverBusy if it was deferred.
+
+    Returns True once the receiver has stored every entry.
+    """
+    total = sum(size for _, _, size in entries)
+    with stats.stage("handshake"):
+        s, version = open_session(ip)
+    with s:
+        if version < 3:
+            raise ConnectionError("Receiver does not support batch transfers")
+        with stats.stage("handshake"):
+            master_key = exchange_keys(s, ip, version, status_callback, stats)
+        if master_key is None:
+            return
 
-            with io.BytesIO(padded_data) as f:
-                while chunk := f.read(BUFFER_SIZE):
-                    if stop_event and stop_event.is_set():
-                        if status_callback:
-                            status_callback("Transfer stopped by user.")
-                        return
-                    encrypted = encryptor.update(chunk)
-                    s.sendall(encrypted)
-                    sent += len(chunk)
-                    if progress_callback:
-                        progress_callback(sent / len(padded_data) * 100)
+        initial_ratio = None
+        if compression == "auto" and entries:
+            sampled = max(entries, key=lambda entry: entry[2])[0]
+            initial_ratio = estimate_ratio(sampled)
 
+        s.sendall(label.encode().ljust(256, b"\x00"))
+        s.sendall(
+            struct.pack("QB", total, 1)
+            + secrets.token_bytes(16)
+            + struct.pack("BB", MODE_IDS[compression], KIND_BATCH)
+        )
+        with stats.stage("admission"):
+            expect_admission(s)
+
+        sent = 0
+
+        def on_progress(count):
+            nonlocal sent
+            sent += count
+            if progress_callback and total:
+                progress_callback(sent / total * 100)
+
+        key, iv = derive_stream_key(master_key, 0)
+        compressor = AdaptiveCompressor(compression, initial_ratio)
+        if not send_chunks(
+            s,
+            batch_records(entries),
+            key,
+            iv,
+            on_progress,
+            stop_event,
+            compressor,
+            stats,
+        ):
             if status_callback:
-                status_callback("File sent successfully ✅")
-                notify("LANCryptor", "File sent successfully ✅")
+                status_callback("Transfer stopped by user.")
+            return
+        if recv_exact(s, 1) != b"\x01":
+            raise ConnectionError("Receiver could not store every file")
 
-    except FileNotFoundError:
+        if status_callback:
+            status_callback(f"{len(entries)} files sent successfully ✅")
+            notify("LANCryptor", f"{len(entries)} files sent successfully ✅")
+        return True
+
+
+def send_files(
+    ip,
+    paths,
+    progress_callback=None,
+    status_callback=None,
+    stop_event=None,
+    compression="auto",
+):
+    """Send files and directories in one session with a single confirmation.
+
+    All entries share one connection and key: each file is announced by a
+    small sealed entry header followed by its data chunks. Returns True if
+    the receiver stored every entry.
+    """
+    stats = metrics.TransferMetrics("send", peer=ip)
+    ok = False
+    try:
+        entries = collect_entries(paths)
+        if compression not in MODES:
+            raise ValueError(f"Unknown compression mode: {compression}")
+        if len(paths) == 1:
+            label = os.path.basename(os.path.abspath(paths[0]))[:64]
+        else:
+            label = f"{len(entries)} files"
+        stats.name = label
+        stats.size = sum(size for _, _, size in entries)
+
+        with stats.stage("keys"):
+            generate_keys()
+
+        ok = retry_when_busy(
+            lambda: send_files_session(
+                ip,
+                entries,
+                label,
+                progress_callback,
+                status_callback,
+                stop_event,
+                compression,
+                stats,
+            ),
+            status_callback,
+            stop_event,
+        )
+
+    except Exception as e:
+        report_send_error(e, status_callback)
+    finally:
+        stats.finish(ok)
+    return bool(ok)
+
+
+def report_send_error(error, status_callback):
+    if isinstance(error, FileNotFoundError):
         logging.error("File not found. Check path.")
         if status_callback:
             status_callback("❌ File not found")
             notify("LANCryptor", "File not found. Check path.")
-    except ConnectionRefusedError:
+    elif isinstance(error, ReceiverBusy):
+        logging.error("Receiver stayed busy, giving up.")
+        if status_callback:
+            status_callback("❌ Receiver is busy. Try again later.")
+            notify("LANCryptor", "❌ Receiver is busy. Try again later.")
+    elif isinstance(error, ReceiverFull):
+        logging.error(str(error))
+        if status_callback:
+            status_callback(f"❌ {error}")
+            notify("LANCryptor", f"❌ {error}")
+    elif isinstance(error, ConnectionRefusedError):
         logging.error("Connection refused.")
         if status_callback:
             status_callback("❌ Connection refused. Is receiver running?")
             notify("LANCryptor", "❌ Connection refused. Is receiver running?")
-    except socket.timeout:
+    elif isinstance(error, socket.timeout):
         logging.error("Socket timeout.")
         if status_callback:
             status_callback("❌ Timeout. No response from receiver.")
             notify("LANCryptor", "❌ Timeout. No response from receiver.")
-    except Exception as e:
-        logging.exception("Unexpected error during send_file")
+    else:
+        logging.error("Unexpected error during send", exc_info=error)
+        message = f"❌ Unexpected error: {type(error).__name__}: {error}"
         if status_callback:
-            status_callback(f"❌ Unexpected error: {type(e).__name__}: {e}")
-            notify("LANCryptor", f"❌ Unexpected error: {type(e).__name__}: {e}")
+            status_callback(message)
+            notify("LANCryptor", message)
 
 
-def handle_client(conn, addr, status_callback=None, progress_callback=None, cli=False):
-    try:
-        conn.settimeout(60)
-        if conn.recv(1024) != b"REQ_PUBLIC_KEY":
-            conn.close()
-            return
+def serve_stream(
+    conn, transfer, index, salt, offset, status_callback, progress_callback
+):
+    """Receive one stream of `transfer` and commit the file if it was the last."""
+    key, iv = derive_stream_key(transfer.key, index, salt)
 
-        # Send receiver's public key with length prefix
-        with open(KEY_FILE_PUBLIC, "rb") as f:
-            receiver_pubkey_data = f.read()
-        conn.sendall(struct.pack("I", len(receiver_pubkey_data)))
-        conn.sendall(receiver_pubkey_data)
+    def on_progress(count):
+        received = transfer.advance(index, count)
+        if progress_callback and transfer.filesize:
+            progress_callback(min(received / transfer.filesize * 100, 100))
 
-        # Calculate receiver's public key hash for confirmation
-        digest = hashes.Hash(hashes.SHA256())
-        digest.update(receiver_pubkey_data)
-        receiver_pubkey_hash = digest.finalize().hex()
+    ok = completed = stored = False
+    try:
+        try:
+            ok = receive_range(conn, transfer, index, key, iv, offset, on_progress)
+        finally:
+            completed = transfer.release(index, ok)
+        # The last stream is only acknowledged once the file is in place
+        if completed:
+            try:
+                commit_received_file(transfer.part_path, transfer.filename)
+                stored = True
+            except OSError as e:
+                logging.error(f"Could not store {transfer.filename}: {e}")
+                transfer.committed = False
+        if transfer.resumable:
+            conn.sendall(b"\x01" if ok and (stored or not completed) else b"\x00")
+    finally:
+        if completed or (not ok and not transfer.resumable):
+            forget_transfer(transfer)
+            transfer.discard()
 
+    if not ok:
+        logging.error("File integrity check failed!")
         if status_callback:
-            status_callback(
-                f"Connection from {addr[0]} - Confirm receiver key:\n{receiver_pubkey_hash}"
-            )
-
-        # Ask UI to confirm receiver public key hash
-        confirmed = confirm_receiver(receiver_pubkey_hash, cli=cli)
-        if not confirmed:
-            if status_callback:
-                status_callback("Connection rejected by user.")
-                notify("LANCryptor", "Connection rejected by user.")
-            conn.sendall(b"\x00")
-            conn.close()
-            return
-
-        # Send approval to sender
-        conn.sendall(b"\x01")
-
-        enc_key_len = struct.unpack("I", recv_exact(conn, 4))[0]
-        enc_key = recv_exact(conn, enc_key_len)
-        aes_key_iv = decrypt_aes_key(enc_key, load_private_key())
-        aes_key, iv = aes_key_iv[:AES_KEY_SIZE], aes_key_iv[AES_KEY_SIZE:]
-
-        filename = recv_exact(conn, 256).rstrip(b"\x00").decode()
-
-        expected_hash = recv_exact(conn, 32)
-
-        filesize = struct.unpack("Q", recv_exact(conn, 8))[0]
-
-        os.makedirs(RECEIVED_DIR, exist_ok=True)
-
-        cipher = create_cipher(aes_key, iv)
-        decryptor = cipher.decryptor()
-
-        written = 0
-        zip_data = io.BytesIO()
-        while written < filesize:
-            chunk = conn.recv(min(BUFFER_SIZE, filesize - written))
-            if not chunk:
-                notify("LANCryptor", "Connection lost during file receive")
-                raise ConnectionError("Connection lost during file receive")
-            written += len(chunk)
-            decrypted = decryptor.update(chunk)
-            zip_data.write(decrypted)
-            if progress_callback:
-                progress_callback(written / filesize * 100)
-        final = decryptor.finalize()
-        zip_data.write(final)
-
-        padded = zip_data.getvalue()
-        unpadder = padding.PKCS7(128).unpadder()
-        unpadded_data = unpadder.update(padded) + unpadder.finalize()
-
-        # Verify hash
-        digest = hashes.Hash(hashes.SHA256())
-        digest.update(unpadded_data)
-        actual_hash = digest.finalize()
-
-        logging.info(f"Expected hash: {expected_hash.hex()}")
-        logging.info(f"Actual hash:   {actual_hash.hex()}")
+            status_callback("File integrity check failed!")
+        return
+    if completed and status_callback:
+        if stored:
+            message = f"File received: {transfer.filename} ✅"
+        else:
+            message = f"❌ Could not store {transfer.filename}"
+        notify("LANCryptor", message)
+        status_callback(message)
+
+
+def serve_join(
+    conn,
+    addr,
+    version,
+    transfer_id,
+    index,
+    salt,
+    proof,
+    status_callback=None,
+    progress_callback=None,
+):
+    """Serve a stream joining, or resuming, a transfer confirmed earlier."""
+    transfer = find_transfer(transfer_id)
+    if (
+        transfer is None
+        or transfer.version != version
+        or not hmac.compare_digest(
+            proof, join_proof(transfer.key, transfer_id, index, salt)
+        )
+    ):
+        logging.error(f"Rejected join from {addr[0]} for unknown transfer")
+        if version >= 3:
+            conn.sendall(JOIN_REJECTED)
+        return
+    if transfer.resumable and index < len(transfer.done) and transfer.done[index]:
+        conn.sendall(JOIN_COMPLETE + struct.pack("Q", transfer.offsets[index]))
+        return
+
+    offset = transfer.join(index)
+    if offset is None:
+        logging.error(f"Rejected join for busy or unknown stream {index}")
+        if version >= 3:
+            conn.sendall(JOIN_REJECTED)
+        return
+    if version >= 3:
+        if offset:
+            logging.info(f"Resuming stream {index} at offset {offset}")
+        conn.sendall(JOIN_ACCEPTED + struct.pack("Q", offset))
+    serve_stream(
+        conn, transfer, index, salt, offset, status_callback, progress_callback
+    )
 
-        if actual_hash != expected_hash:
-            logging.error("File integrity check failed!")
-            if status_callback:
-                status_callback("File integrity check failed!")
-            conn.close()
-            return
 
-        decompress_file(unpadded_data)
+def join_request_size(version):
+    """Bytes following JOIN_HELLO: transfer ID, index, salt (3+) and proof."""
+    return 16 + 1 + (16 if version >= 3 else 0) + 32
+
+
+def parse_join_request(data, version):
+    """Return (transfer_id, index, salt, proof) from a join request."""
+    salt_size = 16 if version >= 3 else 0
+    return data[:16], data[16], data[17 : 17 + salt_size], data[17 + salt_size :]
+
+
+def header_size(version):
+    """Bytes of the transfer header that follows the key exchange."""
+    return 256 + 9 + 16 + (2 if version >= 3 else 0)
+
+
+def parse_header(data, version):
+    """Decode a transfer header into a TransferHeader."""
+    filename = data[:256].rstrip(b"\x00").decode()
+    filesize, streams = struct.unpack_from("QB", data, 256)
+    transfer_id = data[265:281]
+    if not 1 <= streams <= MAX_STREAMS:
+        raise ConnectionError(f"Unsupported stream count: {streams}")
+    compression = "auto"
+    kind = KIND_FILE
+    if version >= 3:
+        mode, kind = data[281], data[282]
+        if mode >= len(MODES):
+            raise ConnectionError(f"Unsupported compression mode: {mode}")
+        compression = MODES[mode]
+    if kind not in (KIND_FILE, KIND_BATCH, KIND_DELTA, KIND_DEDUP):
+        raise ConnectionError(f"Unsupported transfer kind: {kind}")
+    if kind != KIND_FILE and streams != 1:
+        raise ConnectionError("Only plain file transfers use several streams")
+    # The file is stored under its base name; a batch name is only a label
+    if kind != KIND_BATCH:
+        entry_parts(os.path.basename(filename))
+    return TransferHeader(filename, filesize, streams, transfer_id, compression, kind)
+
+
+def receive_session(
+    conn,
+    version,
+    master_key,
+    header,
+    status_callback=None,
+    progress_callback=None,
+    on_finish=None,
+    stats=None,
+):
+    """Receive the payload announced by `header` once the session is set up.
+
+    `on_finish` runs once the transfer no longer needs receiver resources:
+    straight after single-connection payloads, or when a multi-stream file
+    is committed, fails or is dropped from pending_transfers. `stats`, a
+    metrics.TransferMetrics, is finished at the same point.
+    """
+    stats = stats or metrics.NO_METRICS
+    filename, filesize = header.filename, header.filesize
+    received = 0
+
+    def on_progress(count):
+        nonlocal received
+        received += count
+        if progress_callback and filesize:
+            progress_callback(min(received / filesize * 100, 100))
+
+    if header.kind != KIND_FILE:
+        ok = False
+        try:
+            conn.sendall(b"\x01")
+            if header.kind == KIND_BATCH:
+                count = receive_batch(
+                    conn, master_key, header.compression, on_progress, stats
+                )
+                message = f"Received {count} files ({filename}) ✅"
+            else:
+                receive = receive_delta if header.kind == KIND_DELTA else receive_dedup
+                receive(
+                    conn,
+                    master_key,
+                    filename,
+                    filesize,
+                    header.compression,
+                    on_progress,
+                    stats,
+                )
+                message = f"File received: {filename} ✅"
+            conn.sendall(b"\x01")
+            ok = True
+        finally:
+            if on_finish:
+                on_finish()
+            stats.finish(ok)
         if status_callback:
-            notify("LANCryptor", f"File received: {filename} ✅")
-            status_callback(f"File received: {filename} ✅")
+            notify("LANCryptor", message)
+            status_callback(message)
+        return
 
-    except FileNotFoundError:
+    try:
+        transfer = IncomingTransfer(
+            header.transfer_id,
+            version,
+            filename,
+            filesize,
+            header.streams,
+            transfer_key(master_key, header.transfer_id, version),
+            header.compression,
+            on_finish=on_finish,
+            stats=stats,
+        )
+    except BaseException as e:
+        if isinstance(e, storage.InsufficientSpace) and version >= 3:
+            conn.sendall(RECEIVER_NO_SPACE + struct.pack("Q", e.free))
+        if on_finish:
+            on_finish()
+        stats.finish(False)
+        raise
+    with pending_transfers_lock:
+        pending_transfers[header.transfer_id] = transfer
+    conn.sendall(b"\x01")
+
+    # This connection carries the first range; the others join it
+    transfer.join(0)
+    serve_stream(conn, transfer, 0, b"", 0, status_callback, progress_callback)
+
+
+def report_receive_error(error, status_callback):
+    if isinstance(error, FileNotFoundError):
         logging.error("Missing key file.")
         if status_callback:
             status_callback("❌ Key file not found")
             notify("LANCryptor", "❌ Key file not found")
-    except socket.timeout:
+    elif isinstance(error, storage.InsufficientSpace):
+        logging.error(error.strerror)
+        if status_callback:
+            status_callback(f"❌ {error.strerror}")
+            notify("LANCryptor", f"❌ {error.strerror}")
+    elif isinstance(error, socket.timeout):
         logging.error("Client connection timed out.")
         if status_callback:
             status_callback("❌ Timeout during client communication.")
             notify("LANCryptor", "❌ Timeout during client communication.")
-    except ConnectionError as e:
-        logging.error(f"Connection error: {e}")
+    elif isinstance(error, ConnectionError):
+        logging.error(f"Connection error: {error}")
         if status_callback:
-            status_callback(f"❌ Connection error: {e}")
-            notify("LANCryptor", f"❌ Connection error: {e}")
-    except Exception as e:
-        logging.exception("Unexpected error in handle_client")
+            status_callback(f"❌ Connection error: {error}")
+            notify("LANCryptor", f"❌ Connection error: {error}")
+    else:
+        logging.error("Unexpected error while receiving", exc_info=error)
+        message = f"❌ Unexpected error: {type(error).__name__}: {error}"
         if status_callback:
-            status_callback(f"❌ Unexpected error: {type(e).__name__}: {e}")
-            notify("LANCryptor", f"❌ Unexpected error: {type(e).__name__}: {e}")
-    finally:
-        conn.close()
+            status_callback(message)
+            notify("LANCryptor", message)
 
 
 def receiver_thread(
-    status_callback=None, progress_callback=None, stop_event=None, cli=False
+    status_callback=None,
+    progress_callback=None,
+    stop_event=None,
+    cli=False,
+    limits=None,
+    load_callback=None,
+    auto_accept=False,
 ):
-    generate_keys()
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(("", PORT))
-    s.listen()
-    s.settimeout(1.0)
+    """Run the receiver until stop_event is set; see receiver.ReceiverServer.
 
-    if status_callback:
-        status_callback("Listening for incoming files...")
+    `limits` is a receiver.AdmissionLimits; `load_callback` is called with
+    the receiver's load (see AdmissionControl.load) whenever it changes.
+    `auto_accept` approves every sender without a prompt (benchmarks only).
+    """
+    import asyncio
+    import receiver
 
     try:
-        while not (stop_event and stop_event.is_set()):
-            try:
-                conn, addr = s.accept()
-                threading.Thread(
-                    target=handle_client,
-                    args=(conn, addr, status_callback, progress_callback, cli),
-                    daemon=True,
-                ).start()
-            except socket.timeout:
-                continue
+        generate_keys()
+        server = receiver.ReceiverServer(
+            status_callback,
+            progress_callback,
+            cli,
+            limits,
+            load_callback,
+            auto_accept,
+        )
+        asyncio.run(server.run(stop_event))
     except OSError as e:
         logging.error(f"Socket bind/listen error: {e}")
         if status_callback:
@@ -442,18 +2975,18 @@ def receiver_thread(
             status_callback(f"❌ Receiver error: {type(e).__name__}: {e}")
             notify("LANCryptor", f"❌ Receiver error: {type(e).__name__}: {e}")
     finally:
-        try:
-            s.close()
-        except Exception:
-            pass
         if status_callback:
             status_callback("🛑 Receiver stopped.")
             notify("LANCryptor", "🛑 Receiver stopped.")
 
 
 def notify(title, message):
+    if not NOTIFICATIONS:
+        return
     icon_path = resource_path("assets/tray.ico")
     try:
+        from plyer import notification
+
         notification.notify(
             title=title,
             message=message,
@@ -0,0 +1,232 @@
+import contextlib
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+
+# Seconds to wait for the receiver to accept a TCP connection
+CONNECT_TIMEOUT = 10
+# A connection is given up once a single read or write has made no progress
+# for this long; the transfer as a whole may take as long as it needs
+IDLE_TIMEOUT = 60
+# Waits for the receiver's user (approving a key), and for a receiver
+# reading, rebuilding or hashing a whole file before it answers (delta, dedup)
+CONFIRM_TIMEOUT = 10 * 60
+VERIFY_TIMEOUT = 10 * 60
+# Requested SO_SNDBUF / SO_RCVBUF; None leaves the kernel's defaults
+SOCKET_BUFFER = 4 * 1024 * 1024
+# Chunks grow until each carries about this many seconds of data at the
+# measured throughput; the rate is measured again every SAMPLE_BYTES
+CHUNK_TIME = 0.001
+SAMPLE_BYTES = 8 * 1024 * 1024
+
+# Start of Linux's struct tcp_info, up to tcpi_rtt (microseconds)
+TCP_INFO = struct.Struct("8B16I")
+AUTOTUNE_LIMITS = {
+    socket.SO_SNDBUF: "/proc/sys/net/ipv4/tcp_wmem",
+    socket.SO_RCVBUF: "/proc/sys/net/ipv4/tcp_rmem",
+}
+
+_buffer_sizes = {}
+_buffer_lock = threading.Lock()
+
+
+def buffer_size(option):
+    """Bytes to request for `option` (SO_SNDBUF or SO_RCVBUF), or None.
+
+    An explicit size switches Linux's buffer autotuning off, so it is only
+    requested where autotuning stops below SOCKET_BUFFER, and only if the
+    kernel actually grants it (net.core.wmem_max / rmem_max). Decided once
+    per process.
+    """
+    with _buffer_lock:
+        if option not in _buffer_sizes:
+            _buffer_sizes[option] = _probe_buffer(option)
+        return _buffer_sizes[option]
+
+
+def _probe_buffer(option):
+    if not SOCKET_BUFFER:
+        return None
+    if sys.platform == "linux":
+        try:
+            with open(AUTOTUNE_LIMITS[option]) as f:
+                if int(f.read().split()[2]) >= SOCKET_BUFFER:
+                    return None
+        except (OSError, ValueError, IndexError):
+            pass
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            granted = probe.getsockopt(socket.SOL_SOCKET, option)
+    except OSError:
+        return None
+    if granted < SOCKET_BUFFER:
+        logging.info(
+            f"Kernel limits socket buffers to {granted} bytes, keeping its defaults"
+        )
+        return None
+    return SOCKET_BUFFER
+
+
+def set_buffers(sock):
+    """Apply SO_SNDBUF / SO_RCVBUF (see buffer_size) to sock or a listener."""
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        size = buffer_size(option)
+        if size:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+
+def nodelay(sock, enabled):
+    """Switch Nagle's algorithm off (handshakes, acks) or back on (bulk data).
+
+    Enabling TCP_NODELAY also pushes out anything Nagle was holding back.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+    except OSError:
+        pass
+
+
+def connect(address):
+    """Open a tuned connection for a handshake.
+
+    CONNECT_TIMEOUT applies to the connect itself; afterwards every read
+    and write gets IDLE_TIMEOUT.
+    """
+    sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+    try:
+        set_buffers(sock)
+        nodelay(sock, True)
+        sock.settimeout(IDLE_TIMEOUT)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+@contextlib.contextmanager
+def waiting(sock, seconds):
+    """Allow a single read on sock to take up to `seconds`."""
+    previous = sock.gettimeout()
+    sock.settimeout(seconds)
+    try:
+        yield sock
+    finally:
+        sock.settimeout(previous)
+
+
+def rtt(sock):
+    """Smoothed round-trip time the kernel measured for sock, in seconds.
+
+    Returns None where TCP_INFO is not available.
+    """
+    if sys.platform != "linux" or not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    except OSError:
+        return None
+    if len(info) < TCP_INFO.size:
+        return None
+    return TCP_INFO.unpack_from(info)[-1] / 1_000_000
+
+
+def parameters(sock):
+    """Buffer sizes the kernel granted, Nagle state and RTT of a connection."""
+    params = {}
+    try:
+        params["send_buffer"] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        params["receive_buffer"] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        params["nodelay"] = bool(
+            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        )
+    except OSError:
+        pass
+    seconds = rtt(sock)
+    params["rtt_ms"] = round(seconds * 1000, 3) if seconds is not None else None
+    params["idle_timeout"] = IDLE_TIMEOUT
+    return params
+
+
+class ChunkSizer:
+    """Size of each next chunk of a stream, grown from measured throughput.
+
+    Called once per chunk. Starts at `minimum` and doubles, up to
+    `maximum`, whenever a chunk would carry less than CHUNK_TIME of data at
+    the rate measured over the last SAMPLE_BYTES. Larger chunks cut the
+    per-chunk cost of compressing, sealing and framing on fast links; slow
+    links keep small chunks, which resume and fan out at a finer grain. A
+    chunk never exceeds half of the send buffer of `sock`, so the next one
+    can be queued while the kernel sends it. Linux autotuning starts that
+    buffer small and grows it with the connection, so it is read again
+    with every sample.
+    """
+
+    def __init__(self, minimum, maximum, sock=None):
+        self.minimum = minimum
+        self.limit = maximum
+        self.sock = sock
+        self.maximum = self._maximum()
+        self.size = minimum
+        self.rate = None
+        self._sample_start = None
+        self._sampled = 0
+
+    def _maximum(self):
+        """`limit`, capped at half of the send buffer the kernel has now."""
+        if self.sock is None:
+            return self.limit
+        try:
+            send_buffer = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        except OSError:
+            return self.limit
+        return max(self.minimum, min(self.limit, send_buffer // 2))
+
+    def __call__(self):
+        now = time.perf_counter()
+        if self._sample_start is None:
+            self._sample_start = now
+        elif self._sampled >= SAMPLE_BYTES and now > self._sample_start:
+            self.rate = self._sampled / (now - self._sample_start)
+            self.maximum = self._maximum()
+            while self.size < self.maximum and self.rate * CHUNK_TIME >= self.size * 2:
+                self.size *= 2
+            self.size = min(self.size, self.maximum)
+            self._sample_start, self._sampled = now, 0
+        self._sampled += self.size
+        return self.size
+
+    def parameters(self):
+        return {
+            "chunk_size": self.size,
+            "max_chunk_size": self.maximum,
+            "measured_bytes_per_second": round(self.rate) if self.rate else None,
+        }
+
+
+def report(sock, sizer=None, stats=None, label="stream"):
+    """Log the parameters a stream ran with, and add them to its metrics."""
+    params = parameters(sock)
+    if sizer:
+        params.update(sizer.parameters())
+    rate, seconds = params.get("measured_bytes_per_second"), rtt(sock)
+    buffer = params.get("send_buffer")
+    if rate and seconds and buffer and rate * seconds > buffer:
+        logging.warning(
+            f"Send buffer ({buffer} bytes) is below the bandwidth-delay product"
+            f" ({rate * seconds:.0f} bytes) and may limit throughput"
+        )
+    try:
+        peer = sock.getpeername()[0]
+    except OSError:
+        peer = "?"
+    logging.info(
+        f"Transport {label} {peer}: "
+        + ", ".join(f"{key}={value}" for key, value in params.items())
+    )
+    if stats:
+        stats.add_transport(params)
+    return params